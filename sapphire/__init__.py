@@ -70,7 +70,8 @@ from . import transformations
 from . import utils
 
 from .analysis.calibration import (determine_detector_timing_offsets,
-                                   DetermineStationTimingOffsets)
+                                   DetermineStationTimingOffsets,
+                                   TimingCalibrationStore)
 from .analysis.coincidence_queries import CoincidenceQuery
 from .analysis.coincidences import Coincidences, CoincidencesESD
 from .analysis.find_mpv import FindMostProbableValueInSpectrum
@@ -113,7 +114,7 @@ __all__ = ['analysis',
            'transformations',
            'utils',
            'determine_detector_timing_offsets',
-           'DetermineStationTimingOffsets',
+           'DetermineStationTimingOffsets', 'TimingCalibrationStore',
            'CoincidenceQuery',
            'Coincidences', 'CoincidencesESD',
            'FindMostProbableValueInSpectrum',
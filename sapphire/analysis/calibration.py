@@ -13,15 +13,49 @@ from itertools import tee, combinations, chain
 from six.moves import zip
 
 from numpy import (arange, histogram, percentile, linspace, std, nan, isnan,
-                   sqrt, abs, sum)
+                   sqrt, abs, sum, searchsorted, sort, zeros, unique,
+                   bincount, column_stack, cumsum, interp, floor, ceil,
+                   argmax, minimum, r_, atleast_2d, ones, full, matmul,
+                   eye, pi, errstate, isfinite, where, exp, stack, inf,
+                   asarray, broadcast_to, take_along_axis, maximum, diff,
+                   argsort, array, concatenate)
+from numpy.linalg import solve, pinv, LinAlgError
 from scipy.optimize import curve_fit
+import tables
 
 from ..clusters import HiSPARCStations, HiSPARCNetwork
-from ..utils import gauss, round_in_base, memoize, get_active_index, pbar, c
+from ..utils import (gauss, round_in_base, memoize, get_active_index, pbar,
+                     use_worker_processes, worker_pool, c)
 from ..api import Station
+from ..storage import DetectorTimeDeltaHistograms, StationTimeDeltaHistograms
 from ..transformations.clock import datetime_to_gps, gps_to_datetime
 
 
+#: Bin edges of the daily histograms of time differences between
+#: detectors.  The differences are multiples of the sample time (2.5 ns),
+#: each bin is centered on one of those values.
+DETECTOR_DT_BINS = arange(-201.25, 201.26, 2.5)
+
+#: Bin edges of the daily histograms of time differences between stations.
+STATION_DT_BINS = arange(-2000., 2000.1, 2.5)
+
+#: Pairs of detectors (i, j) for which histograms of t_i - t_j are stored.
+DETECTOR_PAIRS = list(combinations(range(4), 2))
+
+#: Number of seconds in a day, the histograms are stored per day.
+SECONDS_PER_DAY = 86400
+
+#: Methods to fit the station timing offsets: ``'curve_fit'`` fits each
+#: offset using :func:`scipy.optimize.curve_fit`, ``'vectorized'`` fits
+#: all offsets at once using :func:`fit_timing_offset_histograms`.
+FIT_METHODS = ('curve_fit', 'vectorized')
+
+
+#: Time deltas of a station pair, set in the workers by
+#: :func:`_init_time_deltas_worker`.
+_worker_time_deltas = None
+
+
 def determine_detector_timing_offsets(events, station=None):
     """Determine the timing offsets between station detectors.
 
@@ -62,6 +96,16 @@ def determine_detector_timing_offsets(events, station=None):
         dz = z[id] - z[ref_id]
         offsets[id], _ = determine_detector_timing_offset(dt, dz)
 
+    return _relative_detector_timing_offsets(offsets)
+
+
+def _relative_detector_timing_offsets(offsets):
+    """Make the detector offsets relative to detector 2, if possible
+
+    :param offsets: list of detector offsets.
+    :return: list of detector offsets.
+
+    """
     # If all except reference are nan, make reference nan.
     if sum(isnan(offsets)) == 3:
         offsets = [nan, nan, nan, nan]
@@ -107,7 +151,8 @@ class DetermineStationTimingOffsets(object):
 
     def __init__(self, stations=None, data=None, progress=False,
                  force_stale=False,
-                 time_deltas_group='/coincidences/time_deltas'):
+                 time_deltas_group='/coincidences/time_deltas',
+                 calibration_store=None):
         """Initialize the class
 
         :param stations: list of stations for which to determine offsets.
@@ -115,12 +160,16 @@ class DetermineStationTimingOffsets(object):
         :param progress: if True show progressbar when determining offsets.
         :param force_stale: if true: do not get network information from API.
         :param time_deltas_group: path to the time deltas group.
+        :param calibration_store: a :class:`TimingCalibrationStore`, if
+            given the offsets are determined from its histograms instead
+            of from the timedelta tables.
 
         """
         self.data = data
         self.progress = progress
         self.force_stale = force_stale
         self.time_deltas_group = time_deltas_group
+        self.calibration_store = calibration_store
         if stations is not None:
             self.cluster = HiSPARCStations(stations, skip_missing=True,
                                            force_stale=self.force_stale)
@@ -138,6 +187,25 @@ class DetermineStationTimingOffsets(object):
         return table.read_where('(timestamp >= ts0) & (timestamp < ts1)',
                                 field='delta')
 
+    def read_all_dt(self, station, ref_station):
+        """Read all timedeltas of a station pair from HDF5 file
+
+        The timedeltas between two dates can then be selected in memory,
+        without querying the table again for each date.
+
+        :param station: station number.
+        :param ref_station: reference station number.
+        :return: the timestamps ordered by time, the timedeltas, and the
+                 order of the rows by timestamp.
+
+        """
+        pair = (ref_station, station)
+        table_path = self.time_deltas_group + '/station_%d/station_%d' % pair
+        table = self.data.get_node(table_path, 'time_deltas')
+        timestamps = table.col('timestamp')
+        order = timestamps.argsort(kind='mergesort')
+        return timestamps[order], table.col('delta'), order
+
     @memoize
     def _get_gps_timestamps(self, station):
         """Get timestamps of station gps changes"""
@@ -255,69 +323,171 @@ class DetermineStationTimingOffsets(object):
         """
         return datetime(date.year, date.month, date.day)
 
-    def determine_station_timing_offset(self, date, station, ref_station):
+    def determine_station_timing_offset(self, date, station, ref_station,
+                                        fit='curve_fit'):
         """Determine the timing offset between a station pair at certain date
 
         :param date: date for which to determine offset as datetime.date.
         :param station: station number.
         :param ref_station: reference station number.
+        :param fit: method used to fit the offset, one of
+                    :data:`FIT_METHODS`.
         :return: station offset and error.
 
+        """
+        _check_fit_method(fit)
+        if self.calibration_store is not None:
+            date = self._datetime(date)
+            left, right = self.determine_first_and_last_date(date, station,
+                                                             ref_station)
+            r, dz = self._get_r_dz(date, station, ref_station)
+            return self.calibration_store.determine_station_timing_offset(
+                station, ref_station, left, right, dz, self.MIN_LEN_DT, fit)
+
+        dt, dz = self._read_dt_and_dz(date, station, ref_station)
+        if fit == 'vectorized':
+            offsets, errors = _determine_station_timing_offset_batch(
+                [(dt, dz, self.MIN_LEN_DT)])
+            return offsets[0], errors[0]
+        return _determine_station_timing_offset((dt, dz, self.MIN_LEN_DT))
+
+    def _read_dt_and_dz(self, date, station, ref_station):
+        """Read the timedeltas to use for the offset at certain date
+
+        :param date: date for which to determine offset as datetime.date.
+        :param station: station number.
+        :param ref_station: reference station number.
+        :return: timedeltas and the height difference between the stations.
+
         """
         date = self._datetime(date)
         left, right = self.determine_first_and_last_date(date, station,
                                                          ref_station)
         r, dz = self._get_r_dz(date, station, ref_station)
         dt = self.read_dt(station, ref_station, left, right)
-        if len(dt) < self.MIN_LEN_DT:
-            s_off, error = nan, nan
-        else:
-            s_off, error = determine_station_timing_offset(dt, dz)
-
-        return s_off, error
+        return dt, dz
 
     def determine_station_timing_offsets(self, station, ref_station,
-                                         start=None, end=None):
+                                         start=None, end=None, workers=None,
+                                         fit='curve_fit'):
         """Determine the timing offsets between a station pair
 
+        The timedeltas of the pair are read once, the timedeltas used for
+        each date are then taken from those.  If a calibration store is
+        used the offsets are determined from its histograms.  The results
+        are the same as those of :meth:`determine_station_timing_offset`
+        for each date.
+
         :param station: station number.
         :param ref_station: reference station number.
         :param start: datetime.date object.
         :param end: datetime.date object.
+        :param workers: if given, fit the offsets for the dates in this
+                        number of worker processes.
+        :param fit: method used to fit the offsets, one of
+                    :data:`FIT_METHODS`.  With ``'vectorized'`` the
+                    offsets for all dates are fitted at once, see
+                    :func:`determine_station_timing_offset_batch`.
         :return: list of station offsets as tuple (timestamp, offset, error).
 
         """
+        _check_fit_method(fit)
         if start is None:
             cuts = self._get_cuts(station, ref_station)
             start = self._datetime(cuts[0])
         if end is None:
             end = self._datetime(datetime.now())
 
-        offsets = []
-        length = (end - start).days
+        gps_timestamps = []
+        intervals = []
+        dzs = []
         for date, _ in pbar(datetime_range(start, end), show=self.progress,
-                            length=length):
-            ts0 = datetime_to_gps(date)
-            s_off, error = self.determine_station_timing_offset(date, station,
-                                                                ref_station)
-            offsets.append((ts0, s_off, error))
-        return offsets
+                            length=(end - start).days):
+            gps_timestamps.append(datetime_to_gps(date))
+            date = self._datetime(date)
+            intervals.append(self.determine_first_and_last_date(
+                date, station, ref_station))
+            dzs.append(self._get_r_dz(date, station, ref_station)[1])
+
+        if not intervals:
+            return []
+        if self.calibration_store is not None:
+            results = self.calibration_store.determine_station_timing_offsets(
+                station, ref_station, intervals, dzs, self.MIN_LEN_DT, fit)
+            return list(zip(gps_timestamps, *results))
+
+        timestamps, time_deltas, order = self.read_all_dt(station,
+                                                          ref_station)
+        tasks = []
+        for (left, right), dz in zip(intervals, dzs):
+            first, last = searchsorted(timestamps, [datetime_to_gps(left),
+                                                    datetime_to_gps(right)])
+            tasks.append((first, last, dz, self.MIN_LEN_DT))
+
+        if fit == 'vectorized':
+            if use_worker_processes(workers):
+                with worker_pool(workers, _init_time_deltas_worker,
+                                 (time_deltas, order)) as pool:
+                    results = pool.map(
+                        _determine_station_timing_offsets_in_worker,
+                        _split_tasks(tasks, workers))
+                results = [concatenate(values) for values in zip(*results)]
+            else:
+                results = _determine_station_timing_offsets(
+                    time_deltas, order, tasks)
+        elif use_worker_processes(workers):
+            with worker_pool(workers, _init_time_deltas_worker,
+                             (time_deltas, order)) as pool:
+                results = pool.map(_determine_station_timing_offset_in_worker,
+                                   tasks, chunksize=16)
+            results = zip(*results)
+        else:
+            results = zip(*[
+                _determine_station_timing_offset(
+                    (_time_deltas_between(time_deltas, order, first, last),
+                     dz, min_len_dt))
+                for first, last, dz, min_len_dt in tasks])
 
-    def determine_station_timing_offsets_for_date(self, date):
+        return list(zip(gps_timestamps, *results))
+
+    def determine_station_timing_offsets_for_date(self, date, workers=None,
+                                                  fit='curve_fit'):
         """Determine the timing offsets between a station pair
 
         :param date: date for which to determine offsets as datetime.date.
+        :param workers: if given, fit the offsets for the station pairs in
+                        this number of worker processes.
+        :param fit: method used to fit the offsets, one of
+                    :data:`FIT_METHODS`.
         :return: list of station offsets as tuple
                  (station, ref_station, offset, error).
 
         """
-        station_pairs = self.get_station_pairs_within_max_distance(date)
-        offsets = []
-        for station, ref_station in station_pairs:
-            s_off, error = self.determine_station_timing_offset(date, station,
-                                                                ref_station)
-            offsets.append((station, ref_station, s_off, error))
-        return offsets
+        _check_fit_method(fit)
+        station_pairs = list(self.get_station_pairs_within_max_distance(date))
+        tasks = [self._read_dt_and_dz(date, station, ref_station) +
+                 (self.MIN_LEN_DT,)
+                 for station, ref_station in station_pairs]
+
+        if fit == 'vectorized':
+            if use_worker_processes(workers):
+                with worker_pool(workers) as pool:
+                    results = pool.map(_determine_station_timing_offset_batch,
+                                       _split_tasks(tasks, workers))
+                results = [concatenate(values) for values in zip(*results)]
+            else:
+                results = _determine_station_timing_offset_batch(tasks)
+        elif use_worker_processes(workers):
+            with worker_pool(workers) as pool:
+                results = zip(*pool.map(_determine_station_timing_offset,
+                                        tasks))
+        else:
+            results = zip(*[_determine_station_timing_offset(task)
+                            for task in tasks])
+
+        return [(station, ref_station, s_off, error)
+                for (station, ref_station), s_off, error
+                in zip(station_pairs, *results)]
 
     def get_station_pairs_within_max_distance(self, date=None):
         """Iterator that yields stations pairs that are close to each other"""
@@ -334,6 +504,323 @@ class DetermineStationTimingOffsets(object):
                     yield s2, s1
 
 
+class TimingCalibrationStore(object):
+
+    """Store daily histograms of time differences for timing calibration
+
+    Determining the detector and station timing offsets from the event
+    and time delta tables requires reading all data in the interval for
+    every fit.  Instead, this class keeps daily histograms of the time
+    differences between detectors and between stations in the HDF5 file.
+    New data only needs to be added once, after which the offsets for any
+    interval are fitted using the summed histograms.
+
+    Because the histograms use fixed bins, the station offsets can differ
+    slightly from those fitted to the time deltas directly.
+
+    Example usage::
+
+        >>> store = TimingCalibrationStore(data)
+        >>> store.update_detector_histograms(501, data.root.s501.events)
+        >>> store.determine_detector_timing_offsets(501, start, end)
+
+    """
+
+    def __init__(self, data, group='/calibration'):
+        """Initialize the class
+
+        :param data: the PyTables datafile in which to store the histograms.
+        :param group: path to the group which contains the histograms.
+
+        """
+        self.data = data
+        self.group = group
+
+    def update_detector_histograms(self, station_number, events,
+                                   chunk_size=1000000):
+        """Add the new events of a station to the daily histograms
+
+        Only the rows which were added to the events table since the
+        previous update are read, the number of processed rows is kept in
+        the histograms table.
+
+        :param station_number: station number.
+        :param events: events table of processed events.
+        :param chunk_size: maximum number of events to read at once.
+
+        """
+        table = self._get_table(
+            'detectors/station_%d' % station_number,
+            DetectorTimeDeltaHistograms)
+        for start in range(table.attrs.processed_rows, events.nrows,
+                           chunk_size):
+            stop = min(start + chunk_size, events.nrows)
+            rows = events.read(start, stop)
+            days, day_idx = unique(rows['timestamp'] -
+                                   rows['timestamp'] % SECONDS_PER_DAY,
+                                   return_inverse=True)
+            t = column_stack([rows['t%d' % i] for i in range(1, 5)])
+            n = column_stack([rows['n%d' % i] for i in range(1, 5)])
+            filters = (n > 0.3) & (t >= 0.)
+
+            stats = {'counts': zeros((len(days), 6, len(DETECTOR_DT_BINS) - 1),
+                                     dtype='uint32'),
+                     'n': zeros((len(days), 6), dtype='uint64'),
+                     'sum': zeros((len(days), 6)),
+                     'sum_of_squares': zeros((len(days), 6)),
+                     'reference': zeros((len(days), 4), dtype='uint64')}
+            for pair, (i, j) in enumerate(DETECTOR_PAIRS):
+                in_pair = filters[:, i] & filters[:, j]
+                pair_stats = _daily_histograms(
+                    day_idx[in_pair], len(days), t[in_pair, i] - t[in_pair, j],
+                    DETECTOR_DT_BINS)
+                for name, values in zip(('counts', 'n', 'sum',
+                                         'sum_of_squares'), pair_stats):
+                    stats[name][:, pair] = values
+            # Events in which a detector and any other detector have data,
+            # used to determine the best reference detector.
+            n_filters = filters.sum(axis=1)
+            for id in range(4):
+                with_others = filters[:, id] & (n_filters > 1)
+                stats['reference'][:, id] = bincount(day_idx[with_others],
+                                                     minlength=len(days))
+            self._add_to_days(table, days, stats)
+            table.attrs.processed_rows = stop
+        table.flush()
+
+    def update_station_histograms(self, station, ref_station, time_deltas,
+                                  chunk_size=1000000):
+        """Add the new time deltas of a station pair to the daily histograms
+
+        Only the rows which were added to the time deltas table since the
+        previous update are read, the number of processed rows is kept in
+        the histograms table.
+
+        :param station: station number.
+        :param ref_station: reference station number.
+        :param time_deltas: time deltas table of the pair, as created by
+            :class:`~sapphire.analysis.time_deltas.ProcessTimeDeltas`.
+        :param chunk_size: maximum number of time deltas to read at once.
+
+        """
+        table = self._get_table(
+            'stations/station_%d/station_%d' % (ref_station, station),
+            StationTimeDeltaHistograms)
+        for start in range(table.attrs.processed_rows, time_deltas.nrows,
+                           chunk_size):
+            stop = min(start + chunk_size, time_deltas.nrows)
+            rows = time_deltas.read(start, stop)
+            days, day_idx = unique(rows['timestamp'] -
+                                   rows['timestamp'] % SECONDS_PER_DAY,
+                                   return_inverse=True)
+            stats = dict(zip(('counts', 'n', 'sum', 'sum_of_squares'),
+                             _daily_histograms(day_idx, len(days),
+                                               rows['delta'],
+                                               STATION_DT_BINS)))
+            self._add_to_days(table, days, stats)
+            table.attrs.processed_rows = stop
+        table.flush()
+
+    def determine_detector_timing_offsets(self, station_number, start, end,
+                                          station=None):
+        """Determine the timing offsets between station detectors
+
+        Like :func:`determine_detector_timing_offsets`, but using the
+        stored histograms of the days from start up to end.  The
+        histograms of all detectors are fitted at once.
+
+        :param station_number: station number.
+        :param start,end: datetime objects, the end date is excluded.
+        :param station: :class:`sapphire.clusters.Station` object, to
+            determine number of detectors and relative altitudes.
+        :return: list of detector offsets.
+
+        """
+        offsets = [nan, nan, nan, nan]
+        rows = self._read_days('detectors/station_%d' % station_number,
+                               start, end)
+        if not len(rows):
+            return offsets
+        counts = rows['counts'].sum(axis=0)
+
+        if station is not None:
+            n_detectors = len(station.detectors)
+            station.cluster.set_timestamp(rows['timestamp'].min())
+            z = [d.get_coordinates()[2] for d in station.detectors]
+        else:
+            n_detectors = 4
+            z = [0., 0., 0., 0.]
+
+        if n_detectors == 2:
+            ref_id = 1
+        else:
+            ref_id = int(argmax(rows['reference'].sum(axis=0)))
+
+        ids = [id for id in range(n_detectors) if id != ref_id]
+        histograms = []
+        for id in ids:
+            if id < ref_id:
+                histograms.append(counts[DETECTOR_PAIRS.index((id, ref_id))])
+            else:
+                # Stored as t_ref - t, reverse the (symmetric) histogram
+                histograms.append(
+                    counts[DETECTOR_PAIRS.index((ref_id, id))][::-1])
+        dz = [z[id] - z[ref_id] for id in ids]
+        detector_offsets, _ = determine_detector_timing_offset_histograms(
+            histograms, dz)
+        offsets[ref_id] = 0.
+        for id, offset in zip(ids, detector_offsets):
+            offsets[id] = offset
+
+        return _relative_detector_timing_offsets(offsets)
+
+    def determine_station_timing_offset(self, station, ref_station, start,
+                                        end, dz=0, min_n=0, fit='curve_fit'):
+        """Determine the timing offset between a station pair
+
+        Like :func:`determine_station_timing_offset`, but using the stored
+        histograms of the days from start up to end.
+
+        :param station: station number.
+        :param ref_station: reference station number.
+        :param start,end: datetime objects, the end date is excluded.
+        :param dz: height difference between the stations (z - z_ref).
+        :param min_n: minimum number of time deltas required for a fit.
+        :param fit: method used to fit the offset, one of
+                    :data:`FIT_METHODS`.
+        :return: station offset and error.
+
+        """
+        offsets, errors = self.determine_station_timing_offsets(
+            station, ref_station, [(start, end)], dz, min_n, fit)
+        return offsets[0], errors[0]
+
+    def determine_station_timing_offsets(self, station, ref_station,
+                                         intervals, dz=0, min_n=0,
+                                         fit='curve_fit'):
+        """Determine the timing offsets between a station pair
+
+        Like :meth:`determine_station_timing_offset`, for many intervals.
+        The stored histograms are read once.  With the ``'vectorized'``
+        fit the summed histograms of all intervals are fitted at once
+        using :func:`determine_station_timing_offset_histograms`.
+
+        :param station: station number.
+        :param ref_station: reference station number.
+        :param intervals: list of (start, end) datetime objects, the end
+                          dates are excluded.
+        :param dz: height difference between the stations (z - z_ref), for
+                   each interval.
+        :param min_n: minimum number of time deltas required for a fit.
+        :param fit: method used to fit the offsets, one of
+                    :data:`FIT_METHODS`.
+        :return: arrays of station offsets and errors.
+
+        """
+        _check_fit_method(fit)
+        starts = array([datetime_to_gps(start) for start, _ in intervals])
+        ends = array([datetime_to_gps(end) for _, end in intervals])
+        rows = self._read_days(
+            'stations/station_%d/station_%d' % (ref_station, station),
+            gps_to_datetime(starts.min()), gps_to_datetime(ends.max()))
+        order = argsort(rows['timestamp'], kind='mergesort')
+        first = searchsorted(rows['timestamp'][order], starts)
+        last = searchsorted(rows['timestamp'][order], ends)
+        dz = zeros(len(intervals)) + dz
+
+        if fit == 'curve_fit':
+            offsets = []
+            errors = []
+            for i, j, dz_i in zip(first, last, dz):
+                # The days of the interval in the order of the table
+                days = rows[sort(order[i:j])]
+                n = days['n'].sum()
+                if not n or n < min_n:
+                    offsets.append(nan)
+                    errors.append(nan)
+                    continue
+                offset, error = determine_station_timing_offset_histogram(
+                    days['counts'].sum(axis=0), n, days['sum'].sum(),
+                    days['sum_of_squares'].sum(), dz_i)
+                offsets.append(offset)
+                errors.append(error)
+            return array(offsets, dtype=float), array(errors, dtype=float)
+
+        # Sums over the days in each interval from cumulative sums
+        rows = rows[order]
+        counts = cumsum(r_[zeros((1, len(STATION_DT_BINS) - 1), dtype=int),
+                           rows['counts']], axis=0)
+        n = cumsum(r_[0, rows['n'].astype(int)])
+        counts = counts[last] - counts[first]
+        n = n[last] - n[first]
+
+        offsets, errors = determine_station_timing_offset_histograms(
+            counts, n, dz)
+        too_few = (n == 0) | (n < min_n)
+        offsets[too_few] = nan
+        errors[too_few] = nan
+        return offsets, errors
+
+    def _get_table(self, path, description):
+        """Get a histograms table, create it if it does not exist
+
+        :param path: path of the table, relative to the store group.
+        :param description: description of the table.
+        :return: the table.
+
+        """
+        where, name = (self.group + '/' + path).rsplit('/', 1)
+        try:
+            table = self.data.get_node(where, name)
+        except tables.NoSuchNodeError:
+            table = self.data.create_table(
+                where, name, description, createparents=True,
+                filters=tables.Filters(complevel=5, complib='blosc'))
+            table.attrs.processed_rows = 0
+        return table
+
+    def _add_to_days(self, table, days, stats):
+        """Add daily statistics to the stored statistics of those days
+
+        :param table: histograms table.
+        :param days: timestamps of the start of the days.
+        :param stats: dictionary with the statistics of each day, for each
+                      column of the table.
+
+        """
+        stored_days = {day: idx
+                       for idx, day in enumerate(table.col('timestamp'))}
+        new_rows = []
+        for i, day in enumerate(days):
+            if day in stored_days:
+                idx = stored_days[day]
+                row = table.read(idx, idx + 1)
+                for name, values in stats.items():
+                    row[name][0] += values[i]
+                table.modify_rows(idx, idx + 1, rows=row)
+            else:
+                new_rows.append(i)
+        if new_rows:
+            rows = zeros(len(new_rows), dtype=table.dtype)
+            rows['timestamp'] = days[new_rows]
+            for name, values in stats.items():
+                rows[name] = values[new_rows]
+            table.append(rows)
+
+    def _read_days(self, path, start, end):
+        """Read the stored statistics of the days from start up to end
+
+        :param path: path of the table, relative to the store group.
+        :param start,end: datetime objects, the end date is excluded.
+        :return: the rows of the days.
+
+        """
+        table = self.data.get_node(self.group + '/' + path)
+        ts0 = datetime_to_gps(start)  # noqa
+        ts1 = datetime_to_gps(end)  # noqa
+        return table.read_where('(timestamp >= ts0) & (timestamp < ts1)')
+
+
 def determine_station_timing_offset(dt, dz=0):
     """Determine the timing offset between stations.
 
@@ -356,6 +843,174 @@ def determine_station_timing_offset(dt, dz=0):
     return station_offset, station_offset_error
 
 
+def determine_station_timing_offset_batch(dts, dz=0):
+    """Determine the timing offsets between stations for many intervals
+
+    Vectorized version of :func:`determine_station_timing_offset`.  The
+    time differences of each interval are histogrammed with the same bins,
+    the histograms are then fitted at once using
+    :func:`fit_timing_offset_histograms`.
+
+    :param dts: iterable of arrays of time differences between stations
+                (t - t_ref), one for each interval.  Only the histograms
+                are kept, so this may be a generator.
+    :param dz: height difference between the stations (z - z_ref), for
+               each interval.
+    :return: arrays with the mean of a gaussian fit to the data of each
+             interval corrected for height, and the error of the mean.
+
+    """
+    # At most 200 bin edges, the unused bins continue the bin edges
+    bins = []
+    counts = []
+    n_edges = []
+    for dt in dts:
+        row_bins = zeros(200)
+        row_counts = zeros(199)
+        n = 0
+        if len(dt):
+            p = percentile(dt, [0.5, 99.5])
+            n = min(int(p[1] - p[0]), len(dt) // 4, 200)
+        # Enough bins to fit the three parameters of the gaussian
+        if n >= 4:
+            edges = linspace(p[0], p[1], n)
+            row_counts[:n - 1] = histogram(dt, bins=edges)[0]
+            row_bins[:] = edges[0] + (edges[1] - edges[0]) * arange(200)
+            row_bins[:n] = edges
+        bins.append(row_bins)
+        counts.append(row_counts)
+        n_edges.append(n)
+    n_edges = array(n_edges, dtype=int)
+    n_bins = max(n_edges.max(initial=0), 4) - 1
+    bins = array(bins).reshape(-1, 200)[:, :n_bins + 1]
+    counts = array(counts).reshape(-1, 199)[:, :n_bins]
+    mask = (n_edges[:, None] >= 4) & (arange(n_bins) < n_edges[:, None] - 1)
+
+    station_offsets, station_offset_errors = fit_timing_offset_histograms(
+        counts, bins, mask)
+    dz = zeros(len(counts)) + dz
+    station_offsets += dz / c
+    outside = ~(abs(station_offsets) <= 1000)
+    station_offsets[outside] = nan
+    station_offset_errors[outside] = nan
+    return station_offsets, station_offset_errors
+
+
+def _determine_station_timing_offset(task):
+    """Determine the station timing offset, if there are enough timedeltas
+
+    :param task: tuple of the timedeltas, the height difference and the
+                 minimum number of timedeltas required to attempt a fit.
+    :return: station offset and error.
+
+    """
+    dt, dz, min_len_dt = task
+    if len(dt) < min_len_dt:
+        return nan, nan
+    return determine_station_timing_offset(dt, dz)
+
+
+def _init_time_deltas_worker(time_deltas, order):
+    """Keep the timedeltas of a station pair in a worker process"""
+
+    global _worker_time_deltas
+    _worker_time_deltas = (time_deltas, order)
+
+
+def _check_fit_method(fit):
+    """Check that the method to fit the offsets is one of FIT_METHODS"""
+
+    if fit not in FIT_METHODS:
+        raise ValueError('Unknown fit method %r, use one of %s.' %
+                         (fit, ', '.join(FIT_METHODS)))
+
+
+def _split_tasks(tasks, workers):
+    """Split tasks in several parts per worker to spread the load"""
+
+    size = max(-(-len(tasks) // (4 * workers)), 1)
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+
+def _determine_station_timing_offset_batch(tasks):
+    """Determine station timing offsets, if there are enough timedeltas
+
+    Vectorized version of :func:`_determine_station_timing_offset`.
+
+    :param tasks: list of tuples of the timedeltas, the height difference
+                  and the minimum number of timedeltas required to
+                  attempt a fit.
+    :return: arrays of station offsets and errors.
+
+    """
+    dts = (dt if len(dt) >= min_len_dt else dt[:0]
+           for dt, _, min_len_dt in tasks)
+    return determine_station_timing_offset_batch(
+        dts, [dz for _, dz, _ in tasks])
+
+
+def _determine_station_timing_offsets(time_deltas, order, tasks):
+    """Determine the station timing offsets for many dates at once
+
+    :param time_deltas: all timedeltas of a station pair.
+    :param order: order of the timedeltas by timestamp.
+    :param tasks: list of tuples of the first and last (excluded) position
+                  in the timedeltas ordered by timestamp, the height
+                  difference and the minimum number of timedeltas to
+                  attempt a fit.
+    :return: arrays of station offsets and errors.
+
+    """
+    dts = (_time_deltas_between(time_deltas, order, first, last)
+           if last - first >= min_len_dt else time_deltas[:0]
+           for first, last, _, min_len_dt in tasks)
+    return determine_station_timing_offset_batch(
+        dts, [dz for _, _, dz, _ in tasks])
+
+
+def _determine_station_timing_offset_in_worker(task):
+    """Determine the station timing offset in a worker process
+
+    :param task: tuple of the first and last (excluded) position in the
+                 timedeltas ordered by timestamp, the height difference
+                 and the minimum number of timedeltas to attempt a fit.
+    :return: station offset and error.
+
+    """
+    first, last, dz, min_len_dt = task
+    time_deltas, order = _worker_time_deltas
+    dt = _time_deltas_between(time_deltas, order, first, last)
+    return _determine_station_timing_offset((dt, dz, min_len_dt))
+
+
+def _determine_station_timing_offsets_in_worker(tasks):
+    """Determine the station timing offsets in a worker process
+
+    :param tasks: list of tasks, see
+                  :func:`_determine_station_timing_offsets`.
+    :return: arrays of station offsets and errors.
+
+    """
+    time_deltas, order = _worker_time_deltas
+    return _determine_station_timing_offsets(time_deltas, order, tasks)
+
+
+def _time_deltas_between(time_deltas, order, first, last):
+    """Get timedeltas from a range of timestamps
+
+    The timedeltas are returned in the order of the table, as they would
+    be returned by a query on the table.
+
+    :param time_deltas: all timedeltas of a station pair.
+    :param order: order of the timedeltas by timestamp.
+    :param first,last: first and last (excluded) position in the
+                       timedeltas ordered by timestamp.
+    :return: the timedeltas.
+
+    """
+    return time_deltas[sort(order[first:last])]
+
+
 def fit_timing_offset(dt, bins):
     """Fit the time difference distribution.
 
@@ -365,10 +1020,24 @@ def fit_timing_offset(dt, bins):
 
     """
     y, bins = histogram(dt, bins=bins)
+    return fit_timing_offset_histogram(y, bins, len(dt), std(dt))
+
+
+def fit_timing_offset_histogram(y, bins, n, dt_std):
+    """Fit a histogram of the time difference distribution.
+
+    :param y: counts in each bin of the histogram.
+    :param bins: bins edges of the histogram.
+    :param n: total number of time differences, used as initial guess.
+    :param dt_std: standard deviation of the time differences, used as
+                   initial guess.
+    :return: mean of a gaussian fit to the data and the error of the mean.
+
+    """
     x = (bins[:-1] + bins[1:]) / 2
     sigma = sqrt(y + 1)
     try:
-        popt, pcov = curve_fit(gauss, x, y, p0=(len(dt), 0., std(dt)),
+        popt, pcov = curve_fit(gauss, x, y, p0=(n, 0., dt_std),
                                sigma=sigma, absolute_sigma=False)
         offset = popt[1]
         width = popt[2]
@@ -378,6 +1047,397 @@ def fit_timing_offset(dt, bins):
     return offset, offset_error
 
 
+def fit_timing_offset_histograms(y, bins, mask=None, max_iterations=100):
+    """Fit many histograms of time difference distributions at once
+
+    Vectorized alternative to :func:`fit_timing_offset_histogram`, which
+    remains the reference implementation.  The same weighted least squares
+    problem is solved for all histograms simultaneously, using the
+    Levenberg-Marquardt algorithm.
+
+    The problem can have several minima, for instance a narrow peak and a
+    wide distribution which includes the background.  Therefore each
+    histogram is fitted starting from two closed-form estimates, one from
+    the mean and standard deviation of the histogram and one from its
+    peak, and the best fit is kept.
+
+    :param y: counts of each histogram, array of shape (n_fits, n_bins).
+    :param bins: equally spaced bins edges, shared by all histograms or
+                 an array of shape (n_fits, n_bins + 1) with the edges
+                 for each histogram.
+    :param mask: boolean array with the shape of y, only the bins which
+                 are True are used in the fit of a histogram.  By default
+                 all bins are used.
+    :param max_iterations: maximum number of iterations of each fit.
+    :return: arrays with the mean of a gaussian fit to each histogram and
+             the error of the mean, nan if a fit failed.
+
+    """
+    y = atleast_2d(y).astype(float)
+    bins = asarray(bins, dtype=float)
+    x = broadcast_to((bins[..., :-1] + bins[..., 1:]) / 2, y.shape)
+    bin_width = bins[..., 1] - bins[..., 0]
+    if mask is None:
+        mask = ones(y.shape, dtype=bool)
+    counts = where(mask, y, 0.)
+    n_counts = counts.sum(axis=1)
+    # Same requirements as curve_fit: at least as many bins as parameters
+    valid = (mask.sum(axis=1) >= 3) & (n_counts > 0)
+    weights = where(valid[:, None] & mask, 1. / (y + 1), 0.)
+
+    parameters = None
+    for initial in (_moments_gauss_parameters(x, counts),
+                    _peak_gauss_parameters(x, counts, bin_width)):
+        fit, chi2 = _fit_gauss(x, y, weights, initial, valid, max_iterations)
+        if parameters is None:
+            parameters, best_chi2 = fit, chi2
+        else:
+            better = chi2 < best_chi2
+            parameters[better] = fit[better]
+            best_chi2[better] = chi2[better]
+
+    offset = parameters[:, 1]
+    with errstate(invalid='ignore', divide='ignore'):
+        offset_error = parameters[:, 2] / sqrt(n_counts)
+    failed = ~valid | ~isfinite(best_chi2)
+    offset[failed] = nan
+    offset_error[failed] = nan
+    return offset, offset_error
+
+
+def _moments_gauss_parameters(x, counts):
+    """Estimate gaussian parameters from the moments of histograms
+
+    :param x: bin centers of each histogram.
+    :param counts: counts of each histogram, zero for unused bins.
+    :return: array with the amplitude, mean and width for each histogram.
+
+    """
+    total = counts.sum(axis=1)
+    with errstate(invalid='ignore', divide='ignore'):
+        mu = (counts * x).sum(axis=1) / total
+        sigma = sqrt((counts * (x - mu[:, None]) ** 2).sum(axis=1) / total)
+        amplitude = total / (sqrt(2 * pi) * sigma)
+    return column_stack([amplitude, mu, sigma])
+
+
+def _peak_gauss_parameters(x, counts, bin_width):
+    """Estimate gaussian parameters from the peak of histograms
+
+    The width follows from the number of bins above half the maximum.
+
+    :param x: bin centers of each histogram.
+    :param counts: counts of each histogram, zero for unused bins.
+    :param bin_width: width of the bins, for each histogram.
+    :return: array with the amplitude, mean and width for each histogram.
+
+    """
+    peak = counts.max(axis=1)
+    mu = take_along_axis(x, argmax(counts, axis=1)[:, None], axis=1)[:, 0]
+    fwhm = (counts > peak[:, None] / 2).sum(axis=1) * bin_width
+    return column_stack([peak, mu, fwhm / 2.355])
+
+
+def _fit_gauss(x, y, weights, parameters, valid, max_iterations):
+    """Fit gaussians to histograms using the Levenberg-Marquardt algorithm
+
+    Only steps to a positive amplitude and width are accepted.
+
+    :param x: bin centers of each histogram.
+    :param y: counts of each histogram.
+    :param weights: weight of each bin in the fit, 1 / sigma ** 2.
+    :param parameters: initial amplitude, mean and width for each
+                       histogram.
+    :param valid: histograms which can be fitted.
+    :param max_iterations: maximum number of iterations.
+    :return: fitted parameters and the weighted sum of squared residuals,
+             which is inf if a fit failed.
+
+    """
+    parameters = parameters.copy()
+    chi2 = _gauss_chi2(x, y, weights, parameters)
+    chi2[~valid | (parameters[:, 0] <= 0) | ~(parameters[:, 2] > 0)] = inf
+    damping = full(len(y), 1e-3)
+    active = isfinite(chi2)
+    for _ in range(max_iterations):
+        idx = active.nonzero()[0]
+        if not len(idx):
+            break
+        p = parameters[idx]
+        w = weights[idx]
+        residuals, jacobian = _gauss_jacobian(x[idx], y[idx], p)
+        weighted = jacobian * w[:, :, None]
+        jtj = matmul(weighted.transpose(0, 2, 1), jacobian)
+        jtr = matmul(weighted.transpose(0, 2, 1), residuals[:, :, None])
+        diagonal = jtj.diagonal(axis1=1, axis2=2)
+        damped = jtj + eye(3) * (damping[idx, None] * diagonal)[:, None, :]
+        with errstate(invalid='ignore', divide='ignore', over='ignore'):
+            try:
+                step = solve(damped, jtr)
+            except LinAlgError:
+                step = matmul(pinv(damped), jtr)
+            new_p = p + step[:, :, 0]
+            new_chi2 = _gauss_chi2(x[idx], y[idx], w, new_p)
+        improved = ((new_chi2 < chi2[idx]) & (new_p[:, 0] > 0) &
+                    (new_p[:, 2] > 0))
+        converged = ((improved & (chi2[idx] - new_chi2 <= 1e-12 * chi2[idx])) |
+                     (damping[idx] > 1e10))
+        parameters[idx[improved]] = new_p[improved]
+        chi2[idx[improved]] = new_chi2[improved]
+        damping[idx] = where(improved, damping[idx] / 10, damping[idx] * 10)
+        active[idx[converged]] = False
+    return parameters, chi2
+
+
+def _gauss_jacobian(x, y, parameters):
+    """Residuals and jacobian of gaussians with respect to their parameters
+
+    :param x: bin centers of each histogram.
+    :param y: counts of each histogram.
+    :param parameters: amplitude, mean and width for each histogram.
+    :return: residuals (y - f) and the jacobian of f.
+
+    """
+    amplitude, mu, sigma = (parameters[:, i, None] for i in range(3))
+    z = (x - mu) / sigma
+    g = exp(-z ** 2 / 2)
+    f = amplitude * g
+    jacobian = stack([g, f * z / sigma, f * z ** 2 / sigma], axis=-1)
+    return y - f, jacobian
+
+
+def _gauss_chi2(x, y, weights, parameters):
+    """Weighted sum of squared residuals of gaussians"""
+
+    amplitude, mu, sigma = (parameters[:, i, None] for i in range(3))
+    with errstate(invalid='ignore', divide='ignore', over='ignore'):
+        f = amplitude * exp(-((x - mu) / sigma) ** 2 / 2)
+        chi2 = (weights * (y - f) ** 2).sum(axis=1)
+    return where(isfinite(chi2), chi2, inf)
+
+
+def determine_detector_timing_offset_histogram(y, n, dt_sum,
+                                               dt_sum_of_squares, dz=0):
+    """Determine the timing offset between detectors from a histogram
+
+    Like :func:`determine_detector_timing_offset`, but using a histogram
+    of the time differences with the bins of :data:`DETECTOR_DT_BINS`.
+
+    :param y: counts in each bin of the histogram.
+    :param n: total number of time differences.
+    :param dt_sum,dt_sum_of_squares: sum and sum of squares of all time
+                                     differences.
+    :param dz: height difference between the detectors (z - z_ref).
+    :return: mean of a gaussian fit to the data corrected for height, and
+             the error of the mean.
+
+    """
+    x = (DETECTOR_DT_BINS[:-1] + DETECTOR_DT_BINS[1:]) / 2
+    dt_filter = abs(x + dz / c) < 100
+    if not sum(y[dt_filter]):
+        return nan, nan
+    p = round_in_base(_histogram_percentiles(x[dt_filter], y[dt_filter],
+                                             [0.5, 99.5]), 2.5)
+    # Same bins as determine_detector_timing_offset, one for each value
+    # between the percentiles.
+    in_range = (x > p[0]) & (x < p[1])
+    if not sum(in_range):
+        return nan, nan
+    bins = r_[x[in_range] - 1.25, x[in_range][-1] + 1.25]
+    detector_offset, detector_offset_error = fit_timing_offset_histogram(
+        y[in_range], bins, n, _std(n, dt_sum, dt_sum_of_squares))
+    detector_offset += dz / c
+    if abs(detector_offset) > 100:
+        return nan, nan
+    return detector_offset, detector_offset_error
+
+
+def determine_detector_timing_offset_histograms(y, dz=0):
+    """Determine the timing offsets between detectors from many histograms
+
+    Vectorized version of :func:`determine_detector_timing_offset_histogram`,
+    all histograms are fitted at once using
+    :func:`fit_timing_offset_histograms`.  Useful to determine the offsets
+    for many stations and intervals with a single call.
+
+    :param y: counts of each histogram, array of shape (n_fits, n_bins)
+              with the bins of :data:`DETECTOR_DT_BINS`.
+    :param dz: height difference between the detectors (z - z_ref), for
+               each histogram.
+    :return: arrays with the mean of a gaussian fit to each histogram
+             corrected for height, and the error of the mean.
+
+    """
+    x = (DETECTOR_DT_BINS[:-1] + DETECTOR_DT_BINS[1:]) / 2
+    y = atleast_2d(y)
+    dz = zeros(len(y)) + dz
+    dt_filter = abs(x + dz[:, None] / c) < 100
+    with errstate(invalid='ignore'):
+        p = round_in_base(_histogram_percentiles(x, where(dt_filter, y, 0),
+                                                 [0.5, 99.5]), 2.5)
+    # Same bins as determine_detector_timing_offset_histogram
+    in_range = ((x > p[:, :1]) & (x < p[:, 1:]) &
+                (dt_filter & (y > 0)).any(axis=1)[:, None])
+    detector_offsets, detector_offset_errors = fit_timing_offset_histograms(
+        y, DETECTOR_DT_BINS, in_range)
+    detector_offsets += dz / c
+    outside = ~(abs(detector_offsets) <= 100)
+    detector_offsets[outside] = nan
+    detector_offset_errors[outside] = nan
+    return detector_offsets, detector_offset_errors
+
+
+def determine_station_timing_offset_histogram(y, n, dt_sum,
+                                              dt_sum_of_squares, dz=0):
+    """Determine the timing offset between stations from a histogram
+
+    Like :func:`determine_station_timing_offset`, but using a histogram
+    of the time differences with the bins of :data:`STATION_DT_BINS`.
+    The bins are combined to get about the same number of bins as used
+    for the time differences themselves.
+
+    :param y: counts in each bin of the histogram.
+    :param n: total number of time differences.
+    :param dt_sum,dt_sum_of_squares: sum and sum of squares of all time
+                                     differences.
+    :param dz: height difference between the stations (z - z_ref).
+    :return: mean of a gaussian fit to the data corrected for height, and
+             the error of the mean.
+
+    """
+    if not sum(y):
+        return nan, nan
+    cumulative = r_[0, cumsum(y)]
+    p = interp([0.005 * cumulative[-1], 0.995 * cumulative[-1]], cumulative,
+               STATION_DT_BINS)
+    # Bins first up to last overlap the range between the percentiles
+    first = max(searchsorted(STATION_DT_BINS, p[0], side='right') - 1, 0)
+    last = min(searchsorted(STATION_DT_BINS, p[1], side='left'), len(y))
+    n_bins = min(int(p[1] - p[0]), n // 4, 200) - 1
+    if n_bins < 1 or last <= first:
+        return nan, nan
+    step = int(ceil((last - first) / n_bins))
+    last = first + (last - first) // step * step
+    bins = STATION_DT_BINS[first:last + 1:step]
+    counts = y[first:last].reshape(-1, step).sum(axis=1)
+    station_offset, station_offset_error = fit_timing_offset_histogram(
+        counts, bins, n, _std(n, dt_sum, dt_sum_of_squares))
+    station_offset += dz / c
+    if abs(station_offset) > 1000:
+        return nan, nan
+    return station_offset, station_offset_error
+
+
+def determine_station_timing_offset_histograms(y, n, dz=0):
+    """Determine the timing offsets between stations from many histograms
+
+    Vectorized version of :func:`determine_station_timing_offset_histogram`,
+    the histograms are rebinned in the same way and then all fitted at
+    once using :func:`fit_timing_offset_histograms`.
+
+    :param y: counts of each histogram, array of shape (n_fits, n_bins)
+              with the bins of :data:`STATION_DT_BINS`.
+    :param n: total number of time differences, for each histogram.
+    :param dz: height difference between the stations (z - z_ref), for
+               each histogram.
+    :return: arrays with the mean of a gaussian fit to each histogram
+             corrected for height, and the error of the mean.
+
+    """
+    y = atleast_2d(y)
+    n = zeros(len(y), dtype=int) + n
+    dz = zeros(len(y)) + dz
+    n_stored_bins = len(STATION_DT_BINS) - 1
+    cumulative = column_stack([zeros(len(y)), cumsum(y, axis=1)])
+    total = cumulative[:, -1]
+    p = array([interp([0.005 * t, 0.995 * t], row, STATION_DT_BINS)
+               for t, row in zip(total, cumulative)]).reshape(-1, 2)
+    # Bins first up to last overlap the range between the percentiles
+    first = maximum(searchsorted(STATION_DT_BINS, p[:, 0], side='right') - 1,
+                    0)
+    last = minimum(searchsorted(STATION_DT_BINS, p[:, 1], side='left'),
+                   n_stored_bins)
+    n_bins = minimum(minimum((p[:, 1] - p[:, 0]).astype(int), n // 4),
+                     200) - 1
+    valid = (total > 0) & (n_bins >= 1) & (last > first)
+
+    # Combine step stored bins into one bin, as many as fit in the range
+    step = ones(len(y), dtype=int)
+    step[valid] = ceil((last[valid] - first[valid]) / n_bins[valid])
+    n_bins = where(valid, (last - first) // step, 0)
+    columns = arange(max(n_bins.max(initial=0), 3) + 1)
+    idx = first[:, None] + step[:, None] * columns
+    bins = STATION_DT_BINS[0] + 2.5 * idx
+    counts = diff(take_along_axis(cumulative, minimum(idx, n_stored_bins),
+                                  axis=1), axis=1)
+    mask = columns[:-1] < n_bins[:, None]
+
+    station_offsets, station_offset_errors = fit_timing_offset_histograms(
+        counts, bins, mask)
+    station_offsets += dz / c
+    outside = ~(abs(station_offsets) <= 1000)
+    station_offsets[outside] = nan
+    station_offset_errors[outside] = nan
+    return station_offsets, station_offset_errors
+
+
+def _daily_histograms(day_idx, n_days, dt, bins):
+    """Determine histograms and statistics of time differences per day
+
+    :param day_idx: index of the day for each time difference.
+    :param n_days: number of days.
+    :param dt: time differences.
+    :param bins: bin edges of the histograms.
+    :return: counts in each bin, number, sum and sum of squares of the
+             time differences, for each day.
+
+    """
+    dt = dt.astype(float)
+    n_bins = len(bins) - 1
+    bin_idx = searchsorted(bins, dt, side='right') - 1
+    # Like numpy.histogram, the last bin includes its right edge
+    bin_idx[dt == bins[-1]] = n_bins - 1
+    in_bins = (bin_idx >= 0) & (bin_idx < n_bins)
+    counts = bincount(day_idx[in_bins] * n_bins + bin_idx[in_bins],
+                      minlength=n_days * n_bins).reshape(n_days, n_bins)
+    n = bincount(day_idx, minlength=n_days)
+    dt_sum = bincount(day_idx, weights=dt, minlength=n_days)
+    dt_sum_of_squares = bincount(day_idx, weights=dt ** 2, minlength=n_days)
+    return counts, n, dt_sum, dt_sum_of_squares
+
+
+def _histogram_percentiles(x, y, q):
+    """Get percentiles of values given by a histogram of those values
+
+    The same as :func:`numpy.percentile` with linear interpolation, for
+    the values x which each occur y times.
+
+    :param x: sorted values.
+    :param y: number of occurrences of each value, the last axis
+              corresponds to the values, to get the percentiles of
+              several histograms at once.
+    :param q: percentiles to get.
+    :return: the percentiles, for each histogram.
+
+    """
+    cumulative = cumsum(y, axis=-1)
+    total = cumulative[..., -1:]
+    positions = (total - 1) * r_[q] / 100.
+    lower = floor(positions)
+    upper = minimum(lower + 1, total - 1)
+    # Index of the first value which occurs after the position
+    lower_values = x[(cumulative[..., None, :] <= lower[..., None]).sum(-1)]
+    upper_values = x[(cumulative[..., None, :] <= upper[..., None]).sum(-1)]
+    return lower_values + (positions - lower) * (upper_values - lower_values)
+
+
+def _std(n, dt_sum, dt_sum_of_squares):
+    """Standard deviation from the number, sum and sum of squares"""
+
+    mean = dt_sum / n
+    return sqrt(max(dt_sum_of_squares / n - mean ** 2, 0.))
+
+
 def determine_best_reference(filters):
     """Find which detector has most events in common with the others
 
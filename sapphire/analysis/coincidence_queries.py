@@ -3,10 +3,19 @@ import itertools
 import warnings
 
 import tables
+import numpy as np
 
 from .. import api
 
 
+#: Number of set bits for each byte value.
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)],
+                    dtype=np.uint8)
+
+#: Default number of coincidences for which the events are read at once.
+BATCH_SIZE = 1000
+
+
 class CoincidenceQuery(object):
 
     """Perform queries on an ESD file where coincidences have been analysed.
@@ -24,6 +33,9 @@ class CoincidenceQuery(object):
     An exception will occur when you include a station in a query that
     does not occur in the datafile.
 
+    For large datasets use :meth:`build_index` to speed up the queries,
+    the index can be stored in the file for later use.
+
     Example usage::
 
         >>> from sapphire import CoincidenceQuery
@@ -68,6 +80,75 @@ class CoincidenceQuery(object):
         except tables.NoSuchNodeError:
             self.reconstructed = False
 
+        self.station_mask = None
+        self.station_bits = None
+        self.timestamp_index = None
+        self._read_index()
+
+    def build_index(self, persist=False):
+        """Build an index of the station membership and the timestamps
+
+        The stations in each coincidence are stored as a packed bitmask,
+        together with the order of the coincidences by timestamp.  Once
+        built (or read from the coincidences group) queries are performed
+        using this index, instead of by PyTables query strings.
+
+        :param persist: if True, store the index in the coincidences
+            group, to be used by future instances of this class.  This
+            requires that the file is opened in a writable mode.
+
+        """
+        s_columns = [column for column in self.coincidences.colnames
+                     if re.match('s[0-9]+$', column)]
+        station_numbers = [int(column[1:]) for column in s_columns]
+        n_coincidences = len(self.coincidences)
+
+        station_mask = np.zeros((n_coincidences, -(-len(s_columns) // 8)),
+                                dtype=np.uint8)
+        for bit, column in enumerate(s_columns):
+            in_coincidence = self.coincidences.col(column).astype(np.uint8)
+            station_mask[:, bit // 8] |= in_coincidence << (bit % 8)
+
+        timestamps = self.coincidences.col('timestamp')
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamp_index = np.empty(n_coincidences,
+                                   dtype=[('timestamp', timestamps.dtype),
+                                          ('row', np.int64)])
+        timestamp_index['timestamp'] = timestamps[order]
+        timestamp_index['row'] = order
+
+        if persist:
+            group = self.coincidences._v_parent
+            for name in ['station_mask', 'timestamp_index']:
+                if name in group:
+                    self.data.remove_node(group, name)
+            mask_node = self.data.create_array(group, 'station_mask',
+                                               station_mask)
+            mask_node.attrs.station_numbers = station_numbers
+            self.data.create_table(group, 'timestamp_index', timestamp_index,
+                                   expectedrows=n_coincidences)
+
+        self.station_mask = station_mask
+        self.station_bits = {'s%d' % number: bit
+                             for bit, number in enumerate(station_numbers)}
+        self.timestamp_index = timestamp_index
+
+    def _read_index(self):
+        """Read the index stored in the coincidences group, if up to date"""
+
+        group = self.coincidences._v_parent
+        if 'station_mask' not in group or 'timestamp_index' not in group:
+            return
+        mask_node = group.station_mask
+        if len(mask_node) != len(self.coincidences):
+            warnings.warn('The stored coincidence index is outdated, it will '
+                          'not be used.  Use build_index to update it.')
+            return
+        self.station_mask = mask_node.read()
+        self.station_bits = {'s%d' % number: bit for bit, number
+                             in enumerate(mask_node.attrs.station_numbers)}
+        self.timestamp_index = group.timestamp_index.read()
+
     def finish(self):
         """Clean-up after using
 
@@ -101,6 +182,8 @@ class CoincidenceQuery(object):
         if len(s_columns) == 0:
             # no stations would result in a bad query string
             return []
+        if self.station_mask is not None:
+            return self._query_index(s_columns, 1, start, stop, iterator)
         query = '(%s)' % ' | '.join(s_columns)
         query = self._add_timestamp_filter(query, start, stop)
         filtered_coincidences = self.perform_query(query, iterator)
@@ -119,6 +202,9 @@ class CoincidenceQuery(object):
             # Not all requested stations exist in the data so it's
             # impossible to find a coincidence with all stations.
             return []
+        if self.station_mask is not None:
+            return self._query_index(s_columns, len(s_columns), start, stop,
+                                     iterator)
         query = '(%s)' % ' & '.join(s_columns)
         query = self._add_timestamp_filter(query, start, stop)
         filtered_coincidences = self.perform_query(query, iterator)
@@ -137,6 +223,8 @@ class CoincidenceQuery(object):
         if len(s_columns) < n:
             # No combinations possible because there are to few stations
             return []
+        if self.station_mask is not None:
+            return self._query_index(s_columns, n, start, stop, iterator)
         s_combinations = ['(%s)' % (' & '.join(combo))
                           for combo in itertools.combinations(s_columns, n)]
         query = '(%s)' % ' | '.join(s_combinations)
@@ -152,10 +240,79 @@ class CoincidenceQuery(object):
         :return: coincidences within the specified timerange.
 
         """
+        if self.station_mask is not None:
+            rows = self._rows_in_timerange(start, stop, True)
+            return self._read_rows(rows, iterator)
         query = '(%d <= timestamp) & (timestamp < %d)' % (start, stop)
         filtered_coincidences = self.perform_query(query, iterator)
         return filtered_coincidences
 
+    def _query_index(self, s_columns, n, start=None, stop=None,
+                     iterator=False):
+        """Filter coincidences using the index
+
+        :param s_columns: column names of the stations.
+        :param n: minimum number of the stations to be in a coincidence.
+        :param start: timestamp from which to look for coincidences.
+        :param stop: end timestamp for coincidences.
+        :return: coincidences matching the query.
+
+        """
+        query_mask = np.zeros(self.station_mask.shape[1], dtype=np.uint8)
+        for column in s_columns:
+            bit = self.station_bits[column]
+            query_mask[bit // 8] |= 1 << (bit % 8)
+
+        rows = self._rows_in_timerange(start, stop)
+        if rows is None:
+            station_mask = self.station_mask
+        else:
+            station_mask = self.station_mask[rows]
+        n_stations = POPCOUNT[station_mask & query_mask].sum(axis=1)
+        if rows is None:
+            rows = np.flatnonzero(n_stations >= n)
+        else:
+            rows = rows[n_stations >= n]
+
+        return self._read_rows(rows, iterator)
+
+    def _rows_in_timerange(self, start=None, stop=None, always=False):
+        """Get the rows of the coincidences within a timerange
+
+        Like :meth:`_add_timestamp_filter` the start and stop are only
+        used if they are not 0 or None, unless always is True.
+
+        :param start: timestamp from which to look for coincidences.
+        :param stop: end timestamp for coincidences.
+        :param always: if True, always use the start and stop.
+        :return: sorted array of row numbers or None if not limited.
+
+        """
+        if not always and not start and not stop:
+            return None
+        timestamps = self.timestamp_index['timestamp']
+        if always or start:
+            first = np.searchsorted(timestamps, start, side='left')
+        else:
+            first = 0
+        if always or stop:
+            last = np.searchsorted(timestamps, stop, side='left')
+        else:
+            last = len(timestamps)
+        return np.sort(self.timestamp_index['row'][first:last])
+
+    def _read_rows(self, rows, iterator=False):
+        """Read the coincidences at the given rows
+
+        :param rows: sorted array of row numbers.
+        :return: the coincidences.
+
+        """
+        if iterator:
+            return self.coincidences.itersequence(rows)
+        else:
+            return self.coincidences.read_coordinates(rows)
+
     def _add_timestamp_filter(self, query, start=None, stop=None):
         """Add timestamp filter to the query
 
@@ -249,6 +406,80 @@ class CoincidenceQuery(object):
             reconstructions.append((station_number, rec_table[e_idx]))
         return reconstructions
 
+    def _get_events_in_batches(self, coincidences, table_name='events',
+                               batch_size=BATCH_SIZE):
+        """Get events belonging to coincidences, reading them in batches
+
+        Instead of reading the events one row at a time, the coincidence
+        indexes of a batch of coincidences are combined, such that the
+        events (or reconstructions) of each station are read with a
+        single :meth:`tables.Table.read_coordinates` call.
+
+        :param coincidences: iterable of coincidence rows.
+        :param table_name: name of the station tables to read the rows
+                           from, 'events' or 'reconstructions'.
+        :param batch_size: number of coincidences to read at once.
+        :return: generator yielding, for each coincidence, a list of
+                 tuples containing station numbers and events.
+
+        """
+        coincidences = iter(coincidences)
+        while True:
+            # Get the ids directly, iterated table rows are reused.
+            c_ids = [coincidence['id'] for coincidence
+                     in itertools.islice(coincidences, batch_size)]
+            if not c_ids:
+                break
+            for events in self._get_events_for_ids(c_ids, table_name):
+                yield events
+
+    def _get_events_for_ids(self, c_ids, table_name='events'):
+        """Get events belonging to a batch of coincidences
+
+        :param c_ids: list of coincidence ids.
+        :param table_name: name of the station tables to read the rows
+                           from, 'events' or 'reconstructions'.
+        :return: list of tuples containing station numbers and events,
+                 for each coincidence.
+
+        """
+        if (np.diff(c_ids) == 1).all():
+            # Consecutive coincidences, read the index in one go.
+            c_idxs = self.c_index.read(c_ids[0], c_ids[-1] + 1)
+        else:
+            c_idxs = [self.c_index[c_id] for c_id in c_ids]
+        lengths = [len(c_idx) for c_idx in c_idxs]
+        pairs = np.concatenate([np.reshape(c_idx, (-1, 2))
+                                for c_idx in c_idxs])
+        s_idxs = pairs[:, 0]
+        e_idxs = pairs[:, 1]
+
+        rows = [None] * len(pairs)
+        for s_idx in np.unique(s_idxs):
+            s_node = self.s_nodes[s_idx]
+            if s_node is None:
+                warnings.warn('Missing station group for station id %d. '
+                              'Events from it are excluded.' % s_idx)
+                continue
+            table = s_node._f_get_child(table_name)
+            positions = np.flatnonzero(s_idxs == s_idx)
+            indexes, inverse = np.unique(e_idxs[positions],
+                                         return_inverse=True)
+            records = table.read_coordinates(indexes)
+            for position, record_idx in zip(positions, inverse):
+                rows[position] = records[record_idx]
+
+        coincidence_events = []
+        start = 0
+        for length in lengths:
+            stop = start + length
+            coincidence_events.append(
+                [(self.s_numbers[s_idx], row)
+                 for s_idx, row in zip(s_idxs[start:stop], rows[start:stop])
+                 if row is not None])
+            start = stop
+        return coincidence_events
+
     def _get_reconstruction(self, coincidence):
         """Get coincidence reconstruction belonging to a coincidence
 
@@ -264,28 +495,42 @@ class CoincidenceQuery(object):
                             'Perform reconstructions and reinitialize this '
                             'class.')
 
-    def all_events(self, coincidences, n=0):
+    def all_events(self, coincidences, n=0, batch_size=None):
         """Get all events for the given coincidences.
 
         :param coincidences: list of coincidence rows.
         :param n: minimum number of events per coincidence.
+        :param batch_size: if given, read the events for this many
+                           coincidences at once, see
+                           :meth:`_get_events_in_batches`.
         :return: list of events for each coincidence.
 
         """
-        coincidence_events = (self._get_events(coincidence)
-                              for coincidence in coincidences)
+        if batch_size:
+            coincidence_events = self._get_events_in_batches(
+                coincidences, 'events', batch_size)
+        else:
+            coincidence_events = (self._get_events(coincidence)
+                                  for coincidence in coincidences)
         return self.minimum_events_for_coincidence(coincidence_events, n)
 
-    def all_reconstructions(self, coincidences, n=0):
+    def all_reconstructions(self, coincidences, n=0, batch_size=None):
         """Get all reconstructed events for the given coincidences.
 
         :param coincidences: list of coincidence rows.
         :param n: minimum number of events per coincidence.
+        :param batch_size: if given, read the reconstructions for this
+                           many coincidences at once, see
+                           :meth:`_get_events_in_batches`.
         :return: list of reconstructed events for each coincidence.
 
         """
-        coincidence_recs = (self._get_reconstructions(coincidence)
-                            for coincidence in coincidences)
+        if batch_size:
+            coincidence_recs = self._get_events_in_batches(
+                coincidences, 'reconstructions', batch_size)
+        else:
+            coincidence_recs = (self._get_reconstructions(coincidence)
+                                for coincidence in coincidences)
         return self.minimum_events_for_coincidence(coincidence_recs, n)
 
     def minimum_events_for_coincidence(self, coincidences_events, n=2):
@@ -300,30 +545,47 @@ class CoincidenceQuery(object):
                                  if len(coincidence) >= n)
         return filtered_coincidences
 
-    def events_from_stations(self, coincidences, stations, n=2):
+    def events_from_stations(self, coincidences, stations, n=2,
+                             batch_size=None):
         """Only get events for specific stations for coincidences.
 
         :param coincidences: list of coincidence rows.
         :param stations: list of station numbers to filter events for.
+        :param batch_size: if given, read the events for this many
+                           coincidences at once, see
+                           :meth:`_get_events_in_batches`.
         :return: list of filtered events for each coincidence.
 
         """
-        events_iterator = (self._get_events(coincidence)
-                           for coincidence in coincidences)
+        if batch_size:
+            events_iterator = self._get_events_in_batches(
+                coincidences, 'events', batch_size)
+        else:
+            events_iterator = (self._get_events(coincidence)
+                               for coincidence in coincidences)
         coincidences_events = (self._events_from_stations(events, stations)
                                for events in events_iterator)
         return self.minimum_events_for_coincidence(coincidences_events, n)
 
-    def reconstructions_from_stations(self, coincidences, stations, n=2):
+    def reconstructions_from_stations(self, coincidences, stations, n=2,
+                                      batch_size=None):
         """Only get reconstructions for specific stations for coincidences.
 
         :param coincidences: list of coincidence rows.
         :param stations: list of station numbers to filter events for.
+        :param batch_size: if given, read the reconstructions for this
+                           many coincidences at once, see
+                           :meth:`_get_events_in_batches`.
         :return: list of filtered reconstructed events for each coincidence.
 
         """
-        reconstructions_iterator = (self._get_reconstructions(coincidence)
-                                    for coincidence in coincidences)
+        if batch_size:
+            reconstructions_iterator = self._get_events_in_batches(
+                coincidences, 'reconstructions', batch_size)
+        else:
+            reconstructions_iterator = (
+                self._get_reconstructions(coincidence)
+                for coincidence in coincidences)
         coincidences_recs = (self._events_from_stations(recs, stations)
                              for recs in reconstructions_iterator)
         return self.minimum_events_for_coincidence(coincidences_recs, n)
@@ -33,10 +33,10 @@
 from __future__ import print_function
 
 import os.path
+from collections import OrderedDict
 
 import tables
 import numpy as np
-from progressbar import ProgressBar, ETA, Bar, Percentage
 from six.moves import range
 
 from . import process_events
@@ -44,6 +44,19 @@ from .. import storage
 from ..utils import pbar
 
 
+#: Number of events of a station read at once when searching in chunks.
+CHUNK_SIZE = 1000000
+
+#: Maximum size in bytes of the decoded traces cached by
+#: :class:`CoincidenceEventsReader`.
+TRACE_CACHE_SIZE = 2 ** 27
+
+#: Layout of the timestamps array: the timestamp, an index into the list of
+#: stations and an index into the event table of that station.
+TIMESTAMPS_DTYPE = np.dtype([('timestamp', np.uint64), ('station', np.uint16),
+                             ('index', np.uint32)])
+
+
 class Coincidences(object):
     """Search for and store coincidences between HiSPARC stations.
 
@@ -165,7 +178,7 @@ class Coincidences(object):
         if self.opened:
             self.data.close()
 
-    def search_and_store_coincidences(self, window=10000):
+    def search_and_store_coincidences(self, window=10000, workers=None):
         """Search, process and store coincidences.
 
         This is a semi-automatic method to search for coincidences,
@@ -176,9 +189,13 @@ class Coincidences(object):
         shifts or overwriting previously processed events, please call
         the individual methods.  See the class docstring.
 
+        :param window: the coincidence time window in nanoseconds.
+        :param workers: the number of worker processes used to process
+            the events, see :meth:`process_events`.
+
         """
         self.search_coincidences(window=window)
-        self.process_events()
+        self.process_events(workers=workers)
         self.store_coincidences()
 
     def search_coincidences(self, window=10000, shifts=None, limit=None):
@@ -212,7 +229,8 @@ class Coincidences(object):
         """
         c_index, timestamps = \
             self._search_coincidences(window, shifts, limit)
-        timestamps = np.array(timestamps, dtype=np.uint64)
+        timestamps = np.column_stack([timestamps[field].astype(np.uint64)
+                                      for field in TIMESTAMPS_DTYPE.names])
         self.data.create_array(self.coincidence_group, '_src_timestamps',
                                timestamps)
         src_c_index = self.data.create_vlarray(self.coincidence_group,
@@ -221,7 +239,7 @@ class Coincidences(object):
         for coincidence in c_index:
             src_c_index.append(coincidence)
 
-    def process_events(self, overwrite=None):
+    def process_events(self, overwrite=None, workers=None):
         """Process events using :mod:`~sapphire.analysis.process_events`
 
         Events making up the coincidences are processed to obtain
@@ -229,6 +247,10 @@ class Coincidences(object):
 
         :param overwrite: if True, overwrite the events tables in the
             station groups.
+        :param workers: the number of worker processes used to process
+            the traces.  The traces of all station groups are processed
+            concurrently by the workers.  The default, None, processes
+            the station groups one after another in the current process.
 
         """
         if overwrite is None:
@@ -246,6 +268,7 @@ class Coincidences(object):
                 selected_timestamps.append(timestamps[event])
         full_index = np.array(selected_timestamps)
 
+        processes = []
         for station_id, station_group in enumerate(self.station_groups):
             station_group = self.data.get_node(station_group)
             selected = full_index.compress(full_index[:, 1] == station_id,
@@ -263,7 +286,15 @@ class Coincidences(object):
 
             process = processor(self.data, station_group, index,
                                 progress=self.progress)
-            process.process_and_store_results(overwrite=overwrite)
+            if workers is None or workers <= 1:
+                process.process_and_store_results(overwrite=overwrite)
+            else:
+                processes.append(process)
+
+        if processes:
+            process_events.process_and_store_results_in_workers(
+                processes, workers, overwrite=overwrite,
+                progress=self.progress)
 
     def store_coincidences(self):
         """Store the previously found coincidences.
@@ -273,79 +304,131 @@ class Coincidences(object):
         method.
 
         """
-        self.c_index = []
         self.coincidences = self.data.create_table(self.coincidence_group,
                                                    'coincidences',
                                                    storage.Coincidence)
         self.observables = self.data.create_table(self.coincidence_group,
                                                   'observables',
                                                   storage.EventObservables)
-
-        for coincidence in pbar(self.coincidence_group._src_c_index,
-                                show=self.progress):
-            self._store_coincidence(coincidence)
-
         c_index = self.data.create_vlarray(self.coincidence_group, 'c_index',
                                            tables.UInt32Col())
-        for coincidence in self.c_index:
-            c_index.append(coincidence)
+
+        src_c_index = self.coincidence_group._src_c_index
+        timestamps = self.coincidence_group._src_timestamps.read()
+        for start in pbar(range(0, len(src_c_index), CHUNK_SIZE),
+                          show=self.progress):
+            coincidences = src_c_index.read(start, start + CHUNK_SIZE)
+            self._store_coincidences(coincidences, timestamps, c_index)
+
         c_index.flush()
         self.c_index = c_index
 
-    def _store_coincidence(self, coincidence):
-        """Store a single coincidence in the coincidence group.
+    def _store_coincidences(self, coincidences, timestamps, c_index):
+        """Store a number of coincidences in the coincidence group.
+
+        Stores the coincidences in the coincidences table, the individual
+        events in the observables table and the indexes of those
+        observables in the c_index.
 
-        Stores in the coincidences table, the c_index, and the individual
-        events in the observables table.
+        :param coincidences: list of coincidences, which each consist of
+            a list with indexes into the timestamps array.
+        :param timestamps: array with for each event a (timestamp,
+            station_idx, event_idx) row.
+        :param c_index: the c_index VLArray.
 
         """
-        row = self.coincidences.row
-        coincidence_id = len(self.coincidences)
-        row['id'] = coincidence_id
-        row['N'] = len(coincidence)
-
-        observables_idx = []
-        timestamps = []
-        for index in coincidence:
-            event_desc = self.coincidence_group._src_timestamps[index]
-            station_id = event_desc[1]
-            event_index = int(event_desc[2])
+        if not len(coincidences):
+            return
 
-            group = self.data.get_node(self.station_groups[station_id])
-            event = group.events[event_index]
-            idx = self._store_event_in_observables(event, coincidence_id,
-                                                   station_id)
-            observables_idx.append(idx)
-            timestamps.append((event['ext_timestamp'], event['timestamp'],
-                               event['nanoseconds']))
-
-        first_timestamp = sorted(timestamps)[0]
-        row['ext_timestamp'], row['timestamp'], row['nanoseconds'] = \
-            first_timestamp
-        row.append()
-        self.c_index.append(observables_idx)
+        members = timestamps[np.concatenate(coincidences)]
+        station_ids = members[:, 1].astype(int)
+        events = self._read_events(
+            station_ids, members[:, 2],
+            ['timestamp', 'nanoseconds', 'ext_timestamp',
+             'n1', 'n2', 'n3', 'n4', 't1', 't2', 't3', 't4'])
+        rows = self._new_coincidence_rows(coincidences, events)
+        self.coincidences.append(rows)
         self.coincidences.flush()
 
-    def _store_event_in_observables(self, event, coincidence_id,
-                                    station_id):
-        """Store a single event in the observables table."""
+        observables = self._empty_rows(self.observables, len(members))
+        observables['id'] = len(self.observables) + np.arange(len(members))
+        observables['station_id'] = station_ids
+        for key, values in events.items():
+            observables[key] = values
+        observables['N'] = sum(events[key] > self.trig_threshold
+                               for key in ('n1', 'n2', 'n3', 'n4'))
+
+        offsets = np.cumsum([len(coincidence)
+                             for coincidence in coincidences])[:-1]
+        for observables_idx in np.split(observables['id'], offsets):
+            c_index.append(observables_idx)
 
-        row = self.observables.row
-        event_id = len(self.observables)
-        row['id'] = event_id
+        self.observables.append(observables)
+        self.observables.flush()
 
-        row['station_id'] = station_id
-        for key in ('timestamp', 'nanoseconds', 'ext_timestamp',
-                    'n1', 'n2', 'n3', 'n4', 't1', 't2', 't3', 't4'):
-            row[key] = event[key]
+    def _read_events(self, station_ids, event_indexes, fields):
+        """Read columns of events from the station event tables
 
-        signals = [event[key] for key in ('n1', 'n2', 'n3', 'n4')]
-        n = sum([1 if u > self.trig_threshold else 0 for u in signals])
-        row['N'] = n
+        Reads the events of each station with a single selection.
 
-        row.append()
-        self.observables.flush()
-        return event_id
+        :param station_ids: array with for each event an index into the
+            station_groups.
+        :param event_indexes: array with for each event an index into the
+            station's event table.
+        :param fields: names of the columns to read.
+        :return: dictionary with an array for each of the fields, in the
+            same order as the events.
+
+        """
+        events = {}
+        for station_id in np.unique(station_ids):
+            group = self.data.get_node(self.station_groups[station_id])
+            selected = np.flatnonzero(station_ids == station_id)
+            index, inverse = np.unique(event_indexes[selected],
+                                       return_inverse=True)
+            rows = group.events.read_coordinates(index)
+            for field in fields:
+                if field not in events:
+                    events[field] = np.empty(len(station_ids),
+                                             dtype=rows.dtype[field])
+                events[field][selected] = rows[field][inverse]
+        return events
+
+    def _new_coincidence_rows(self, coincidences, events):
+        """Create rows for a number of coincidences for the coincidences table
+
+        The timestamp of a coincidence is that of its earliest event.
+
+        :param coincidences: list of coincidences, which each consist of
+            a list of events.
+        :param events: dictionary with arrays of the ext_timestamp,
+            timestamp and nanoseconds of the events of all coincidences,
+            in the same order as the coincidences.
+        :return: array of rows for the coincidences table.
+
+        """
+        n_events = np.array([len(coincidence)
+                             for coincidence in coincidences])
+        coincidence_idx = np.repeat(np.arange(len(coincidences)), n_events)
+        order = np.lexsort((events['nanoseconds'], events['timestamp'],
+                            events['ext_timestamp'], coincidence_idx))
+        first = order[np.cumsum(n_events) - n_events]
+
+        rows = self._empty_rows(self.coincidences, len(coincidences))
+        rows['id'] = len(self.coincidences) + np.arange(len(coincidences))
+        rows['N'] = n_events
+        for key in ('ext_timestamp', 'timestamp', 'nanoseconds'):
+            rows[key] = events[key][first]
+        return rows
+
+    @staticmethod
+    def _empty_rows(table, n_rows):
+        """Create an array of rows for a table, filled with the defaults"""
+
+        rows = np.empty(n_rows, dtype=table.dtype)
+        for name, default in table.coldflts.items():
+            rows[name] = default
+        return rows
 
     def _search_coincidences(self, window=10000, shifts=None, limit=None):
         """Search for coincidences
@@ -366,25 +449,29 @@ class Coincidences(object):
 
         :return: coincidences, timestamps. First a list of coincidences, which
             each consist of a list with indexes into the timestamps array as a
-            pointer to the events making up the coincidence. Then, a list of
-            tuples.  Each tuple consists of a timestamp followed by an index
-            into the stations list which designates the detector
-            station which measured the event, and finally an index into that
-            station's event table.
+            pointer to the events making up the coincidence. Then, a
+            structured array (see :data:`TIMESTAMPS_DTYPE`).  Each row
+            consists of a timestamp followed by an index into the stations
+            list which designates the detector station which measured the
+            event, and finally an index into that station's event table.
 
         """
-        # get the 'events' tables from the groups or groupnames
+        event_tables = self._get_event_tables()
+        timestamps = self._retrieve_timestamps(event_tables, shifts, limit)
+        coincidences = self._do_search_coincidences(timestamps, window)
+
+        return coincidences, timestamps
+
+    def _get_event_tables(self):
+        """Get the 'events' tables from the groups or groupnames"""
+
         event_tables = []
         for station_group in self.station_groups:
             station_group = self.data.get_node(station_group)
             if 'events' in station_group:
                 event_tables.append(self.data.get_node(station_group,
                                                        'events'))
-
-        timestamps = self._retrieve_timestamps(event_tables, shifts, limit)
-        coincidences = self._do_search_coincidences(timestamps, window)
-
-        return coincidences, timestamps
+        return event_tables
 
     def _retrieve_timestamps(self, event_tables, shifts=None, limit=None):
         """Retrieve all timestamps from all stations, optionally shifting them
@@ -400,39 +487,213 @@ class Coincidences(object):
             shift.
         :param limit: limit the number of events which are processed.
 
-        :return: list of tuples.  Each tuple consists of a timestamp followed
-            by an index into the stations list which designates the detector
-            station which measured the event, and finally an index of the
-            event into the station's event table.
+        :return: structured array with the fields ``timestamp``,
+            ``station`` and ``index``, sorted by timestamp.  Each row
+            consists of a timestamp followed by an index into the stations
+            list which designates the detector station which measured the
+            event, and finally an index of the event into the station's
+            event table.
+
+        """
+        shifts = self._shifts_in_nanoseconds(shifts, len(event_tables))
+
+        station_timestamps = []
+        for event_table, shift in zip(event_tables, shifts):
+            ts = np.array(event_table.col('ext_timestamp')[:limit],
+                          dtype=np.uint64)
+            station_timestamps.append(self._shift_timestamps(ts, shift))
+
+        n_events = sum(len(ts) for ts in station_timestamps)
+        timestamps = np.empty(n_events, dtype=TIMESTAMPS_DTYPE)
+        if n_events:
+            timestamps['timestamp'] = np.concatenate(station_timestamps)
+            timestamps['station'] = np.repeat(
+                np.arange(len(station_timestamps)),
+                [len(ts) for ts in station_timestamps])
+            timestamps['index'] = np.concatenate(
+                [np.arange(len(ts)) for ts in station_timestamps])
+
+            # The event tables are sorted by timestamp, so this is a merge
+            # of already sorted runs, which the stable sort does in linear
+            # time.  Equal timestamps remain ordered by station and index.
+            order = np.argsort(timestamps['timestamp'], kind='stable')
+            timestamps = timestamps[order]
+
+        return timestamps
+
+    @staticmethod
+    def _shifts_in_nanoseconds(shifts, n_stations):
+        """Convert the shifts in seconds to integer nanoseconds
+
+        :param shifts: a list of time shifts in seconds, use 'None' for no
+            shift.  Missing shifts are also taken as no shift.
+        :param n_stations: the number of stations.
+        :return: list with a shift (int) or None for each station.
 
         """
-        # calculate the shifts in nanoseconds and cast them to int.
-        # (prevent upcasting timestamps to float64 further on)
-        if shifts is not None:
-            shifts = [int(shift * 1e9) if shift is not None else shift
-                      for shift in shifts]
-
-        timestamps = []
-        for s_id, event_table in enumerate(event_tables):
-            ts = [(x, s_id, j) for j, x in
-                  enumerate(event_table.col('ext_timestamp')[:limit])]
-            try:
-                # shift data. carefully avoid upcasting (we're adding two
-                # ints, which is an int, and casting that back to uint64. if
-                # we're not careful, an intermediate value will be a float64,
-                # which doesn't hold the precision to store nanoseconds.
-                ts = [(np.uint64(int(x) + shifts[i]), i, j)
-                      for x, i, j in ts]
-            except (TypeError, IndexError):
-                # shift is None or doesn't exist
-                pass
-            timestamps.extend(ts)
-
-        # sort the timestamps
-        timestamps.sort()
+        if shifts is None:
+            shifts = []
+        shifts = [int(round(shift * 1e9)) if shift is not None else shift
+                  for shift in shifts[:n_stations]]
+        return shifts + [None] * (n_stations - len(shifts))
 
+    @staticmethod
+    def _shift_timestamps(timestamps, shift):
+        """Shift uint64 timestamps in place
+
+        Only uint64 operands are used, mixing them with (negative) Python
+        ints would upcast the timestamps to float64, which doesn't hold
+        the precision to store nanoseconds.
+
+        :param timestamps: array of uint64 timestamps.
+        :param shift: shift in nanoseconds (int) or None for no shift.
+        :return: the shifted timestamps.
+
+        """
+        if shift:
+            if shift > 0:
+                timestamps += np.uint64(shift)
+            else:
+                timestamps -= np.uint64(-shift)
         return timestamps
 
+    def _iter_timestamps_in_chunks(self, event_tables, shifts=None,
+                                   chunk_size=CHUNK_SIZE):
+        """Iterate over the merged timestamps of all stations in chunks
+
+        Reads chunks of at most chunk_size events from each event table,
+        so the timestamps of all stations are never in memory at once.
+        Events from different stations are only yielded once no station
+        can still have an earlier event.  Together the chunks are equal
+        to the result of :meth:`_retrieve_timestamps`.
+
+        :param event_tables: a list of HiSPARC event tables, sorted by
+            ext_timestamp.
+        :param shifts: a list of time shifts in seconds, use 'None' for no
+            shift.
+        :param chunk_size: number of events to read from a table at once.
+        :return: generator of structured arrays (see
+            :data:`TIMESTAMPS_DTYPE`) sorted by timestamp.
+
+        """
+        shifts = self._shifts_in_nanoseconds(shifts, len(event_tables))
+        positions = [0] * len(event_tables)
+        buffers = [np.empty(0, dtype=TIMESTAMPS_DTYPE) for _ in event_tables]
+        refill = list(range(len(event_tables)))
+
+        while True:
+            for s_id in refill:
+                event_table = event_tables[s_id]
+                start = positions[s_id]
+                stop = min(start + chunk_size, len(event_table))
+                if start >= stop:
+                    continue
+                chunk = np.empty(stop - start, dtype=TIMESTAMPS_DTYPE)
+                ts = np.array(event_table.read(start, stop,
+                                               field='ext_timestamp'),
+                              dtype=np.uint64)
+                chunk['timestamp'] = self._shift_timestamps(ts, shifts[s_id])
+                chunk['station'] = s_id
+                chunk['index'] = np.arange(start, stop)
+                chunk = np.concatenate([buffers[s_id], chunk])
+                if np.any(np.diff(chunk['timestamp'].astype(np.int64)) < 0):
+                    raise RuntimeError("Events in %s are not sorted by "
+                                       "ext_timestamp." % event_table)
+                buffers[s_id] = chunk
+                positions[s_id] = stop
+
+            unread = [s_id for s_id, event_table in enumerate(event_tables)
+                      if positions[s_id] < len(event_table)]
+            if not unread and not any(len(buffer) for buffer in buffers):
+                return
+
+            # Stations with unread events may still have events at the
+            # last timestamp in their buffer, only earlier events are final.
+            if unread:
+                horizon = min(buffers[s_id]['timestamp'][-1]
+                              for s_id in unread)
+                n_final = [np.searchsorted(buffer['timestamp'], horizon,
+                                           side='left')
+                           for buffer in buffers]
+            else:
+                n_final = [len(buffer) for buffer in buffers]
+
+            if not any(n_final):
+                # The buffers of the limiting stations only contain events
+                # at the horizon, read more of their events.
+                refill = [s_id for s_id in unread
+                          if buffers[s_id]['timestamp'][-1] == horizon]
+                continue
+
+            timestamps = np.concatenate([buffer[:n] for buffer, n
+                                         in zip(buffers, n_final)])
+            buffers = [buffer[n:] for buffer, n in zip(buffers, n_final)]
+            refill = [s_id for s_id in unread if not len(buffers[s_id])]
+
+            # Equal timestamps remain ordered by station and index.
+            order = np.argsort(timestamps['timestamp'], kind='stable')
+            yield timestamps[order]
+
+    def _search_coincidences_in_chunks(self, event_tables, window=10000,
+                                       shifts=None, chunk_size=CHUNK_SIZE):
+        """Search for coincidences in chunks of the timestamps
+
+        Like :meth:`_search_coincidences`, but only a chunk of the
+        timestamps is in memory at any time.  Events within a window of
+        the end of a chunk are carried over to the next chunk, so each
+        coincidence is found exactly once, also if it spans the boundary
+        between chunks.
+
+        :param event_tables: a list of HiSPARC event tables, sorted by
+            ext_timestamp.
+        :param window: the time window in nanoseconds which will be searched
+            for coincidences.
+        :param shifts: a list of time shifts in seconds, use 'None' for no
+            shift.
+        :param chunk_size: number of events to read from a table at once.
+        :return: generator of (timestamps, coincidences) tuples.  The
+            coincidences are lists of indexes into that chunk of
+            timestamps, which is a structured array (see
+            :data:`TIMESTAMPS_DTYPE`).
+
+        """
+        window = np.uint64(np.ceil(window))
+        chunks = self._iter_timestamps_in_chunks(event_tables, shifts,
+                                                 chunk_size)
+        carry = np.empty(0, dtype=TIMESTAMPS_DTYPE)
+        # number of events at the start of carry already used as start of
+        # a coincidence, only needed to compare their window ends.
+        n_done = 0
+
+        for chunk in chunks:
+            timestamps = np.concatenate([carry, chunk])
+            # the end of the window is only known for the events at least
+            # a window before the last timestamp.
+            last_start = timestamps['timestamp'][-1]
+            if last_start < window:
+                n_final = 0
+            else:
+                n_final = np.searchsorted(timestamps['timestamp'],
+                                          last_start - window, side='right')
+            if n_final > n_done:
+                yield timestamps, self._coincidences_starting_in(
+                    timestamps, window, n_done, n_final)
+                carry = timestamps[n_final - 1:]
+                n_done = 1
+            else:
+                carry = timestamps
+
+        if len(carry) > n_done:
+            yield carry, self._coincidences_starting_in(carry, window,
+                                                        n_done, len(carry))
+
+    def _coincidences_starting_in(self, timestamps, window, start, stop):
+        """Coincidences starting with one of the events in start:stop"""
+
+        coincidences = self._do_search_coincidences(timestamps, window)
+        return [coincidence for coincidence in coincidences
+                if start <= coincidence[0] < stop]
+
     def _do_search_coincidences(self, timestamps, window):
         """Search for coincidences in a set of timestamps
 
@@ -440,8 +701,9 @@ class Coincidences(object):
         for events which occured almost at the same time and thus might be the
         result of an extended air shower.
 
-        :param timestamps: a list of tuples (timestamp, station_idx,
-            event_idx) which will be searched
+        :param timestamps: a structured array or list of tuples
+            (timestamp, station_idx, event_idx), sorted by timestamp, which
+            will be searched
         :param window: the time window in nanoseconds which will be searched
             for coincidences.  Events falling outside this window will not be
             part of the coincidence.
@@ -451,45 +713,31 @@ class Coincidences(object):
             making up the coincidence
 
         """
-        coincidences = []
-
-        # traverse all timestamps
-        prev_coincidence = []
-
-        if self.progress and len(timestamps):
-            pbar = ProgressBar(max_value=len(timestamps),
-                               widgets=[Percentage(), Bar(), ETA()]).start()
-
-        for i in range(len(timestamps)):
+        if getattr(timestamps, 'dtype', None) == TIMESTAMPS_DTYPE:
+            timestamps = timestamps['timestamp']
+        else:
+            timestamps = np.fromiter((timestamp[0] for timestamp
+                                      in timestamps),
+                                     dtype=np.uint64, count=len(timestamps))
 
-            # build coincidence, starting with the current timestamp
-            c = [i]
-            t0 = timestamps[i][0]
+        # For each timestamp find the end of its coincidence window.  The
+        # timestamps are integers, so a fractional window is rounded up.
+        window = np.uint64(np.ceil(window))
+        starts = np.arange(len(timestamps))
+        ends = np.searchsorted(timestamps, timestamps + window, side='left')
 
-            # traverse the rest of the timestamps
-            for j in range(i + 1, len(timestamps)):
-                # if a timestamp is within the coincidence window, add it
-                if timestamps[j][0] - t0 < window:
-                    c.append(j)
-                else:
-                    # coincidence window has passed, break for-loop
-                    break
+        # only save coincidences with more than one event
+        is_coincidence = ends - starts > 1
+        starts = starts[is_coincidence]
+        ends = ends[is_coincidence]
 
-            # if we have more than one event in the coincidence, save it
-            if len(c) > 1:
-                # is this coincidence part of the previous coincidence?
-                is_part_of_prev = np.array([u in prev_coincidence
-                                            for u in c]).all()
-                if not is_part_of_prev:
-                    # no, so it's a new one
-                    coincidences.append(c)
-                    prev_coincidence = c
+        # The window ends can not decrease, so a coincidence is part of the
+        # previous coincidence if both end at the same timestamp.
+        is_new = np.ones(len(ends), dtype=bool)
+        is_new[1:] = ends[1:] != ends[:-1]
 
-            if self.progress and not i % 5000:
-                pbar.update(i)
-
-        if self.progress and len(timestamps):
-            pbar.finish()
+        coincidences = [list(range(start, end)) for start, end
+                        in zip(starts[is_new].tolist(), ends[is_new].tolist())]
 
         return coincidences
 
@@ -603,10 +851,11 @@ class CoincidencesESD(Coincidences):
         attributes ``_src_c_index`` and ``_src_timestamps``.  The
         former is a list of coincidences, which each consist of a list with
         indexes into the timestamps array as a pointer to the events making up
-        the coincidence. The latter is a list of tuples.  Each tuple consists
-        of a timestamp followed by an index into the stations list which
-        designates the detector station which measured the event, and finally
-        an index into that station's event table.
+        the coincidence. The latter is a structured array (see
+        :data:`TIMESTAMPS_DTYPE`).  Each row consists of a timestamp followed
+        by an index into the stations list which designates the detector
+        station which measured the event, and finally an index into that
+        station's event table.
 
         :param window: the coincidence time window.  All events with delta
             t's smaller than this window will be considered a coincidence.
@@ -637,6 +886,72 @@ class CoincidencesESD(Coincidences):
 
         """
         n_coincidences = len(self._src_c_index)
+        self._create_coincidences_table(station_numbers, n_coincidences)
+        c_index = self.data.create_vlarray(
+            self.coincidence_group, 'c_index', tables.UInt32Col(shape=2),
+            expectedrows=n_coincidences)
+
+        for start in pbar(range(0, n_coincidences, CHUNK_SIZE),
+                          show=self.progress):
+            coincidences = self._src_c_index[start:start + CHUNK_SIZE]
+            self._store_coincidences(coincidences, self._src_timestamps,
+                                     c_index)
+        c_index.flush()
+        self.c_index = c_index
+
+        self._store_s_index()
+
+    def search_and_store_coincidences_in_chunks(self, window=10000,
+                                                shifts=None,
+                                                station_numbers=None,
+                                                chunk_size=CHUNK_SIZE):
+        """Search and store coincidences without reading all timestamps
+
+        Like :meth:`search_and_store_coincidences`, but the event tables
+        are read in time-ordered chunks and the coincidences are stored
+        as they are found.  The memory use therefore does not grow with
+        the number of events, which allows searching long periods of data
+        of many stations.  The results are identical to those of
+        :meth:`search_coincidences` followed by
+        :meth:`store_coincidences`, except that the preliminary results
+        (``_src_c_index`` and ``_src_timestamps``) are not kept.
+
+        The event tables need to be sorted by ext_timestamp, which is the
+        case for data downloaded from the ESD.
+
+        :param window: the coincidence time window in nanoseconds.
+        :param shifts: optionally shift a station's data in time.
+            Expects a list of shifts, one for each station, in seconds.
+            Use 'None' for no shift.
+        :param station_numbers: optional list of station_numbers, see
+            :meth:`store_coincidences`.
+        :param chunk_size: number of events to read from a station's
+            event table at once.
+
+        """
+        self._create_coincidences_table(station_numbers)
+        c_index = self.data.create_vlarray(
+            self.coincidence_group, 'c_index', tables.UInt32Col(shape=2))
+
+        event_tables = self._get_event_tables()
+        chunks = self._search_coincidences_in_chunks(event_tables, window,
+                                                     shifts, chunk_size)
+        for timestamps, coincidences in chunks:
+            self._store_coincidences(coincidences, timestamps, c_index)
+        c_index.flush()
+        self.c_index = c_index
+
+        self._store_s_index()
+
+    def _create_coincidences_table(self, station_numbers=None,
+                                   expectedrows=10000):
+        """Create the coincidences table with a column for each station
+
+        :param station_numbers: optional list of station_numbers, see
+            :meth:`store_coincidences`.
+        :param expectedrows: expected number of coincidences.
+
+        """
         if station_numbers is not None:
             if len(station_numbers) != len(self.station_groups):
                 raise RuntimeError(
@@ -653,19 +968,10 @@ class CoincidencesESD(Coincidences):
         description.columns.update(s_columns)
         self.coincidences = self.data.create_table(
             self.coincidence_group, 'coincidences', description,
-            expectedrows=n_coincidences)
-
-        self.c_index = []
+            expectedrows=expectedrows)
 
-        for coincidence in pbar(self._src_c_index, show=self.progress):
-            self._store_coincidence(coincidence)
-
-        c_index = self.data.create_vlarray(
-            self.coincidence_group, 'c_index', tables.UInt32Col(shape=2),
-            expectedrows=n_coincidences)
-        for observables_idx in pbar(self.c_index, show=self.progress):
-            c_index.append(observables_idx)
-        c_index.flush()
+    def _store_s_index(self):
+        """Store the paths to the station groups in s_index"""
 
         s_index = self.data.create_vlarray(
             self.coincidence_group, 's_index', tables.VLStringAtom(),
@@ -674,48 +980,51 @@ class CoincidencesESD(Coincidences):
             s_index.append(station_group.encode('utf-8'))
         s_index.flush()
 
-    def _store_coincidence(self, coincidence):
-        """Store a single coincidence in the coincidence group.
+    def _store_coincidences(self, coincidences, timestamps, c_index):
+        """Store a number of coincidences in the coincidence group.
+
+        Stores the coincidences in the coincidences table and references
+        to the events making up each coincidence in ``c_index``.
 
-        Stores coincidence in the coincidences table and references
-        to the observables making up each coincidence in ``c_index``.
+        :param coincidences: list of coincidences, which each consist of
+            a list with indexes into the timestamps array.
+        :param timestamps: structured array of the timestamps (see
+            :data:`TIMESTAMPS_DTYPE`).
+        :param c_index: the c_index VLArray.
 
         """
-        row = self.coincidences.row
-        coincidence_id = len(self.coincidences)
-        row['id'] = coincidence_id
-        row['N'] = len(coincidence)
-
-        observables_idx = []
-        timestamps = []
-        for index in coincidence:
-            event_desc = self._src_timestamps[index]
-            station_id = event_desc[1]
-            event_index = event_desc[2]
+        if not len(coincidences):
+            return
+
+        members = timestamps[np.concatenate(coincidences)]
+        events = self._read_events(members['station'], members['index'],
+                                   ['ext_timestamp', 'timestamp',
+                                    'nanoseconds'])
+        rows = self._new_coincidence_rows(coincidences, events)
+
+        n_events = [len(coincidence) for coincidence in coincidences]
+        coincidence_idx = np.repeat(np.arange(len(coincidences)), n_events)
+        for station_id in np.unique(members['station']):
             if self.station_numbers is not None:
-                station_number = self.station_numbers[station_id]
-                row['s%d' % station_number] = True
+                column = 's%d' % self.station_numbers[station_id]
             else:
-                row['s%d' % station_id] = True
-
-            group = self.data.get_node(self.station_groups[station_id])
-            event = group.events[event_index]
-            observables_idx.append((station_id, event_index))
-            timestamps.append((event['ext_timestamp'], event['timestamp'],
-                               event['nanoseconds']))
-
-        first_timestamp = sorted(timestamps)[0]
-        row['ext_timestamp'], row['timestamp'], row['nanoseconds'] = \
-            first_timestamp
-        row.append()
-        self.c_index.append(observables_idx)
+                column = 's%d' % station_id
+            participating = coincidence_idx[members['station'] == station_id]
+            rows[column][participating] = True
+        self.coincidences.append(rows)
         self.coincidences.flush()
 
+        observables_idx = np.column_stack([members['station'],
+                                           members['index']])
+        for idx in np.split(observables_idx, np.cumsum(n_events)[:-1]):
+            c_index.append(idx)
+
 
 def get_events(data, stations, coincidence, timestamps, get_raw_traces=False):
     """Get event data of a coincidence
 
-    Return a list of events making up a coincidence.
+    Return a list of events making up a coincidence.  To get the events
+    of many coincidences use :class:`CoincidenceEventsReader`.
 
     :param data: the PyTables data file
     :param stations: a list of HiSPARC event tables (normally from
@@ -732,19 +1041,167 @@ def get_events(data, stations, coincidence, timestamps, get_raw_traces=False):
         a list of the uncompressed traces.
 
     """
-    events = []
-    for event in coincidence:
-        timestamp, station, index = timestamps[event]
-        process = process_events.ProcessEvents(data, stations[station])
-        event = process.source[index]
-        if not get_raw_traces:
-            baseline = np.where(event['baseline'] != -999, event['baseline'],
-                                200)[np.where(event['traces'] >= 0)]
-            # transpose to get expected format
-            traces = (process.get_traces_for_event(event) - baseline).T
-            traces = traces * -0.57
-        else:
-            traces = [process.group.blobs[x] for x in event['traces']]
-        events.append((stations[station], event, traces))
+    reader = CoincidenceEventsReader(data, stations)
+    events = reader.get_events(coincidence, timestamps, get_raw_traces)
+    if get_raw_traces:
+        return events
+    # The traces are not shared through a cache, allow modifying them
+    return [(station, event, traces.copy())
+            for station, event, traces in events]
 
-    return events
+
+class CoincidenceEventsReader(object):
+    """Get event data of many coincidences
+
+    The events of each station are read with a single selection and their
+    traces are decoded together.  The decoded traces are kept in a cache,
+    which is limited in size by discarding the least recently used traces.
+    The returned traces are shared with the cache and are therefore
+    read-only, copy them to modify them.
+
+    Example usage::
+
+        >>> reader = CoincidenceEventsReader(data, station_groups)
+        >>> for events in reader.get_events_for_coincidences(c_index,
+        ...                                                  timestamps):
+        ...     for station, event, traces in events:
+        ...         pass
+
+    """
+
+    def __init__(self, data, stations, cache_size=TRACE_CACHE_SIZE):
+        """Initialize the class.
+
+        :param data: the PyTables data file
+        :param stations: a list of station groups.
+        :param cache_size: maximum size of the cached traces in bytes.
+
+        """
+        self.data = data
+        self.stations = stations
+        self.cache_size = cache_size
+        self._processes = {}
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+
+    def get_events(self, coincidence, timestamps, get_raw_traces=False):
+        """Get event data of a coincidence
+
+        See :func:`get_events`.
+
+        """
+        return self.get_events_for_coincidences([coincidence], timestamps,
+                                                get_raw_traces)[0]
+
+    def get_events_for_coincidences(self, coincidences, timestamps,
+                                    get_raw_traces=False):
+        """Get event data of many coincidences
+
+        :param coincidences: list of coincidences, as returned by
+            :meth:`~Coincidences.search_coincidences`.
+        :param timestamps: the timestamps, as returned by
+            :meth:`~Coincidences.search_coincidences`.
+        :param get_raw_traces: boolean.  If true, return the compressed ADC
+            values instead of the uncompressed traces.
+
+        :return: for each coincidence a list of tuples.  Each tuple consists
+            of (station, event, traces), where event is the event row from
+            PyTables and traces is a read-only array of the uncompressed
+            traces (or list of compressed traces).
+
+        """
+        members = [(int(timestamps[event][1]), int(timestamps[event][2]))
+                   for coincidence in coincidences for event in coincidence]
+
+        events = {}
+        for station in set(station for station, _ in members):
+            index = np.unique([idx for s, idx in members if s == station])
+            rows = self._get_process(station).source.read_coordinates(index)
+            if get_raw_traces:
+                traces = self._get_raw_traces(station, rows)
+            else:
+                traces = self._get_traces(station, index, rows)
+            for idx, event, event_traces in zip(index.tolist(), rows,
+                                                traces):
+                events[station, idx] = (self.stations[station], event,
+                                        event_traces)
+
+        result = []
+        members = iter(members)
+        for coincidence in coincidences:
+            result.append([events[next(members)] for _ in coincidence])
+        return result
+
+    def _get_process(self, station):
+        """Get the (reused) ProcessEvents object to read a station's data"""
+
+        if station not in self._processes:
+            self._processes[station] = process_events.ProcessEvents(
+                self.data, self.stations[station])
+        return self._processes[station]
+
+    def _get_raw_traces(self, station, events):
+        """Get the compressed traces of events"""
+
+        blobs = self._get_process(station).group.blobs
+        return [[blobs[x] for x in event['traces']] for event in events]
+
+    def _get_traces(self, station, index, events):
+        """Get the decoded traces of events, using the cache
+
+        The traces are relative to the baseline and inverted, in mV.
+
+        :param station: index of the station.
+        :param index: the indexes of the events in the events table.
+        :param events: the events.
+        :return: list with an array of the traces of each event.
+
+        """
+        traces = [self._cache_get((station, idx)) for idx in index.tolist()]
+        missing = [i for i, event_traces in enumerate(traces)
+                   if event_traces is None]
+
+        process = self._get_process(station)
+        chunk_size = process_events.TRACE_CHUNK_SIZE
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            raw_traces = process.get_traces_for_events(events[chunk])
+            for i, event, event_traces in zip(chunk, events[chunk],
+                                              raw_traces):
+                present = event['traces'] >= 0
+                baseline = np.where(event['baseline'] != -999,
+                                    event['baseline'], 200)[present]
+                event_traces = event_traces[present]
+                # remove padding from longer traces of other events
+                has_value = np.flatnonzero((event_traces != -1).any(axis=0))
+                n_samples = has_value[-1] + 1 if len(has_value) else 0
+                event_traces = event_traces[:, :n_samples]
+                event_traces = (event_traces - baseline[:, np.newaxis]) * -0.57
+                self._cache_put((station, int(index[i])), event_traces)
+                traces[i] = event_traces
+
+        return traces
+
+    def _cache_get(self, key):
+        """Get traces from the cache, marking them as recently used"""
+
+        try:
+            traces = self._cache.pop(key)
+        except KeyError:
+            return None
+        self._cache[key] = traces
+        return traces
+
+    def _cache_put(self, key, traces):
+        """Add traces to the cache, discarding the least recently used
+
+        The traces are made read-only, so that modifying traces returned
+        to a caller can not change the traces returned by later reads.
+
+        """
+        traces.flags.writeable = False
+        self._cache[key] = traces
+        self._cache_nbytes += traces.nbytes
+        while self._cache_nbytes > self.cache_size and self._cache:
+            _, discarded = self._cache.popitem(last=False)
+            self._cache_nbytes -= discarded.nbytes
@@ -16,12 +16,14 @@
 
 """
 import warnings
-from itertools import combinations
+from itertools import combinations, islice
 
 from six.moves import zip_longest
 from six import itervalues
 from numpy import (nan, isnan, arcsin, arccos, arctan2, sin, cos, tan,
-                   sqrt, where, pi, inf, array, cross, dot, sum, zeros)
+                   sqrt, where, pi, inf, array, cross, dot, sum, zeros,
+                   asarray, stack, broadcast_arrays, errstate, full, isin,
+                   column_stack, unique, take_along_axis, ones, minimum)
 from scipy.optimize import minimize
 from scipy.sparse.csgraph import shortest_path
 
@@ -29,7 +31,7 @@ from .event_utils import (station_arrival_time, detector_arrival_time,
                           relative_detector_arrival_times)
 from ..simulations.showerfront import CorsikaStationFront
 from ..utils import (pbar, norm_angle, c, make_relative, vector_length,
-                     floor_in_base, memoize)
+                     floor_in_base, memoize, get_active_indexes, ERR)
 from ..api import Station
 
 
@@ -110,6 +112,10 @@ class EventDirectionReconstruction(object):
         """
         if initials is None:
             initials = []
+        if (hasattr(events, 'dtype') and
+                hasattr(self.direct, 'reconstruct_common_batch')):
+            return self.reconstruct_events_batch(events, detector_ids,
+                                                 offsets, progress, initials)
         events = pbar(events, show=progress)
         events_init = zip_longest(events, initials)
         angles = [self.reconstruct_event(event, detector_ids, offsets, initial)
@@ -120,6 +126,129 @@ class EventDirectionReconstruction(object):
             theta, phi, ids = ((), (), ())
         return theta, phi, ids
 
+    def reconstruct_events_batch(self, events, detector_ids=None,
+                                 offsets=NO_OFFSET, progress=True,
+                                 initials=None, chunk_size=10000):
+        """Reconstruct events in chunks
+
+        Gives the same results as reconstructing each event with
+        :meth:`reconstruct_event`.  The arrival times of a chunk of events
+        are determined at once, and all events with the same number of
+        detections are reconstructed with a single call to the
+        ``reconstruct_common_batch`` method of the direct or fit
+        algorithm.  Algorithms without that method reconstruct the events
+        one by one.
+
+        :param events: the events table for the station from an ESD data
+            file, or an array of events.
+        :param detector_ids: detectors to use for the reconstructions.
+        :param offsets: time offsets for each detector or a
+            :class:`~sapphire.api.Station` object.
+        :param progress: if True show a progress bar while reconstructing.
+        :param initials: list of dictionaries with already reconstructed shower
+                         parameters.
+        :param chunk_size: number of events to reconstruct at once.
+        :return: list of theta, phi, and detector ids.
+
+        """
+        if detector_ids is None:
+            detector_ids = range(4)
+        detector_ids = list(detector_ids)
+        initials = iter([] if initials is None else initials)
+        theta, phi, ids = [], [], []
+        for start in pbar(range(0, len(events), chunk_size), show=progress):
+            chunk = events[start:start + chunk_size]
+            chunk_initials = list(islice(initials, len(chunk)))
+            chunk_initials.extend([None] * (len(chunk) - len(chunk_initials)))
+            angles = self._reconstruct_chunk(chunk, detector_ids, offsets,
+                                             chunk_initials)
+            theta.extend(angles[0])
+            phi.extend(angles[1])
+            ids.extend(angles[2])
+        return tuple(theta), tuple(phi), tuple(ids)
+
+    def _reconstruct_chunk(self, events, detector_ids, offsets, initials):
+        """Reconstruct a chunk of events
+
+        :param events: array of events.
+        :param detector_ids: detectors to use for the reconstructions.
+        :param offsets: time offsets for each detector or a
+            :class:`~sapphire.api.Station` object.
+        :param initials: list of dictionaries with already reconstructed
+                         shower parameters, one for each event.
+        :return: arrays of theta and phi, and list of detector ids.
+
+        """
+        timestamps = events['timestamp']
+        t = self._detector_arrival_times(events, detector_ids, offsets)
+        detected = ~isnan(t)
+        n_detected = detected.sum(axis=1)
+        theta = full(len(events), nan)
+        phi = full(len(events), nan)
+
+        # The detector positions only change at the station and detector
+        # timestamps, use the same positions for all events in between.
+        position_timestamps = sorted(set(self.station.timestamps).union(
+            *[detector.timestamps for detector in self.station.detectors]))
+        segments = get_active_indexes(position_timestamps, timestamps)
+        for segment in unique(segments):
+            in_segment = (segments == segment).nonzero()[0]
+            self.station.cluster.set_timestamp(timestamps[in_segment[0]])
+            # Only look up detectors with detections, stations may have
+            # fewer detectors than there are detector ids.
+            xyz = full((len(detector_ids), 3), nan)
+            for column in detected[in_segment].any(axis=0).nonzero()[0]:
+                detector = self.station.detectors[detector_ids[column]]
+                xyz[column] = detector.get_coordinates()
+
+            for n in unique(n_detected[in_segment]):
+                if n < 3:
+                    continue
+                algorithm = self.direct if n == 3 else self.fit
+                rows = in_segment[n_detected[in_segment] == n]
+                # Columns of the detections, in order of the detector ids
+                columns = detected[rows].nonzero()[1].reshape(-1, n)
+                if hasattr(algorithm, 'reconstruct_common_batch'):
+                    angles = algorithm.reconstruct_common_batch(
+                        take_along_axis(t[rows], columns, axis=1),
+                        xyz[columns, 0], xyz[columns, 1], xyz[columns, 2])
+                    theta[rows], phi[rows] = angles
+                    continue
+                for i, row_columns in zip(rows, columns):
+                    theta[i], phi[i] = algorithm.reconstruct_common(
+                        list(t[i, row_columns]), list(xyz[row_columns, 0]),
+                        list(xyz[row_columns, 1]), list(xyz[row_columns, 2]),
+                        initials[i])
+
+        id_lists = [[id for id, d in zip(detector_ids, row) if d]
+                    for row in detected]
+        return theta, phi, id_lists
+
+    def _detector_arrival_times(self, events, detector_ids, offsets):
+        """Get corrected arrival times in the detectors for many events
+
+        Vectorized version of
+        :func:`~sapphire.analysis.event_utils.detector_arrival_time`.
+
+        :param events: array of events.
+        :param detector_ids: detectors for which to get the arrival times.
+        :param offsets: time offsets for each detector or a
+            :class:`~sapphire.api.Station` object.
+        :return: array of arrival times with a column for each detector,
+                 nan if the detector has no arrival time.
+
+        """
+        t = column_stack([events['t%d' % (id + 1)] for id in detector_ids])
+        if isinstance(offsets, Station):
+            timing_offsets = offsets.detector_timing_offsets
+            idx = get_active_indexes(timing_offsets['timestamp'],
+                                     events['timestamp'])
+            offsets = column_stack([timing_offsets['offset%d' % (id + 1)][idx]
+                                    for id in detector_ids])
+        else:
+            offsets = array([offsets[id] for id in detector_ids])
+        return where(isin(t, ERR), nan, t - offsets)
+
     def __repr__(self):
         return ("<%s, station: %r, direct: %r, fit: %r>" %
                 (self.__class__.__name__, self.station, self.direct, self.fit))
@@ -158,18 +287,38 @@ class CoincidenceDirectionReconstruction(object):
         :return: list of theta, phi, and station numbers.
 
         """
-        if len(coincidence_events) < 3:
-            return nan, nan, []
         if offsets is None:
             offsets = {}
         if initial is None:
             initial = {}
 
+        t, x, y, z, nums = self._detections(coincidence_events,
+                                            station_numbers, offsets)
+        theta, phi = self._reconstruct_detections(t, x, y, z, initial)
+
+        return theta, phi, nums
+
+    def _detections(self, coincidence_events, station_numbers, offsets):
+        """Get the arrival times and positions of the stations
+
+        :param coincidence_events: a coincidence list consisting of three
+            or more (station_number, event) tuples.
+        :param station_numbers: list of station numbers, to only use
+            events from those stations.
+        :param offsets: a dictionary of either lists of detector timing
+            offsets or :class:`~sapphire.api.Station` objects for each station.
+        :return: lists of arrival times, x, y, and z positions, and station
+                 numbers of the stations with an arrival time.
+
+        """
+        t, x, y, z, nums = ([], [], [], [], [])
+        if len(coincidence_events) < 3:
+            return t, x, y, z, nums
+
         # Subtract base timestamp to prevent loss of precision
         ts0 = int(coincidence_events[0][1]['timestamp'])
         ets0 = ts0 * int(1e9)
         self.cluster.set_timestamp(ts0)
-        t, x, y, z, nums = ([], [], [], [], [])
 
         offsets = self.get_station_offsets(coincidence_events, station_numbers,
                                            offsets, ts0)
@@ -190,6 +339,17 @@ class CoincidenceDirectionReconstruction(object):
                 z.append(sz)
                 nums.append(station_number)
 
+        return t, x, y, z, nums
+
+    def _reconstruct_detections(self, t, x, y, z, initial):
+        """Reconstruct the direction using the appropriate algorithm
+
+        :param t: arrival times in ns.
+        :param x,y,z: positions in m.
+        :param initial: dictionary with already fitted shower parameters.
+        :return: theta and phi.
+
+        """
         if len(t) >= 3 and 'core_x' in initial and 'core_y' in initial:
             theta, phi = self.curved.reconstruct_common(t, x, y, z, initial)
         elif len(t) == 3:
@@ -199,7 +359,7 @@ class CoincidenceDirectionReconstruction(object):
         else:
             theta, phi = (nan, nan)
 
-        return theta, phi, nums
+        return theta, phi
 
     def reconstruct_coincidences(self, coincidences, station_numbers=None,
                                  offsets=None, progress=True, initials=None):
@@ -233,6 +393,98 @@ class CoincidenceDirectionReconstruction(object):
             theta, phi, nums = ((), (), ())
         return theta, phi, nums
 
+    def reconstruct_coincidences_batch(self, coincidences,
+                                       station_numbers=None, offsets=None,
+                                       progress=True, initials=None,
+                                       chunk_size=10000):
+        """Reconstruct all coincidences in chunks
+
+        Gives the same results as :meth:`reconstruct_coincidences`.  The
+        arrival times and positions are collected for a chunk of
+        coincidences, then all coincidences with the same number of
+        detections are reconstructed with a single call to the
+        ``reconstruct_common_batch`` method of the direct or fit
+        algorithm.  Algorithms without that method, and the curved
+        algorithm, reconstruct the coincidences one by one.
+
+        :param coincidences: a list of coincidence events, each consisting
+                             of three or more (station_number, event) tuples.
+        :param station_numbers: list of station numbers, to only use
+                                events from those stations.
+        :param offsets: dictionary with detector offsets for each station.
+                        These detector offsets should be relative to one
+                        detector from a specific station.
+        :param progress: if True show a progress bar while reconstructing.
+        :param initials: list of dictionaries with already reconstructed shower
+                         parameters.
+        :param chunk_size: number of coincidences to reconstruct at once.
+        :return: list of theta, phi, and station numbers.
+
+        """
+        if offsets is None:
+            offsets = {}
+        if initials is None:
+            initials = []
+        coincidences = pbar(coincidences, show=progress)
+        coin_init = zip_longest(coincidences, initials)
+        theta, phi, nums = [], [], []
+        while True:
+            chunk = list(islice(coin_init, chunk_size))
+            if not chunk:
+                break
+            detections = [self._detections(coincidence, station_numbers,
+                                           offsets)
+                          for coincidence, _ in chunk]
+            chunk_initials = [{} if initial is None else initial
+                              for _, initial in chunk]
+            angles = self._reconstruct_detections_batch(detections,
+                                                        chunk_initials)
+            theta.extend(angles[0])
+            phi.extend(angles[1])
+            nums.extend(detection[4] for detection in detections)
+        return tuple(theta), tuple(phi), tuple(nums)
+
+    def _reconstruct_detections_batch(self, detections, initials):
+        """Reconstruct the directions of many coincidences
+
+        Vectorized version of :meth:`_reconstruct_detections`.
+
+        :param detections: list with the arrival times and x, y, and z
+                           positions for each coincidence.
+        :param initials: list of dictionaries with already fitted shower
+                         parameters.
+        :return: arrays of theta and phi.
+
+        """
+        n_detections = array([len(detection[0]) for detection in detections],
+                             dtype=int)
+        theta = full(len(detections), nan)
+        phi = full(len(detections), nan)
+
+        curved = array([n >= 3 and 'core_x' in initial and 'core_y' in initial
+                        for n, initial in zip(n_detections, initials)],
+                       dtype=bool)
+        for i in curved.nonzero()[0]:
+            theta[i], phi[i] = self._reconstruct_detections(
+                *(detections[i][:4] + (initials[i],)))
+
+        for n in unique(n_detections[~curved]):
+            if n < 3:
+                continue
+            algorithm = self.direct if n == 3 else self.fit
+            rows = ((n_detections == n) & ~curved).nonzero()[0]
+            if hasattr(algorithm, 'reconstruct_common_batch'):
+                t, x, y, z = [array([detections[i][j] for i in rows],
+                                    dtype=float) for j in range(4)]
+                theta[rows], phi[rows] = algorithm.reconstruct_common_batch(
+                    t, x, y, z)
+                continue
+            for i in rows:
+                theta[i], phi[i] = self._reconstruct_detections(
+                    *(detections[i][:4] + (initials[i],)))
+
+        return theta, phi
+
     def get_station_offsets(self, coincidence_events, station_numbers,
                             offsets, ts0):
         if offsets and isinstance(next(itervalues(offsets)), Station):
@@ -349,9 +601,8 @@ class CoincidenceDirectionReconstructionDetectors(
 
     """
 
-    def reconstruct_coincidence(self, coincidence_events, station_numbers=None,
-                                offsets=None, initial=None):
-        """Reconstruct a single coincidence
+    def _detections(self, coincidence_events, station_numbers, offsets):
+        """Get the arrival times and positions of the detectors
 
         :param coincidence_events: a coincidence list consisting of one
                                    or more (station_number, event) tuples.
@@ -360,22 +611,18 @@ class CoincidenceDirectionReconstructionDetectors(
         :param offsets: dictionary with detector offsets for each station.
                         These detector offsets should be relative to one
                         detector from a specific station.
-        :param initial: dictionary with already fitted shower parameters.
-        :return: list of theta, phi, and station numbers.
+        :return: lists of arrival times, x, y, and z positions, and station
+                 numbers of the stations with an arrival time.
 
         """
+        t, x, y, z, nums = ([], [], [], [], [])
         if len(coincidence_events) < 1:
-            return nan, nan, []
-        if offsets is None:
-            offsets = {}
-        if initial is None:
-            initial = {}
+            return t, x, y, z, nums
 
         # Subtract base timestamp to prevent loss of precision
         ts0 = int(coincidence_events[0][1]['timestamp'])
         ets0 = ts0 * int(1e9)
         self.cluster.set_timestamp(ts0)
-        t, x, y, z, nums = ([], [], [], [], [])
 
         offsets = self.get_station_offsets(coincidence_events, station_numbers,
                                            offsets, ts0)
@@ -399,16 +646,7 @@ class CoincidenceDirectionReconstructionDetectors(
             if not all(isnan(t_detectors)):
                 nums.append(station_number)
 
-        if len(t) >= 3 and 'core_x' in initial and 'core_y' in initial:
-            theta, phi = self.curved.reconstruct_common(t, x, y, z, initial)
-        elif len(t) == 3:
-            theta, phi = self.direct.reconstruct_common(t, x, y, z, initial)
-        elif len(t) > 3:
-            theta, phi = self.fit.reconstruct_common(t, x, y, z, initial)
-        else:
-            theta, phi = (nan, nan)
-
-        return theta, phi, nums
+        return t, x, y, z, nums
 
 
 class BaseDirectionAlgorithm(object):
@@ -701,6 +939,53 @@ class DirectAlgorithmCartesian(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def reconstruct_common_batch(cls, t, x, y, z=None):
+        """Reconstruct angles from 3 detections for many events
+
+        Vectorized version of :meth:`reconstruct_common`.
+
+        :param t: arrival times in detector 0, 1 and 2 in ns, array with
+                  a row for each event.
+        :param x,y: positions of detector 0, 1 and 2 in m, arrays with a
+                    row for each event or a single row for all events.
+        :param z: height of detectors 0, 1 and 2 is ignored.
+        :return: arrays of reconstructed theta and phi angles.
+
+        """
+        t, x, y = _relative_to_first_detection(t, x, y)
+        return cls.reconstruct_batch(t[..., 1], t[..., 2], x[..., 1],
+                                     x[..., 2], y[..., 1], y[..., 2])
+
+    @staticmethod
+    def reconstruct_batch(dt1, dt2, dx1, dx2, dy1, dy2):
+        """Reconstruct angles from 3 detections for many events
+
+        Vectorized version of :meth:`reconstruct`, the results are nan in
+        the same cases.
+
+        :param dt#: arrays of arrival times in detector 1 and 2 relative
+                    to detector 0 in ns.
+        :param dx#,dy#: position of detector 1 and 2 relative to
+                        detector 0 in m, arrays or values for all events.
+        :return: arrays of theta and phi.
+
+        """
+        dt1, dt2, dx1, dx2, dy1, dy2 = broadcast_arrays(dt1, dt2, dx1, dx2,
+                                                        dy1, dy2)
+        ux = c * (dt2 * dx1 - dt1 * dx2)
+        uy = c * (dt2 * dy1 - dt1 * dy2)
+
+        vz = dx1 * dy2 - dx2 * dy1
+
+        with errstate(invalid='ignore', divide='ignore'):
+            uvzsqrt = sqrt((ux * ux + uy * uy) / (vz * vz))
+            valid = (vz != 0) & (uvzsqrt <= 1.0)
+            theta = where(valid, arcsin(uvzsqrt), nan)
+            phi = where(valid, arctan2(-ux * vz, uy * vz), nan)
+
+        return theta, phi
+
 
 class DirectAlgorithmCartesian3D(BaseDirectionAlgorithm):
 
@@ -794,6 +1079,77 @@ class DirectAlgorithmCartesian3D(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def reconstruct_common_batch(cls, t, x, y, z=None):
+        """Reconstruct angles from 3 detections for many events
+
+        Vectorized version of :meth:`reconstruct_common`.
+
+        :param t: arrival times in detector 0, 1 and 2 in ns, array with
+                  a row for each event.
+        :param x,y,z: positions of detector 0, 1 and 2 in m, arrays with
+                      a row for each event or a single row for all events.
+        :return: arrays of reconstructed theta and phi angles.
+
+        """
+        if z is None:
+            z = zeros(3)
+        t, x, y, z = _relative_to_first_detection(t, x, y, z)
+        return cls.reconstruct_batch(t[..., 1], t[..., 2], x[..., 1],
+                                     x[..., 2], y[..., 1], y[..., 2],
+                                     z[..., 1], z[..., 2])
+
+    @staticmethod
+    def reconstruct_batch(dt1, dt2, dx1, dx2, dy1, dy2, dz1=0, dz2=0):
+        """Reconstruct angles from 3 detections for many events
+
+        Vectorized version of :meth:`reconstruct`, the results are nan in
+        the same cases.
+
+        :param dt#: arrays of arrival times in detector 1 and 2 relative
+                    to detector 0 in ns.
+        :param dx#,dy#,dz#: position of detector 1 and 2 relative to
+                            detector 0 in m, arrays or values for all
+                            events.
+        :return: arrays of theta and phi.
+
+        """
+        dt1, dt2, dx1, dx2, dy1, dy2, dz1, dz2 = broadcast_arrays(
+            dt1, dt2, dx1, dx2, dy1, dy2, dz1, dz2)
+        d1 = stack([dx1, dy1, dz1], axis=-1)
+        d2 = stack([dx2, dy2, dz2], axis=-1)
+        u = c * (dt2[..., None] * d1 - dt1[..., None] * d2)
+        v = cross(d1, d2)
+        uxv = cross(u, v)
+
+        usquared = (u * u).sum(axis=-1)
+        vsquared = (v * v).sum(axis=-1)
+        underroot = vsquared - usquared
+
+        with errstate(invalid='ignore', divide='ignore'):
+            term = v * sqrt(underroot)[..., None]
+            nplus = (uxv + term) / vsquared[..., None]
+            nmin = (uxv - term) / vsquared[..., None]
+
+            phiplus = arctan2(nplus[..., 1], nplus[..., 0])
+            thetaplus = arccos(nplus[..., 2])
+
+            phimin = arctan2(nmin[..., 1], nmin[..., 0])
+            thetamin = arccos(nmin[..., 2])
+
+            thetaplus = where(isnan(thetaplus), pi, thetaplus)
+            thetamin = where(isnan(thetamin), pi, thetamin)
+
+            # Allow solution only if it is the only one above horizon
+            valid = (underroot > 0) & (vsquared != 0)
+            plus = valid & (thetaplus <= pi / 2.) & (thetamin > pi / 2.)
+            minus = valid & (thetaplus > pi / 2.) & (thetamin <= pi / 2.)
+
+        theta = where(plus, thetaplus, where(minus, thetamin, nan))
+        phi = where(plus, phiplus, where(minus, phimin, nan))
+
+        return theta, phi
+
 
 class SphereAlgorithm(object):
 
@@ -1090,6 +1446,77 @@ class RegressionAlgorithm(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def reconstruct_common_batch(cls, t, x, y, z=None, mask=None):
+        """Reconstruct angles from 3 or more detections for many events
+
+        Vectorized version of :meth:`reconstruct_common`.
+
+        :param t: arrival times of the detectors in ns, array with a row
+                  for each event.
+        :param x,y,z: positions of the detectors in m, arrays with a row
+                      for each event or a single row for all events. The
+                      height is ignored.
+        :param mask: boolean array like t, only the detections which are
+                     True are used.  By default all detections are used.
+        :return: arrays of reconstructed theta and phi angles.
+
+        """
+        return cls.reconstruct_batch(t, x, y, mask)
+
+    @classmethod
+    def reconstruct_batch(cls, t, x, y, mask=None):
+        """Reconstruct angles for many detections for many events
+
+        Vectorized version of :meth:`reconstruct`, the results are nan in
+        the same cases.  Events with different numbers of detections can
+        be combined by padding the arrays and masking the padding.
+
+        :param t: arrival times in the detectors in ns.
+        :param x,y: positions of the detectors in m.
+        :param mask: boolean array like t, only the detections which are
+                     True are used.  By default all detections are used.
+        :return: arrays of theta and phi.
+
+        """
+        t, x, y = broadcast_arrays(*[asarray(value, dtype=float)
+                                     for value in (t, x, y)])
+        if mask is None:
+            mask = ones(t.shape, dtype=bool)
+        passed = logic_checks_batch(t, x, y, zeros(t.shape), mask)
+        t, x, y = [where(mask, value, 0.) for value in (t, x, y)]
+
+        k = mask.sum(axis=-1)
+        xs = x.sum(axis=-1)
+        ys = y.sum(axis=-1)
+        ts = t.sum(axis=-1)
+
+        xx = (x * x).sum(axis=-1)
+        yy = (y * y).sum(axis=-1)
+        tx = (t * x).sum(axis=-1)
+        ty = (t * y).sum(axis=-1)
+        xy = (x * y).sum(axis=-1)
+
+        denom = (k * xy ** 2 + xs ** 2 * yy + ys ** 2 * xx - k * xx * yy -
+                 2 * xs * ys * xy)
+        denom = where(denom == 0, nan, denom)
+
+        numer = (tx * (k * yy - ys ** 2) + xy * (ts * ys - k * ty) +
+                 xs * ys * ty - ts * xs * yy)
+        nx = c * numer / denom
+
+        numer = (ty * (k * xx - xs ** 2) + xy * (ts * xs - k * tx) +
+                 xs * ys * tx - ts * ys * xx)
+        ny = c * numer / denom
+
+        with errstate(invalid='ignore'):
+            valid = passed & (nx ** 2 + ny ** 2 <= 1.)
+            nz = sqrt(1 - nx ** 2 - ny ** 2)
+        theta = where(valid, arccos(nz), nan)
+        phi = where(valid, arctan2(ny, nx), nan)
+
+        return theta, phi
+
 
 class RegressionAlgorithm3D(BaseDirectionAlgorithm):
 
@@ -1156,6 +1583,78 @@ class RegressionAlgorithm3D(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def reconstruct_common_batch(cls, t, x, y, z=None, mask=None):
+        """Reconstruct angles from 3 or more detections for many events
+
+        Vectorized version of :meth:`reconstruct_common`.
+
+        :param t: arrival times of the detectors in ns, array with a row
+                  for each event.
+        :param x,y,z: positions of the detectors in m, arrays with a row
+                      for each event or a single row for all events. The
+                      height for all detectors will be set to 0 if not
+                      given.
+        :param mask: boolean array like t, only the detections which are
+                     True are used.  By default all detections are used.
+        :return: arrays of reconstructed theta and phi angles.
+
+        """
+        if z is None:
+            z = zeros(asarray(x).shape)
+
+        return cls.reconstruct_batch(t, x, y, z, mask)
+
+    @classmethod
+    def reconstruct_batch(cls, t, x, y, z, mask=None):
+        """Reconstruct angles for many detections for many events
+
+        Vectorized version of :meth:`reconstruct`, the results are nan in
+        the same cases.  Each iteration projects the detections of all
+        events which have not yet converged, converged events are no
+        longer updated.
+
+        :param t: arrival times in the detectors in ns.
+        :param x,y,z: positions of the detectors in m.
+        :param mask: boolean array like t, only the detections which are
+                     True are used.  By default all detections are used.
+        :return: arrays of theta and phi.
+
+        """
+        t, x, y, z = broadcast_arrays(*[asarray(value, dtype=float)
+                                        for value in (t, x, y, z)])
+        if mask is None:
+            mask = ones(t.shape, dtype=bool)
+
+        theta, phi = RegressionAlgorithm.reconstruct_batch(t, x, y, mask)
+        passed = logic_checks_batch(t, x, y, z, mask)
+        theta[~passed] = nan
+        phi[~passed] = nan
+
+        # Events for which the reconstruction failed are done
+        active = ~isnan(theta)
+        for _ in range(cls.MAX_ITERATIONS):
+            idx = active.nonzero()[0]
+            if not len(idx):
+                break
+            nxnz = (tan(theta[idx]) * cos(phi[idx]))[:, None]
+            nynz = (tan(theta[idx]) * sin(phi[idx]))[:, None]
+            nz = cos(theta[idx])[:, None]
+            x_proj = x[idx] - z[idx] * nxnz
+            y_proj = y[idx] - z[idx] * nynz
+            t_proj = t[idx] + z[idx] / (c * nz)
+            theta_prev = theta[idx]
+            theta[idx], phi[idx] = RegressionAlgorithm.reconstruct_batch(
+                t_proj, x_proj, y_proj, mask[idx])
+            with errstate(invalid='ignore'):
+                active[idx] = abs(theta[idx] - theta_prev) > 0.001
+
+        # No convergence within the maximum number of iterations
+        theta[active] = nan
+        phi[active] = nan
+
+        return theta, phi
+
 
 class CurvedMixin(object):
 
@@ -1414,5 +1913,92 @@ def logic_checks(t, x, y, z):
     return True
 
 
+def logic_checks_batch(t, x, y, z, mask=None):
+    """Check for impossible reconstructions of many events
+
+    Vectorized version of :func:`logic_checks`, for arrays with a row for
+    each event and a column for each detection.
+
+    :param t: arrival times in the detectors in ns.
+    :param x,y,z: positions of the detectors in m.
+    :param mask: boolean array like t, only the detections which are
+                 True are checked.  By default all detections are used.
+    :return: boolean array, True if the checks pass for an event.
+
+    """
+    t, x, y, z = broadcast_arrays(*[asarray(value, dtype=float)
+                                    for value in (t, x, y, z)])
+    if mask is None:
+        mask = ones(t.shape, dtype=bool)
+    n_detections = t.shape[-1]
+    three = mask.sum(axis=-1) == 3
+    passed = ones(t.shape[:-1], dtype=bool)
+
+    with errstate(invalid='ignore', divide='ignore'):
+        # Check for identical positions and if the time difference is
+        # larger than expected by c, if there are three detections.
+        for i, j in combinations(range(n_detections), 2):
+            pair = three & mask[..., i] & mask[..., j]
+            dx = x[..., i] - x[..., j]
+            dy = y[..., i] - y[..., j]
+            dz = z[..., i] - z[..., j]
+            same = (dx == 0) & (dy == 0) & (dz == 0)
+            dt_max = vector_length(dx, dy, dz) / c
+            passed &= ~(pair & (same | (dt_max < abs(t[..., i] - t[..., j]))))
+
+        # Check if all the positions are (almost) on a single line
+        largest_of_smallest_angles = zeros(passed.shape)
+        for i, j, k in combinations(range(n_detections), 3):
+            triangle = mask[..., i] & mask[..., j] & mask[..., k]
+            dx1 = x[..., i] - x[..., j]
+            dy1 = y[..., i] - y[..., j]
+            dz1 = z[..., i] - z[..., j]
+            dx2 = x[..., i] - x[..., k]
+            dy2 = y[..., i] - y[..., k]
+            dz2 = z[..., i] - z[..., k]
+            lenvec01 = vector_length(dx1, dy1, dz1)
+            lenvec02 = vector_length(dx2, dy2, dz2)
+            lenvec12 = vector_length(dx2 - dx1, dy2 - dy1, dz2 - dz1)
+
+            # area triangle is |cross product|
+            area = abs(dx1 * dy2 - dx2 * dy1 + dy1 * dz2 - dy2 * dz1 +
+                       dz1 * dx2 - dz2 * dx1)
+
+            # prevent floating point errors
+            passed &= ~(triangle & (area < 1e-7))
+
+            # smallest sine of the angles, the area divided by two sides
+            smallest_angle = minimum.reduce([area / lenvec01 / lenvec02,
+                                             area / lenvec01 / lenvec12,
+                                             area / lenvec02 / lenvec12])
+            largest_of_smallest_angles = where(
+                triangle & (smallest_angle > largest_of_smallest_angles),
+                smallest_angle, largest_of_smallest_angles)
+
+    # discard reconstruction if the largest of the smallest angles of each
+    # triangle is smaller than 0.1 rad (5.73 degrees)
+    passed &= largest_of_smallest_angles >= 0.1
+
+    return passed
+
+
+def _relative_to_first_detection(*values):
+    """Make the values relative to those of the first detection
+
+    Vectorized version of :func:`~sapphire.utils.make_relative` for the
+    arrival times and positions of many events, with a column for each
+    detection.  Only the first three detections are used, as in the
+    scalar algorithms.
+
+    :param values: arrays with a column for each detection.
+    :return: arrays relative to the first column.
+
+    """
+    values = [asarray(value, dtype=float) for value in values]
+    if any(value.shape[-1] > 3 for value in values):
+        warning_only_three()
+    return [value[..., :3] - value[..., :1] for value in values]
+
+
 def warning_only_three():
     warnings.warn('Only the first three detections will be used')
@@ -29,16 +29,19 @@
 """
 import zlib
 
-import operator
 import os
+import tempfile
 import warnings
+from collections import namedtuple
+from contextlib import contextmanager
 
 import tables
 import numpy as np
 from six.moves import range, zip
 
 from ..api import Station
-from ..utils import pbar, ERR
+from ..utils import (pbar, get_active_indexes, use_worker_processes,
+                     worker_pool, ERR)
 from .find_mpv import FindMostProbableValueInSpectrum
 from .process_traces import (ADC_TIME_PER_SAMPLE, ADC_LOW_THRESHOLD,
                              ADC_HIGH_THRESHOLD)
@@ -53,6 +56,13 @@ TRIGGER_2 = (2, 0, False, 0)
 #: 3 low or 2 high, no external
 TRIGGER_4 = (3, 2, True, 0)
 
+#: Number of events for which the traces are decoded at once
+TRACE_CHUNK_SIZE = 1000
+#: Number of events for which other columns are processed at once
+CHUNK_SIZE = 100000
+#: Tables with more rows are sorted out of core when cleaning
+MAX_ROWS_SORTED_IN_MEMORY = 10 ** 7
+
 
 class ProcessEvents(object):
 
@@ -88,6 +98,14 @@ class ProcessEvents(object):
         'n4': tables.Float32Col(pos=20, dflt=-1),
         't_trigger': tables.Float32Col(pos=21, dflt=-1)}
 
+    #: Number of worker processes used to process traces.  None means all
+    #: events are processed in the current process.
+    workers = None
+
+    #: Histograms of the pulseintegrals of previously processed events,
+    #: used when processing events incrementally.
+    _previous_histograms = None
+
     def __init__(self, data, group, source=None, progress=True):
         """Initialize the class.
 
@@ -107,17 +125,50 @@ class ProcessEvents(object):
         self.limit = None
 
     def process_and_store_results(self, destination=None, overwrite=False,
-                                  limit=None):
+                                  limit=None, workers=None, incremental=False):
         """Process events and store the results.
 
+        When processing incrementally only the events which were appended
+        to the source since the previous run are cleaned, processed and
+        merged into the existing results.  The number of processed source
+        events and the last ext_timestamp are stored in the attributes of
+        the results table.  If those are not available all events are
+        processed.  The number of particles depends on the MPVs fitted to
+        the pulseintegrals of all events, so those columns are updated for
+        all rows, the results are the same as when processing all events.
+
+        If the results replace the source events table, the source is
+        renamed to '_events' and new events should be appended to that
+        table.  Functions like :func:`sapphire.publicdb.download_data`
+        append to 'events', which then are the results.  Incremental
+        processing raises a RuntimeError if the results table contains
+        rows which were not stored by processing events.
+
         :param destination: name of the table where the results will be
             written.  The default, None, corresponds to 'events'.
         :param overwrite: if True, overwrite previously obtained results.
         :param limit: the maximum number of events that will be stored.
             The default, None, corresponds to no limit.
+        :param workers: the number of worker processes used to process the
+            traces.  The events are split into shards which are processed
+            in parallel.  The default, None, processes all events in the
+            current process.
+        :param incremental: if True, only process events which were added
+            since the previous run.
 
         """
         self.limit = limit
+        self.workers = workers
+
+        if incremental:
+            if limit is not None:
+                raise RuntimeError("Incremental processing can not be "
+                                   "combined with a limit.")
+            results = self._get_results_table(destination)
+            if (results is not None and
+                    'processed_source_events' in results.attrs):
+                self._process_new_events(results)
+                return
 
         self._check_destination(destination, overwrite)
 
@@ -128,6 +179,9 @@ class ProcessEvents(object):
         self._store_number_of_particles()
         self._move_results_table_into_destination()
 
+        if limit is None:
+            self._store_watermark(self._tmp_events)
+
     def get_traces_for_event(self, event):
         """Return the traces from an event.
 
@@ -135,12 +189,11 @@ class ProcessEvents(object):
         :return: the traces: an array of pulseheight values.
 
         """
-        traces = [list(self._get_trace(idx)) for idx in event['traces']
-                  if idx >= 0]
+        trace_idx = event['traces']
+        traces = self._get_traces(trace_idx[trace_idx >= 0])
 
         # Make traces follow NumPy conventions
-        traces = np.array(traces).T
-        return traces
+        return traces.T
 
     def get_traces_for_event_index(self, idx):
         """Return the traces from event #idx.
@@ -152,6 +205,17 @@ class ProcessEvents(object):
         event = self.source[idx]
         return self.get_traces_for_event(event)
 
+    def get_traces_for_events(self, events):
+        """Return the traces from many events at once.
+
+        :param events: array of rows from the events table.
+        :return: the traces: an array of pulseheight values with the
+                 shape (events, detectors, samples).  Missing traces and
+                 samples beyond the end of shorter traces are -1.
+
+        """
+        return self._get_traces(events['traces'])
+
     def _get_source(self, source):
         """Return the table containing the events.
 
@@ -196,28 +260,116 @@ class ProcessEvents(object):
         """
         events = self.source
 
-        enumerated_timestamps = list(enumerate(events.col('ext_timestamp')))
-        enumerated_timestamps.sort(key=operator.itemgetter(1))
-
-        unique_sorted_ids = self._find_unique_row_ids(enumerated_timestamps)
-
-        new_events = self._replace_table_with_selected_rows(events,
-                                                            unique_sorted_ids)
+        with self._sorted_unique_row_ids(events,
+                                         'ext_timestamp') as row_ids:
+            new_events = self._replace_table_with_selected_rows(events,
+                                                                row_ids)
         self.source = new_events
         self._normalize_event_ids(new_events)
 
-    def _find_unique_row_ids(self, enumerated_timestamps):
-        """Find the unique row_ids from enumerated timestamps."""
+    @staticmethod
+    def _find_sorted_unique_row_ids(values):
+        """Find the unique row ids, sorted by value.
+
+        Of duplicate values the first row is kept.  Rows with a value of 0
+        are removed.
 
-        prev_timestamp = 0
-        unique_sorted_ids = []
-        for row_id, timestamp in enumerated_timestamps:
-            if timestamp != prev_timestamp:
-                # event is unique, so add it
-                unique_sorted_ids.append(row_id)
-            prev_timestamp = timestamp
+        :param values: array of values for each row.
+        :return: array of row ids.
+
+        """
+        row_ids = np.argsort(values, kind='mergesort')
+        sorted_values = values[row_ids]
+        is_unique = np.empty(len(sorted_values), dtype=bool)
+        is_unique[:1] = sorted_values[:1] != 0
+        is_unique[1:] = sorted_values[1:] != sorted_values[:-1]
+        return row_ids[is_unique]
 
-        return unique_sorted_ids
+    @contextmanager
+    def _sorted_unique_row_ids(self, table, colname):
+        """Provide the unique row ids of a table, sorted by a column.
+
+        Tables with more than :data:`MAX_ROWS_SORTED_IN_MEMORY` rows are
+        sorted out of core, in a temporary file.
+
+        :param table: the table to sort.
+        :param colname: name of the column by which to sort.
+        :return: context manager providing an array of row ids.
+
+        """
+        if len(table) <= MAX_ROWS_SORTED_IN_MEMORY:
+            yield self._find_sorted_unique_row_ids(table.col(colname))
+        else:
+            fd, path = tempfile.mkstemp('.h5')
+            os.close(fd)
+            try:
+                with tables.open_file(path, 'w') as sortfile:
+                    yield self._sort_out_of_core(table, colname, sortfile)
+            finally:
+                os.remove(path)
+
+    def _sort_out_of_core(self, table, colname, sortfile):
+        """Find the sorted unique row ids of a large table.
+
+        The values and row ids are copied to a table on which a completely
+        sorted index is created.  The sorted values are then read in chunks
+        to find the unique row ids.
+
+        :param table: the table to sort.
+        :param colname: name of the column by which to sort.
+        :param sortfile: PyTables file in which to store temporary data.
+        :return: array in the sortfile containing the row ids.
+
+        """
+        n_rows = len(table)
+        # PyTables can not index unsigned 64-bit integers, timestamps fit in
+        # a signed 64-bit integer.
+        description = np.dtype([('value', np.int64), ('row_id', np.int64)])
+
+        values = sortfile.create_table('/', 'values', description,
+                                       expectedrows=n_rows)
+        for start in range(0, n_rows, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_rows)
+            chunk = np.empty(stop - start, dtype=description)
+            chunk['value'] = table.read(start, stop, field=colname)
+            chunk['row_id'] = np.arange(start, stop)
+            values.append(chunk)
+        values.flush()
+        values.cols.value.create_csindex()
+
+        row_ids = sortfile.create_earray('/', 'row_ids', tables.Int64Atom(),
+                                         (0,), expectedrows=n_rows)
+        pending = np.empty(0, dtype=description)
+        for start in range(0, n_rows, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_rows)
+            chunk = values.read_sorted('value', start=start, stop=stop)
+            chunk = np.concatenate([pending, chunk])
+            if stop < n_rows:
+                # Duplicates of the last value may be in the next chunk
+                is_last = chunk['value'] == chunk['value'][-1]
+                pending = chunk[is_last]
+                chunk = chunk[~is_last]
+            # The index does not order the row ids of duplicate values
+            chunk.sort(order=['value', 'row_id'])
+            unique_ids = self._find_sorted_unique_row_ids(chunk['value'])
+            row_ids.append(chunk['row_id'][unique_ids])
+        row_ids.flush()
+
+        return row_ids
+
+    def _copy_selected_rows(self, table, new_table, row_ids):
+        """Copy selected rows into a new table, in chunks.
+
+        :param table: original table.
+        :param new_table: table to which the selected rows are appended.
+        :param row_ids: array of row ids of the selected rows.
+
+        """
+        for start in range(0, len(row_ids), CHUNK_SIZE):
+            selected_rows = table.read_coordinates(
+                row_ids[start:start + CHUNK_SIZE])
+            new_table.append(selected_rows)
+        new_table.flush()
 
     def _replace_table_with_selected_rows(self, table, row_ids):
         """Replace events table with selected rows.
@@ -228,10 +380,9 @@ class ProcessEvents(object):
 
         """
         tmptable = self.data.create_table(self.group, 't__events',
-                                          description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        tmptable.append(selected_rows)
-        tmptable.flush()
+                                          description=table.description,
+                                          expectedrows=len(row_ids))
+        self._copy_selected_rows(table, tmptable, row_ids)
         self.data.rename_node(tmptable, table.name, overwrite=True)
         return tmptable
 
@@ -246,8 +397,11 @@ class ProcessEvents(object):
         :param events: the events table to normalize.
 
         """
-        row_ids = list(range(len(events)))
-        events.modify_column(column=row_ids, colname='event_id')
+        n_events = len(events)
+        for start in range(0, n_events, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_events)
+            events.modify_column(start, stop, colname='event_id',
+                                 column=np.arange(start, stop))
 
     def _create_results_table(self):
         """Create results table containing the events."""
@@ -284,10 +438,11 @@ class ProcessEvents(object):
                                 column=getattr(source.cols, col)[:self.limit])
         table.flush()
 
-    def _store_results_from_traces(self):
+    def _store_results_from_traces(self, timings=None):
         table = self._tmp_events
 
-        timings = self.process_traces()
+        if timings is None:
+            timings = self.process_traces()
 
         # Assign values to full table, column-wise.
         for idx in range(4):
@@ -296,56 +451,179 @@ class ProcessEvents(object):
         table.flush()
 
     def process_traces(self):
-        """Process traces to yield pulse timing information."""
+        """Process traces to yield pulse timing information.
 
+        If more than one worker is requested the events are split into
+        shards which are processed by separate processes.
+
+        """
+        n_events = self._get_number_of_events()
+
+        if use_worker_processes(self.workers):
+            timings = self._process_traces_in_workers(n_events)
+        else:
+            chunks = self._read_event_chunks(0, n_events)
+            timings = self._process_traces_from_event_chunks(chunks,
+                                                             n_events)
+        return timings
+
+    def _get_number_of_events(self):
+        """Get the number of events to process"""
+
+        n_events = len(self.source)
         if self.limit is not None:
-            events = self.source.iterrows(stop=self.limit)
+            n_events = min(self.limit, n_events)
+        return n_events
+
+    def _read_event_chunks(self, start, stop, chunk_size=None):
+        """Read the events to process in chunks
+
+        :param start,stop: the range of events to read.
+        :param chunk_size: number of events in a chunk, by default
+                           :data:`TRACE_CHUNK_SIZE`.
+        :return: generator of arrays of events.
+
+        """
+        if chunk_size is None:
+            chunk_size = TRACE_CHUNK_SIZE
+        return (self.source.read(i, min(i + chunk_size, stop))
+                for i in range(start, stop, chunk_size))
+
+    def _process_traces_in_workers(self, n_events):
+        """Process traces in shards using multiple worker processes.
+
+        The workers open the HDF5 files read-only and each process a range
+        of events.  The results are combined in the original order.
+
+        :param n_events: the number of events to process.
+
+        """
+        shards = self._get_worker_shards(n_events)
+
+        with worker_pool(self.workers, files=[self.data]) as pool:
+            result = list(pbar(pool.imap(_process_traces_in_worker, shards),
+                               length=len(shards), show=self.progress))
+
+        if result:
+            timings = np.concatenate(result)
         else:
-            events = self.source
+            timings = np.array(result)
 
-        timings = self._process_traces_from_event_list(events,
-                                                       length=self.limit)
         return timings
 
-    def _process_traces_from_event_list(self, events, length=None):
-        """Process traces from a list of events.
+    def _get_worker_shards(self, n_events):
+        """Split the events into shards for the worker processes
+
+        :param n_events: the number of events to process.
+        :return: list of shards for :func:`_process_traces_in_worker`.
+
+        """
+        # The workers import this module anew, so pass the chunk size
+        chunk_size = TRACE_CHUNK_SIZE
+        n_chunks = -(-n_events // chunk_size)
+        # Several shards per worker to spread the load
+        chunks_per_shard = max(-(-n_chunks // (4 * self.workers)), 1)
+        shard_size = chunks_per_shard * chunk_size
+
+        state = self._get_worker_state()
+        return [(self.__class__, state, start,
+                 min(start + shard_size, n_events), chunk_size)
+                for start in range(0, n_events, shard_size)]
+
+    def _get_worker_state(self):
+        """Get the attributes needed to recreate this object in a worker
 
-        This is the method looping over all events.
+        Files and nodes are replaced by references, so the workers can
+        open them.
 
-        :param events: an iterable of the events
-        :param length: an indication of the number of events, for use as a
-            progress bar.  Optional.
+        :return: dictionary of attributes.
 
         """
+        state = {}
+        for key, value in vars(self).items():
+            if isinstance(value, tables.File):
+                value = _NodeReference(value.filename, None)
+            elif isinstance(value, tables.Node):
+                value = _NodeReference(value._v_file.filename,
+                                       value._v_pathname)
+            state[key] = value
+        return state
+
+    def _process_traces_from_event_chunks(self, chunks, length):
+        """Process traces from chunks of events.
+
+        This is the method looping over all chunks.  The traces of all
+        events in a chunk are decoded and processed at once.
+
+        :param chunks: an iterable of arrays of events.
+        :param length: the total number of events in the chunks.
+
+        """
+        n_chunks = -(-length // TRACE_CHUNK_SIZE)
+
         result = []
-        for event in pbar(events, length=length, show=self.progress):
-            timings = self._reconstruct_time_from_traces(event)
+        for events in pbar(chunks, length=n_chunks, show=self.progress):
+            traces = self._get_traces(events['traces'])
+            timings = self._reconstruct_time_from_traces_batch(events, traces)
             result.append(timings)
-        timings = np.array(result)
 
+        if result:
+            timings = np.concatenate(result)
+        else:
+            timings = np.array(result)
+
+        return timings
+
+    def _reconstruct_time_from_traces_batch(self, events, traces):
+        """Reconstruct arrival times for a chunk of events.
+
+        This is the vectorized equivalent of
+        :meth:`_reconstruct_time_from_traces`, it gives identical results.
+
+        :param events: array of rows from the events table.
+        :param traces: the decoded traces of the events, as returned by
+            :meth:`_get_traces`.
+        :return: array with the arrival times in the detectors relative to
+                 trace start in ns, for each event.
+
+        """
+        pulseheights = events['pulseheights']
+        times = self._reconstruct_time_from_trace_batch(traces,
+                                                        events['baseline'])
+
+        # retain -1, -999 status flags in timing
+        timings = np.where(pulseheights < 0, pulseheights,
+                           np.where(pulseheights < ADC_THRESHOLD, -999,
+                                    times))
+        timings = np.where(np.isin(timings, ERR), timings,
+                           timings * ADC_TIME_PER_SAMPLE)
         return timings
 
-    def _reconstruct_time_from_traces(self, event):
+    def _reconstruct_time_from_traces(self, event, traces=None):
         """Reconstruct arrival times for a single event.
 
         This method loops over the traces.
 
         :param event: row from the events table.
+        :param traces: the decoded traces of the event, as returned by
+            :meth:`_get_traces`.  If None, they are read from the blobs.
         :return: arrival times in the detectors relative to trace start
                  in ns.
 
         """
+        if traces is None:
+            traces = self._get_traces(event['traces'])
+
         timings = []
-        for baseline, pulseheight, trace_idx in zip(event['baseline'],
-                                                    event['pulseheights'],
-                                                    event['traces']):
+        for baseline, pulseheight, trace in zip(event['baseline'],
+                                                event['pulseheights'],
+                                                traces):
             if pulseheight < 0:
                 # retain -1, -999 status flags in timing
                 timings.append(pulseheight)
             elif pulseheight < ADC_THRESHOLD:
                 timings.append(-999)
             else:
-                trace = self._get_trace(trace_idx)
                 timings.append(self._reconstruct_time_from_trace(trace,
                                                                  baseline))
         timings = [time * ADC_TIME_PER_SAMPLE
@@ -356,27 +634,65 @@ class ProcessEvents(object):
     def _get_trace(self, idx):
         """Returns a trace given an index into the blobs array.
 
-        Decompress a trace from the blobs array.
+        Decompress a trace from the blobs array.  If the decoded traces are
+        stored (see :func:`store_decoded_traces`) the trace is read from
+        there instead.
 
         :param idx: index into the blobs array
         :return: iterator over the pulseheight values
 
         """
+        if self._get_decoded_traces(idx) is not None:
+            trace = self._get_traces(np.array([idx]))[0]
+            return (int(x) for x in trace)
+
         blobs = self._get_blobs()
 
-        try:
-            trace = zlib.decompress(blobs[idx]).decode('utf-8').split(',')
-        except zlib.error:
-            trace = (zlib.decompress(blobs[idx][1:-1])
-                     .decode('utf-8').split(','))
+        trace = _decompress_trace(blobs[idx]).decode('utf-8').split(',')
         if trace[-1] == '':
             del trace[-1]
         trace = (int(x) for x in trace)
         return trace
 
+    def _get_traces(self, trace_idx):
+        """Returns many traces given an array of indexes into the blobs
+
+        The traces are decoded all at once, see :func:`decode_traces`.  If
+        the decoded traces are stored (see :func:`store_decoded_traces`)
+        these are read instead.
+
+        :param trace_idx: array of indexes into the blobs array, usually
+            the traces column of (a selection of) the events table.
+        :return: array of pulseheight values, with an extra last axis for
+                 the samples.
+
+        """
+        trace_idx = np.asarray(trace_idx)
+        decoded_traces = self._get_decoded_traces(trace_idx.max(initial=-1))
+        if decoded_traces is not None:
+            return read_decoded_traces(*decoded_traces, trace_idx=trace_idx)
+        else:
+            return decode_traces(self._get_blobs(), trace_idx)
+
     def _get_blobs(self):
         return self.group.blobs
 
+    def _get_decoded_traces(self, max_idx):
+        """Return the stored decoded traces, if available
+
+        :param max_idx: the largest index into the blobs array which
+            should be available.
+        :return: the decoded traces and offsets arrays, or None if the
+                 traces are not (all) stored.
+
+        """
+        group = self._get_blobs()._v_parent
+        if 'decoded_traces_offsets' in group:
+            offsets = group.decoded_traces_offsets
+            if max_idx < len(offsets) - 1:
+                return group.decoded_traces, offsets
+        return None
+
     def _reconstruct_time_from_trace(self, trace, baseline):
         """Reconstruct time of measurement from a trace.
 
@@ -406,19 +722,57 @@ class ProcessEvents(object):
         """
         return next((i for i, x in enumerate(trace) if x >= threshold), -999)
 
+    def _reconstruct_time_from_trace_batch(self, traces, baselines):
+        """Reconstruct time of measurement from many traces at once.
+
+        :param traces: array of traces, with the samples along the last
+                       axis.
+        :param baselines: array of baselines, one for each trace.
+        :return: indexes in the traces for the arrival time of the first
+                 particle.
+
+        """
+        thresholds = baselines + ADC_THRESHOLD
+        return self.first_above_threshold_batch(traces, thresholds)
+
+    @staticmethod
+    def first_above_threshold_batch(traces, thresholds):
+        """Find the first element in many traces equal or above threshold
+
+        Vectorized version of :meth:`first_above_threshold`.  If no element
+        of a trace matches the condition -999 will be returned for it.
+
+        :param traces: array of traces, with the samples along the last
+                       axis.  Padding values (-1) should be below the
+                       thresholds.
+        :param thresholds: array of thresholds, one for each trace.
+        :return: array of indexes in the traces where a value is greater
+                 or equal to the threshold.
+
+        """
+        thresholds = np.asarray(thresholds)
+        if traces.shape[-1] == 0:
+            return np.full(thresholds.shape, -999, dtype=np.intp)
+        above = traces >= thresholds[..., np.newaxis]
+        return np.where(above.any(axis=-1), above.argmax(axis=-1), -999)
+
     def _store_number_of_particles(self):
         """Store number of particles in the detectors.
 
         Process all pulseintegrals from the events and estimate the number
-        of particles in each detector.
+        of particles in each detector.  The results are written in chunks
+        to keep memory usage bounded.
 
         """
         table = self._tmp_events
 
-        n_particles = self._process_pulseintegrals()
-        for idx in range(4):
-            col = 'n%d' % (idx + 1)
-            table.modify_column(column=n_particles[:, idx], colname=col)
+        all_mpv = self._find_mpvs()
+        names = ['n%d' % (idx + 1) for idx in range(4)]
+        for start, stop in self._iter_chunk_ranges(CHUNK_SIZE):
+            integrals = self.source.read(start, stop, field='integrals')
+            n_particles = self._number_of_particles(integrals, all_mpv)
+            table.modify_columns(start, stop, columns=list(n_particles.T),
+                                 names=names)
         table.flush()
 
     def _process_pulseintegrals(self):
@@ -428,36 +782,255 @@ class ProcessEvents(object):
                  event.
 
         """
-        n_particles = []
+        all_mpv = self._find_mpvs()
+        n_particles = [
+            self._number_of_particles(
+                self.source.read(start, stop, field='integrals'), all_mpv)
+            for start, stop in self._iter_chunk_ranges(CHUNK_SIZE)]
+
+        if n_particles:
+            return np.concatenate(n_particles)
+        else:
+            return np.array(n_particles)
+
+    def _iter_chunk_ranges(self, chunk_size):
+        """Ranges of rows of the events to process, in chunks
+
+        :param chunk_size: maximum number of rows in a chunk.
+        :return: generator of start, stop tuples.
+
+        """
+        n_events = len(self.source)
+        if self.limit is not None:
+            n_events = min(self.limit, n_events)
+        return ((start, min(start + chunk_size, n_events))
+                for start in range(0, n_events, chunk_size))
+
+    def _find_mpvs(self):
+        """Find the MPV of the pulseintegrals of each detector
+
+        The histograms of the pulseintegrals of all events are accumulated
+        in chunks, the MPVs are then fitted once.  When processing events
+        incrementally the histograms of the previously processed events
+        are included.
+
+        :return: array with the MPV for each detector, nan if the MPV
+                 could not be determined.
+
+        """
+        bins = np.linspace(0, 50000, 201)
+        histograms = np.zeros((4, len(bins) - 1), dtype=np.int64)
+        has_integrals = np.zeros(4, dtype=bool)
+
+        n_events = len(self.source)
+        for start in range(0, n_events, CHUNK_SIZE):
+            integrals = self.source.read(start, start + CHUNK_SIZE,
+                                         field='integrals')
+            has_integrals |= (integrals >= 0).any(axis=0)
+            for idx, detector_integrals in enumerate(integrals.T):
+                histograms[idx] += np.histogram(detector_integrals,
+                                                bins=bins)[0]
+
+        if self._previous_histograms is not None:
+            previous_histograms, previous_has_integrals = \
+                self._previous_histograms
+            histograms = histograms + previous_histograms
+            has_integrals = has_integrals | previous_has_integrals
+        self._integral_histograms = histograms, has_integrals
 
-        integrals = self.source.col('integrals')
         all_mpv = []
-        for detector_integrals in integrals.T:
-            if (detector_integrals < 0).all():
+        for n, detector_has_integrals in zip(histograms, has_integrals):
+            if not detector_has_integrals:
                 all_mpv.append(np.nan)
             else:
-                n, bins = np.histogram(detector_integrals,
-                                       bins=np.linspace(0, 50000, 201))
                 find_mpv = FindMostProbableValueInSpectrum(n, bins)
                 mpv, is_fitted = find_mpv.find_mpv()
                 if is_fitted:
                     all_mpv.append(mpv)
                 else:
                     all_mpv.append(np.nan)
-        all_mpv = np.array(all_mpv)
+        return np.array(all_mpv)
+
+    @staticmethod
+    def _number_of_particles(integrals, all_mpv):
+        """Convert pulseintegrals to number of particles
+
+        :param integrals: array of pulseintegrals per detector per event.
+        :param all_mpv: array with the MPV for each detector.
+        :return: array with estimated number of particles per detector per
+                 event.
+
+        """
+        # retain -1, -999 status flags
+        with np.errstate(invalid='ignore'):
+            n_particles = np.where(integrals >= 0, integrals / all_mpv,
+                                   integrals)
+        # if mpv fit failed, value is nan.  Make it -999
+        return np.where(np.isnan(n_particles), -999, n_particles)
+
+    def _get_results_table(self, destination):
+        """Return the table with previous results, if it exists
 
-        for event in self.source[:self.limit]:
-            pulseintegrals = event['integrals']
-            # retain -1, -999 status flags
-            pulseintegrals = np.where(pulseintegrals >= 0,
-                                      pulseintegrals / all_mpv,
-                                      pulseintegrals)
-            # if mpv fit failed, value is nan.  Make it -999
-            pulseintegrals = np.where(np.isnan(pulseintegrals), -999,
-                                      pulseintegrals)
-            n_particles.append(pulseintegrals)
+        :param destination: name of the table with the results.  The
+            default, None, corresponds to 'events'.
+        :return: table object or None.
+
+        """
+        if destination is None:
+            destination = 'events'
+        if destination in self.group:
+            return self.group._f_get_child(destination)
+        else:
+            return None
 
-        return np.array(n_particles)
+    def _get_cleaned_events(self):
+        """Return the table containing the cleaned events"""
+
+        return self.source
+
+    def _count_processed_source_events(self):
+        """Return the number of source events which have been processed"""
+
+        return len(self.source)
+
+    def _store_watermark(self, results):
+        """Store the progress of the processing in the results table
+
+        These attributes are used to only process new events in later
+        incremental runs.
+
+        :param results: the table containing the results.
+
+        """
+        attrs = results.attrs
+        attrs.processed_source_events = self._count_processed_source_events()
+        attrs.number_of_results = len(results)
+        if len(results):
+            attrs.last_ext_timestamp = results.cols.ext_timestamp[-1]
+        else:
+            attrs.last_ext_timestamp = 0
+        histograms, has_integrals = self._integral_histograms
+        attrs.integral_histograms = histograms
+        attrs.detectors_with_integrals = has_integrals
+        results.flush()
+
+    def _process_new_events(self, results):
+        """Process events appended to the source since the previous run
+
+        The new events are sorted and duplicates are removed, also those
+        which are already included in the results.  The new events are
+        processed separately and then merged into the cleaned events and
+        results tables.  Only the part of those tables after the first new
+        event is rewritten, so if all new events are newer than the
+        previous results, the new events are simply appended.  Afterwards
+        the number of particles is updated for all events, using the MPVs
+        of the pulseintegrals of all events.
+
+        :param results: the table containing the previous results.
+
+        """
+        attrs = results.attrs
+        events = self._get_cleaned_events()
+        n_events = len(results)
+        if n_events != attrs.number_of_results:
+            raise RuntimeError("The results table contains rows which were "
+                               "not stored by processing events.  New events "
+                               "should be appended to the source table, "
+                               "which is '_events' if the results replaced "
+                               "the events.")
+
+        new_events = self.source.read(attrs.processed_source_events)
+        new_events = new_events[
+            self._find_sorted_unique_row_ids(new_events['ext_timestamp'])]
+
+        timestamps = new_events['ext_timestamp']
+        start = n_events
+        if len(timestamps) and timestamps[0] <= attrs.last_ext_timestamp:
+            # Some new events are older than the last processed event
+            old_timestamps = events.read(0, n_events, field='ext_timestamp')
+            new_events = new_events[~np.isin(timestamps, old_timestamps)]
+            if len(new_events):
+                start = np.searchsorted(old_timestamps,
+                                        new_events['ext_timestamp'][0])
+
+        if not len(new_events):
+            # Remove any duplicate events appended to the cleaned events
+            events.truncate(n_events)
+            attrs.processed_source_events = \
+                self._count_processed_source_events()
+            return
+
+        source = self.source
+        group = events._v_parent
+        self.source = events._v_file.create_table(
+            group, '_t_new_events', description=events.description,
+            expectedrows=len(new_events))
+        self.source.append(new_events)
+        self.source.flush()
+        self._previous_histograms = (attrs.integral_histograms,
+                                     attrs.detectors_with_integrals)
+        try:
+            self._tmp_events = events._v_file.create_table(
+                group, '_t_new_results', self.processed_events_description,
+                expectedrows=len(new_events))
+            for _ in range(len(new_events)):
+                self._tmp_events.row.append()
+            self._tmp_events.flush()
+            self._copy_events_into_table()
+            self._store_results_from_traces()
+            all_mpv = self._find_mpvs()
+
+            self._merge_tables(events, self.source, start, n_events)
+            self._merge_tables(results, self._tmp_events, start, n_events)
+            self._update_number_of_particles(results, events, all_mpv)
+        finally:
+            self.source.remove()
+            if '_t_new_results' in group:
+                group._t_new_results.remove()
+            self.source = source
+            self._previous_histograms = None
+
+        self._store_watermark(results)
+
+    def _update_number_of_particles(self, results, events, all_mpv):
+        """Store the number of particles of all events in the results
+
+        :param results: the table containing the results.
+        :param events: the cleaned events, in the same order as the results.
+        :param all_mpv: array with the MPV for each detector.
+
+        """
+        names = ['n%d' % (idx + 1) for idx in range(4)]
+        n_events = len(results)
+        for start in range(0, n_events, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_events)
+            integrals = events.read(start, stop, field='integrals')
+            n_particles = self._number_of_particles(integrals, all_mpv)
+            results.modify_columns(start, stop, columns=list(n_particles.T),
+                                   names=names)
+        results.flush()
+
+    def _merge_tables(self, table, new_rows, start, stop):
+        """Merge sorted new rows into a sorted table
+
+        The rows of the table from start onwards are replaced by the merge
+        of those rows and the new rows, ordered by ext_timestamp.  Rows
+        after stop are discarded.  The event_ids are renumbered to match
+        the row ids.
+
+        :param table: the table into which the rows are merged.
+        :param new_rows: table containing the new rows.
+        :param start: the row from which the table is rewritten.
+        :param stop: the number of rows of the table to merge with.
+
+        """
+        rows = np.concatenate([table.read(start, stop), new_rows.read()])
+        order = np.argsort(rows['ext_timestamp'], kind='mergesort')
+        rows = rows[order]
+        rows['event_id'] = np.arange(start, start + len(rows))
+        table.truncate(start)
+        table.append(rows)
+        table.flush()
 
     def _move_results_table_into_destination(self):
         if self.source.name == 'events':
@@ -505,10 +1078,11 @@ class ProcessIndexedEvents(ProcessEvents):
                                                    progress)
         self.indexes = indexes
 
-    def _store_results_from_traces(self):
+    def _store_results_from_traces(self, timings=None):
         table = self._tmp_events
 
-        timings = self.process_traces()
+        if timings is None:
+            timings = self.process_traces()
 
         for event, (t1, t2, t3, t4) in zip(table.itersequence(self.indexes),
                                            timings):
@@ -520,17 +1094,27 @@ class ProcessIndexedEvents(ProcessEvents):
 
         table.flush()
 
-    def process_traces(self):
-        """Process traces to yield pulse timing information.
+    def _get_number_of_events(self):
+        """Get the number of events to process"""
 
-        This method makes use of the indexes to build a list of events.
+        return len(self.indexes)
 
-        """
-        events = self.source.itersequence(self.indexes)
-        length = len(self.indexes)
-        timings = self._process_traces_from_event_list(events, length=length)
+    def _read_event_chunks(self, start, stop, chunk_size=None):
+        """Read the events to process in chunks
 
-        return timings
+        This method makes use of the indexes to select the events.
+
+        :param start,stop: the range of indexes of events to read.
+        :param chunk_size: number of events in a chunk, by default
+                           :data:`TRACE_CHUNK_SIZE`.
+        :return: generator of arrays of events.
+
+        """
+        if chunk_size is None:
+            chunk_size = TRACE_CHUNK_SIZE
+        for i in range(start, stop, chunk_size):
+            idx = self.indexes[i:min(i + chunk_size, stop)]
+            yield self.source.read_coordinates(idx)
 
     def get_traces_for_indexed_event_index(self, idx):
         idx = self.indexes[idx]
@@ -571,6 +1155,34 @@ class ProcessEventsWithLINT(ProcessEvents):
 
         return value
 
+    def _reconstruct_time_from_trace_batch(self, traces, baselines):
+        """Reconstruct time of measurement from many traces (LINT timings).
+
+        Vectorized version of :meth:`_reconstruct_time_from_trace`.
+
+        :param traces: array of traces, with the samples along the last
+                       axis.
+        :param baselines: array of baselines, one for each trace.
+        :return: arrival times.
+
+        """
+        thresholds = baselines + ADC_THRESHOLD
+        i = self.first_above_threshold_batch(traces, thresholds)
+
+        n_samples = traces.shape[-1]
+        if n_samples < 2:
+            return i
+
+        # Index of the sample after the crossing, only meaningful for i > 0
+        x1 = np.clip(i, 1, n_samples - 1)
+        x0 = x1 - 1
+        y0 = np.take_along_axis(traces, x0[..., np.newaxis], axis=-1)[..., 0]
+        y1 = np.take_along_axis(traces, x1[..., np.newaxis], axis=-1)[..., 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = 1. * (thresholds - y0) / (y1 - y0) + x0
+
+        return np.where(i > 0, value, i)
+
 
 class ProcessIndexedEventsWithLINT(ProcessIndexedEvents,
                                    ProcessEventsWithLINT):
@@ -597,7 +1209,7 @@ class ProcessEventsWithoutTraces(ProcessEvents):
 
     """
 
-    def _store_results_from_traces(self):
+    def _store_results_from_traces(self, timings=None):
         """Fake storing results from traces."""
 
         pass
@@ -660,10 +1272,11 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
         else:
             self.station = Station(station)
 
-    def _store_results_from_traces(self):
+    def _store_results_from_traces(self, timings=None):
         table = self._tmp_events
 
-        timings = self.process_traces()
+        if timings is None:
+            timings = self.process_traces()
 
         # Assign values to full table, column-wise.
         for idx in range(4):
@@ -672,16 +1285,21 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
         table.modify_column(column=timings[:, 4], colname='t_trigger')
         table.flush()
 
-    def _reconstruct_time_from_traces(self, event):
+    def _reconstruct_time_from_traces(self, event, traces=None):
         """Reconstruct arrival times for a single event.
 
         This method loops over the traces.
 
         :param event: row from the events table.
+        :param traces: the decoded traces of the event, as returned by
+            :meth:`_get_traces`.  If None, they are read from the blobs.
         :return: arrival times in the detectors and trigger time
                  relative to start of trace in ns
 
         """
+        if traces is None:
+            traces = self._get_traces(event['traces'])
+
         if self.station is not None:
             timestamp = event['timestamp']
             try:
@@ -701,8 +1319,8 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
         timings = []
         low_idx = []
         high_idx = []
-        for baseline, pulseheight, trace_idx, trig_thresholds in zip(
-                event['baseline'], event['pulseheights'], event['traces'],
+        for baseline, pulseheight, trace, trig_thresholds in zip(
+                event['baseline'], event['pulseheights'], traces,
                 self.thresholds):
             if pulseheight < 0:
                 # Retain -1 and -999 status flags in timing
@@ -731,9 +1349,7 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
             else:
                 thresholds.append(ADC_LIMIT)
 
-            trace = self._get_trace(trace_idx)
-
-            t, l, h = self._first_above_thresholds(trace, thresholds,
+            t, l, h = self._first_above_thresholds(iter(trace), thresholds,
                                                    max_signal)
             timings.append(t)
             low_idx.append(l)
@@ -839,6 +1455,178 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
 
         return -999
 
+    def _reconstruct_time_from_traces_batch(self, events, traces):
+        """Reconstruct arrival and trigger times for a chunk of events.
+
+        This is the vectorized equivalent of
+        :meth:`_reconstruct_time_from_traces`, it gives identical results.
+
+        :param events: array of rows from the events table.
+        :param traces: the decoded traces of the events, as returned by
+            :meth:`_get_traces`.
+        :return: array with the arrival times in the detectors and the
+                 trigger time relative to start of trace in ns, for each
+                 event.
+
+        """
+        thresholds, triggers = self._trigger_settings_batch(events)
+        n_low, n_high = triggers[:, 0, np.newaxis], triggers[:, 1, np.newaxis]
+        external = triggers[:, 3].astype(bool)
+
+        # Do not reconstruct thresholds if external trigger is involved
+        thresholds[external] = ADC_LIMIT
+        low_thresholds = thresholds[:, :, 0]
+        high_thresholds = thresholds[:, :, 1]
+
+        baselines = events['baseline']
+        pulseheights = events['pulseheights']
+        max_signal = baselines + pulseheights
+        adc_thresholds = baselines + ADC_THRESHOLD
+
+        # Only include if needed for trigger and large enough signal
+        low_thresholds = np.where(
+            (n_low != 0) & (max_signal >= low_thresholds), low_thresholds,
+            ADC_LIMIT)
+        high_thresholds = np.where(
+            (n_high != 0) & (max_signal >= high_thresholds), high_thresholds,
+            ADC_LIMIT)
+
+        t = self._first_above_thresholds_batch(traces, adc_thresholds,
+                                               max_signal)
+        low_idx = self._first_above_thresholds_batch(traces, low_thresholds,
+                                                     max_signal)
+        high_idx = self._first_above_thresholds_batch(traces, high_thresholds,
+                                                      max_signal)
+
+        # Retain -1 and -999 status flags in timing, mark detectors without
+        # significant pulse or with a bad baseline as -999.
+        flagged = pulseheights < 0
+        no_signal = ((pulseheights < ADC_THRESHOLD) |
+                     (baselines > thresholds[:, :, 0]))
+        t = np.where(flagged, pulseheights, np.where(no_signal, -999, t))
+        low_idx = np.where(flagged | no_signal, -999, low_idx)
+        high_idx = np.where(flagged | no_signal, -999, high_idx)
+
+        t_trigger = self._reconstruct_trigger_batch(low_idx, high_idx,
+                                                    triggers)
+
+        timings = np.column_stack([t, t_trigger])
+        timings = np.where(np.isin(timings, ERR), timings,
+                           timings * ADC_TIME_PER_SAMPLE)
+        return timings
+
+    def _trigger_settings_batch(self, events):
+        """Get the trigger settings for a chunk of events
+
+        :param events: array of rows from the events table.
+        :return: array with the low and high thresholds for each detector
+                 and array with the n_low, n_high, and_or and external
+                 trigger settings, for each event.
+
+        """
+        if self.station is None:
+            thresholds = [self.thresholds] * len(events)
+            triggers = [self.trigger] * len(events)
+        else:
+            # Look up the active settings for all events at once
+            try:
+                all_triggers = self.station.triggers
+                idx = get_active_indexes(all_triggers['timestamp'],
+                                         events['timestamp'])
+                settings = all_triggers[idx]
+            except Exception:
+                warnings.warn('Unknown trigger settings, not reconstructing '
+                              'trigger offset.')
+                # Pretend external trigger, thresholds will not be used
+                thresholds = [(ADC_LIMIT, ADC_LIMIT)] * 4 * len(events)
+                triggers = [(0, 0, 0, 1)] * len(events)
+            else:
+                thresholds = np.column_stack(
+                    [settings['%s%d' % (t, i)]
+                     for i in range(1, 5) for t in ('low', 'high')])
+                triggers = np.column_stack(
+                    [settings[t]
+                     for t in ('n_low', 'n_high', 'and_or', 'external')])
+
+        thresholds = np.array(thresholds).reshape(len(events), 4, 2)
+        triggers = np.array(triggers).reshape(len(events), 4)
+        return thresholds, triggers
+
+    @classmethod
+    def _first_above_thresholds_batch(cls, traces, thresholds, max_signal):
+        """Find the first element in many traces equal or above threshold
+
+        Vectorized version of :meth:`_first_above_thresholds`, for a single
+        threshold per trace.  Thresholds above the expected max value are
+        not looked for.
+
+        :param traces: array of traces, with the samples along the last
+                       axis.
+        :param thresholds: array of thresholds, one for each trace.
+        :param max_signal: array with the expected max value in each trace,
+                           based on baseline and pulseheight.
+        :return: array of indexes into the traces where the thresholds are
+                 crossed.
+
+        """
+        idx = cls.first_above_threshold_batch(traces, thresholds)
+        return np.where(max_signal < thresholds, -999, idx)
+
+    @staticmethod
+    def _reconstruct_trigger_batch(low_idx, high_idx, triggers):
+        """Reconstruct the moment of trigger for many events
+
+        Vectorized version of :meth:`_reconstruct_trigger`.
+
+        :param low_idx,high_idx: arrays of trace indexes when a detector
+                                 crossed a given threshold, for each event.
+        :param triggers: array with the n_low, n_high, and_or and external
+                         trigger settings for each event.
+        :return: array of indexes in trace where the trigger happened.
+
+        """
+        n_low, n_high, and_or, external = np.asarray(triggers).T.astype(int)
+        n_low_idx = (low_idx != -999).sum(axis=1)
+        n_high_idx = (high_idx != -999).sum(axis=1)
+
+        # Missing crossings are sorted after all real crossings
+        no_crossing = np.iinfo(np.intp).max
+        low_idx = np.sort(np.where(low_idx == -999, no_crossing, low_idx),
+                          axis=1)
+        high_idx = np.sort(np.where(high_idx == -999, no_crossing, high_idx),
+                           axis=1)
+
+        def nth(idx, n):
+            """Get the n-th (1-based) crossing, n is clipped to valid range"""
+            n = np.clip(n - 1, 0, idx.shape[1] - 1)
+            return np.take_along_axis(idx, n[:, np.newaxis], axis=1)[:, 0]
+
+        low = nth(low_idx, n_low)
+        high = nth(high_idx, n_high)
+        low_and_high = nth(low_idx, n_low + n_high)
+
+        has_low = (n_low != 0) & (n_low_idx >= n_low)
+        has_high = (n_high != 0) & (n_high_idx >= n_high)
+
+        # low or high, which ever is first
+        or_trigger = np.select(
+            [has_low & has_high, has_high, has_low],
+            [np.minimum(low, high), high, low], -999)
+        # low and high
+        and_trigger = np.select(
+            [(n_low != 0) & (n_high != 0),
+             (n_high != 0),
+             (n_low != 0)],
+            [np.where((n_low_idx >= n_low + n_high) & has_high,
+                      np.maximum(low_and_high, high), -999),
+             np.where(has_high, high, -999),
+             np.where(has_low, low, -999)], -999)
+
+        t_trigger = np.where(and_or != 0, or_trigger, and_trigger)
+
+        # External trigger not supported
+        return np.where(external != 0, -999, t_trigger)
+
     def __repr__(self):
         if not self.data.isopen:
             return "<finished %s>" % self.__class__.__name__
@@ -922,10 +1710,9 @@ class ProcessEventsFromSource(ProcessEvents):
 
         """
         new_events = self.dest_file.create_table(self.dest_group, '_events',
-                                                 description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        new_events.append(selected_rows)
-        new_events.flush()
+                                                 description=table.description,
+                                                 expectedrows=len(row_ids))
+        self._copy_selected_rows(table, new_events, row_ids)
         return new_events
 
     def _create_empty_results_table(self):
@@ -950,6 +1737,24 @@ class ProcessEventsFromSource(ProcessEvents):
         """Override, destination is temporary table"""
         self.destination = self._tmp_events
 
+    def _get_results_table(self, destination):
+        """Override, the results are always stored in 'events'"""
+
+        if 'events' in self.dest_group:
+            return self.dest_group.events
+        else:
+            return None
+
+    def _get_cleaned_events(self):
+        """Override, the cleaned events are stored in the destination"""
+
+        return self.dest_group._events
+
+    def _count_processed_source_events(self):
+        """Override, the source is left untouched"""
+
+        return len(self._get_source())
+
     def _get_blobs(self):
         """Return blobs node"""
 
@@ -1098,13 +1903,8 @@ class ProcessDataTable(ProcessEvents):
         """
         data = self.source
 
-        enumerated_timestamps = list(enumerate(data.col('timestamp')))
-        enumerated_timestamps.sort(key=operator.itemgetter(1))
-
-        unique_sorted_ids = self._find_unique_row_ids(enumerated_timestamps)
-
-        new_data = self._replace_table_with_selected_rows(data,
-                                                          unique_sorted_ids)
+        with self._sorted_unique_row_ids(data, 'timestamp') as row_ids:
+            new_data = self._replace_table_with_selected_rows(data, row_ids)
         self.source = new_data
         self._normalize_event_ids(new_data)
 
@@ -1118,10 +1918,9 @@ class ProcessDataTable(ProcessEvents):
         """
         tmptable = self.data.create_table(self.group,
                                           '_t_%s' % self.table_name,
-                                          description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        tmptable.append(selected_rows)
-        tmptable.flush()
+                                          description=table.description,
+                                          expectedrows=len(row_ids))
+        self._copy_selected_rows(table, tmptable, row_ids)
         self.data.rename_node(tmptable, self.destination, overwrite=True)
         return tmptable
 
@@ -1181,10 +1980,9 @@ class ProcessDataTableFromSource(ProcessDataTable):
         """
         new_table = self.dest_file.create_table(self.dest_group,
                                                 self.table_name,
-                                                description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        new_table.append(selected_rows)
-        new_table.flush()
+                                                description=table.description,
+                                                expectedrows=len(row_ids))
+        self._copy_selected_rows(table, new_table, row_ids)
         return new_table
 
     def __repr__(self):
@@ -1249,3 +2047,296 @@ class ProcessSinglesFromSource(ProcessDataTableFromSource):
 
     """
     table_name = 'singles'
+
+
+#: Reference to a file (pathname None) or node, to reopen it in a worker
+_NodeReference = namedtuple('_NodeReference', ['filename', 'pathname'])
+
+
+def process_and_store_results_in_workers(processes, workers, overwrite=False,
+                                         progress=True):
+    """Process events of several groups, using one pool of workers
+
+    The traces of all groups are processed concurrently by the worker
+    processes, which is most efficient when there are many groups with
+    few events.  The workers only read the data, the results are stored
+    by the current process once all traces are processed.  The results
+    are identical to calling
+    :meth:`ProcessEvents.process_and_store_results` for each of the
+    processes.
+
+    :param processes: list of :class:`ProcessEvents` instances, one for
+        each group.
+    :param workers: the number of worker processes.
+    :param overwrite: if True, overwrite previously obtained results.
+    :param progress: if True show a progressbar while processing traces.
+
+    """
+    if not use_worker_processes(workers):
+        for process in processes:
+            process.process_and_store_results(overwrite=overwrite)
+        return
+
+    shards = []
+    shard_owners = []
+    for idx, process in enumerate(processes):
+        process.limit = None
+        process.workers = workers
+        process._check_destination(None, overwrite)
+        process._clean_events_table()
+        process._create_results_table()
+
+        if not isinstance(process, ProcessEventsWithoutTraces):
+            n_events = process._get_number_of_events()
+            process_shards = process._get_worker_shards(n_events)
+            shards.extend(process_shards)
+            shard_owners.extend([idx] * len(process_shards))
+
+    files = set(process.data for process in processes)
+    with worker_pool(workers, files=files) as pool:
+        result = list(pbar(pool.imap(_process_traces_in_worker, shards),
+                           length=len(shards), show=progress))
+
+    for idx, process in enumerate(processes):
+        timings = [timings for owner, timings in zip(shard_owners, result)
+                   if owner == idx]
+        if timings:
+            timings = np.concatenate(timings)
+        else:
+            timings = np.array(timings)
+
+        process._store_results_from_traces(timings)
+        process._store_number_of_particles()
+        process._move_results_table_into_destination()
+        process._store_watermark(process._tmp_events)
+
+
+def _process_traces_in_worker(shard):
+    """Process the traces of a shard of events in a worker process
+
+    :param shard: tuple of the processing class, the state from
+        :meth:`ProcessEvents._get_worker_state`, the range of events and
+        the number of events to process at once.
+    :return: the pulse timing information for the events in the shard.
+
+    """
+    cls, state, start, stop, chunk_size = shard
+
+    files = {}
+    try:
+        process = cls.__new__(cls)
+        for key, value in state.items():
+            if isinstance(value, _NodeReference):
+                filename, pathname = value
+                if filename not in files:
+                    files[filename] = tables.open_file(filename, 'r')
+                if pathname is None:
+                    value = files[filename]
+                else:
+                    value = files[filename].get_node(pathname)
+            setattr(process, key, value)
+        process.progress = False
+
+        chunks = process._read_event_chunks(start, stop, chunk_size)
+        return process._process_traces_from_event_chunks(chunks,
+                                                         stop - start)
+    finally:
+        for data in files.values():
+            data.close()
+
+
+def decode_traces(blobs, trace_idx):
+    """Decompress and decode many traces from the blobs array at once
+
+    Instead of converting each value separately the decompressed traces
+    are joined and parsed by NumPy in a single call.  Both the plain
+    zlib-compressed blobs and those wrapped in an extra byte on either
+    side are accepted.
+
+    :param blobs: the blobs array, or any other sequence of compressed
+        traces.
+    :param trace_idx: array of indexes into the blobs array, usually the
+        traces column of (a selection of) the events table.  Negative
+        indexes designate missing traces.
+    :return: int16 array with the shape of trace_idx plus an extra last
+             axis for the samples.  Missing traces and samples beyond the
+             end of shorter traces are filled with -1.
+
+    """
+    trace_idx = np.asarray(trace_idx)
+    flat_idx = trace_idx.ravel()
+    present = np.flatnonzero(flat_idx >= 0)
+
+    values, lengths = _decode_trace_values(blobs, flat_idx[present])
+
+    return _arrange_traces(values, lengths, present, trace_idx.shape)
+
+
+def store_decoded_traces(data, group, progress=True):
+    """Store the decoded traces next to the blobs
+
+    The traces of the events in the group are decoded once and stored in
+    the Blosc-compressed int16 array ``decoded_traces``.  For each entry in
+    the blobs array the ``decoded_traces_offsets`` array gives the position
+    of the first sample in ``decoded_traces``, the next entry gives the end
+    of the trace.  Other blobs, like error messages, have no samples.
+
+    When blobs are added to the group later, calling this function again
+    only decodes the new traces.  :class:`ProcessEvents` reads the stored
+    traces instead of the blobs when they are available.
+
+    :param data: the PyTables datafile.
+    :param group: the group containing the events table and blobs.
+    :param progress: if True show a progressbar while decoding.
+
+    """
+    group = data.get_node(group)
+    blobs = group.blobs
+
+    if 'decoded_traces' in group:
+        decoded_traces = group.decoded_traces
+        offsets = group.decoded_traces_offsets
+    else:
+        filters = tables.Filters(complevel=5, complib='blosc')
+        decoded_traces = data.create_earray(group, 'decoded_traces',
+                                            tables.Int16Atom(), (0,),
+                                            filters=filters)
+        offsets = data.create_earray(group, 'decoded_traces_offsets',
+                                     tables.Int64Atom(), (0,),
+                                     filters=filters,
+                                     expectedrows=len(blobs) + 1)
+        offsets.append([0])
+
+    n_decoded = len(offsets) - 1
+    n_blobs = len(blobs)
+    end = offsets[-1]
+
+    # Only the blobs referred to by events contain traces
+    if '_events' in group:
+        events = group._events
+    else:
+        events = group.events
+    is_trace = np.zeros(n_blobs - n_decoded, dtype=bool)
+    for start in range(0, len(events), CHUNK_SIZE):
+        trace_idx = events.read(start, start + CHUNK_SIZE, field='traces')
+        trace_idx = trace_idx[trace_idx >= n_decoded]
+        is_trace[trace_idx - n_decoded] = True
+
+    for start in pbar(range(n_decoded, n_blobs, TRACE_CHUNK_SIZE),
+                      show=progress):
+        stop = min(start + TRACE_CHUNK_SIZE, n_blobs)
+        chunk_is_trace = is_trace[start - n_decoded:stop - n_decoded]
+        values, lengths = _decode_trace_values(
+            blobs, np.arange(start, stop)[chunk_is_trace])
+        chunk_lengths = np.zeros(stop - start, dtype=np.int64)
+        chunk_lengths[chunk_is_trace] = lengths
+        decoded_traces.append(values)
+        offsets.append(end + chunk_lengths.cumsum())
+        end += lengths.sum()
+
+    decoded_traces.flush()
+    offsets.flush()
+
+
+def read_decoded_traces(decoded_traces, offsets, trace_idx):
+    """Read many traces from the stored decoded traces
+
+    This gives the same result as :func:`decode_traces`, but reads the
+    traces stored by :func:`store_decoded_traces`.
+
+    :param decoded_traces: the array with the samples of all traces.
+    :param offsets: the array with the offsets into decoded_traces for
+        each blob.
+    :param trace_idx: array of indexes into the blobs array.  Negative
+        indexes designate missing traces.
+    :return: int16 array with the shape of trace_idx plus an extra last
+             axis for the samples.  Missing traces and samples beyond the
+             end of shorter traces are filled with -1.
+
+    """
+    trace_idx = np.asarray(trace_idx)
+    flat_idx = trace_idx.ravel()
+    present = np.flatnonzero(flat_idx >= 0)
+    idx = flat_idx[present]
+
+    if len(idx):
+        starts = _read_elements(offsets, idx)
+        lengths = _read_elements(offsets, idx + 1) - starts
+        first, last = starts.min(), (starts + lengths).max()
+        if last - first <= 2 * lengths.sum():
+            # The traces are close together, read them at once
+            samples = decoded_traces[first:last]
+            positions = (np.repeat(starts - first, lengths) +
+                         np.arange(lengths.sum()) -
+                         np.repeat(lengths.cumsum() - lengths, lengths))
+            values = samples[positions]
+        else:
+            values = np.concatenate([decoded_traces[start:start + length]
+                                     for start, length in zip(starts,
+                                                              lengths)])
+    else:
+        values = np.array([], dtype=np.int16)
+        lengths = np.array([], dtype=np.int64)
+
+    return _arrange_traces(values, lengths, present, trace_idx.shape)
+
+
+def _read_elements(array, idx):
+    """Read the elements at the given indexes from a 1D array node"""
+
+    first, last = idx.min(), idx.max() + 1
+    if last - first <= 2 * len(idx) + TRACE_CHUNK_SIZE:
+        return array[first:last][idx - first]
+    else:
+        return array[idx]
+
+
+def _decode_trace_values(blobs, idx):
+    """Decode the traces from the blobs at the given indexes
+
+    :param blobs: the blobs array.
+    :param idx: array of indexes into the blobs array.
+    :return: array of all values of the traces joined and an array with
+             the number of values of each trace.
+
+    """
+    raw_traces = [_decompress_trace(blobs[i]) for i in idx.tolist()]
+    lengths = np.array([trace.count(b',') + 1 if trace else 0
+                        for trace in raw_traces], dtype=np.intp)
+    values = np.fromstring(b','.join(trace for trace in raw_traces if trace),
+                           dtype=np.int16, sep=',')
+    return values, lengths
+
+
+def _arrange_traces(values, lengths, present, shape):
+    """Arrange joined trace values in an array padded with -1
+
+    :param values: the values of all traces joined.
+    :param lengths: the number of values of each trace.
+    :param present: the flat positions in the result of each trace.
+    :param shape: the shape of the result, without the samples axis.
+    :return: int16 array of traces.
+
+    """
+    n_samples = lengths.max() if len(lengths) else 0
+    traces = np.full((int(np.prod(shape)), n_samples), -1, dtype=np.int16)
+    rows = np.repeat(present, lengths)
+    columns = (np.arange(lengths.sum()) -
+               np.repeat(lengths.cumsum() - lengths, lengths))
+    traces[rows, columns] = values
+
+    return traces.reshape(shape + (n_samples,))
+
+
+def _decompress_trace(blob):
+    """Decompress a trace blob, stripping a trailing separator
+
+    :param blob: a compressed trace from the blobs array.
+    :return: the comma separated pulseheight values as bytes.
+
+    """
+    try:
+        trace = zlib.decompress(blob)
+    except zlib.error:
+        trace = zlib.decompress(blob[1:-1])
+    return trace.rstrip(b',')
@@ -8,7 +8,9 @@
 
 """
 from six.moves import range
-from numpy import around, convolve, ones, where
+from numpy import (around, convolve, ones, where, zeros, full, concatenate,
+                   maximum, minimum, newaxis, ascontiguousarray, copyto,
+                   asarray, moveaxis, empty, empty_like)
 from lazy import lazy
 
 
@@ -170,6 +172,150 @@ class TraceObservables(object):
         return n_peaks + self.missing
 
 
+class TraceObservablesBatch(object):
+
+    """Reconstruct trace observables for many events at once
+
+    This is the batch version of :class:`TraceObservables` and gives the
+    same results.  Instead of lists each observable is an array with a row
+    of 4 values for each event.  The peaks are counted for all traces at
+    once, looping only over the samples.
+
+    Traces of different length can be combined by padding them with values
+    below the baseline, e.g. -1.  This does not affect the pulseheights,
+    integrals and n_peaks, as long as each trace contains at least the
+    samples used to determine the baseline.
+
+    """
+
+    def __init__(self, traces, threshold=ADC_BASELINE_THRESHOLD,
+                 padding=DATA_REDUCTION_PADDING):
+        """Initialize the class
+
+        :param traces: a NumPy array of traces with shape (events, samples,
+                       detectors), i.e. for each event the traces are
+                       ordered as for :class:`TraceObservables`.
+        :param threshold: value of the threshold to use, in ADC counts.
+        :param padding: number of samples which should be usuable to determine
+                        the baseline.
+
+        """
+        self.traces = traces
+        self.threshold = threshold
+        self.padding = padding
+        self.n = self.traces.shape[2]
+        if self.n not in [2, 4]:
+            raise Exception('Unsupported number of detectors')
+
+    def _add_missing(self, values):
+        """Pad the observables with -1 for missing detectors"""
+
+        missing = full((len(values), 4 - self.n), -1, dtype=values.dtype)
+        return concatenate([values, missing], axis=1)
+
+    @lazy
+    def _baselines(self):
+        baselines = around(self.traces[:, :self.padding].mean(axis=1))
+        return baselines.astype('int')
+
+    @lazy
+    def baselines(self):
+        """Mean value of the first part of the traces
+
+        :return: the baselines in ADC count.
+
+        """
+        return self._add_missing(self._baselines)
+
+    @lazy
+    def std_dev(self):
+        """Standard deviation of the first part of the traces
+
+        :return: the standard deviations in milli ADC count.
+
+        """
+        std_dev = around(self.traces[:, :self.padding].std(axis=1) * 1000)
+        return self._add_missing(std_dev.astype('int'))
+
+    @lazy
+    def pulseheights(self):
+        """Maximum peak to baseline value in the traces
+
+        :return: the pulseheights in ADC count.
+
+        """
+        pulseheights = self.traces.max(axis=1) - self._baselines
+        return self._add_missing(pulseheights)
+
+    @lazy
+    def integrals(self):
+        """Integral of the traces for all values over threshold
+
+        :return: the pulse integrals in ADC count * sample.
+
+        """
+        traces = self.traces - self._baselines[:, newaxis]
+        integrals = where(traces > self.threshold, traces, 0).sum(axis=1)
+        return self._add_missing(integrals)
+
+    @lazy
+    def n_peaks(self):
+        """Number of peaks in the traces
+
+        :return: the number of peaks.
+
+        """
+        # Make rough guess at the baseline/threshold to expect
+        peak_thresholds = where((self._baselines < 100).all(axis=1),
+                                ADC_LOW_THRESHOLD_III - 30,
+                                ADC_LOW_THRESHOLD - 200)
+
+        traces = self.traces - self._baselines[:, newaxis]
+        n_peaks = self.count_peaks(traces, peak_thresholds[:, newaxis])
+        return self._add_missing(n_peaks)
+
+    @staticmethod
+    def count_peaks(traces, peak_thresholds):
+        """Count the peaks in many traces at once
+
+        This follows the same algorithm as :attr:`TraceObservables.n_peaks`,
+        the state of all traces is updated sample by sample.
+
+        :param traces: array of traces relative to the baseline, with shape
+                       (events, samples, detectors).
+        :param peak_thresholds: the (positive) peak thresholds,
+                                broadcastable to the shape (events,
+                                detectors).
+        :return: array with the number of peaks, with shape (events,
+                 detectors).
+
+        """
+        # Make the values of each sample contiguous in memory
+        traces = ascontiguousarray(traces.swapaxes(0, 1))
+        shape = traces.shape[1:]
+        n_peaks = zeros(shape, dtype='int')
+        in_peak = zeros(shape, dtype=bool)
+        local_minimum = zeros(shape, dtype=traces.dtype)
+        local_maximum = zeros(shape, dtype=traces.dtype)
+
+        for value in traces:
+            not_in_peak = ~in_peak
+            # enough signal over local minimum to be in a peak
+            peak_start = not_in_peak & (value - local_minimum >
+                                        peak_thresholds)
+            # enough signal decrease to be out of peak
+            peak_end = in_peak & (local_maximum - value > peak_thresholds)
+
+            copyto(local_minimum, maximum(value, 0),
+                   where=(not_in_peak & (value < local_minimum)) | peak_end)
+            copyto(local_maximum, value,
+                   where=peak_start | (in_peak & (value > local_maximum)))
+            n_peaks += peak_start
+            in_peak ^= peak_start | peak_end
+
+        return n_peaks
+
+
 class MeanFilter(object):
 
     """Filter raw traces
@@ -197,9 +343,11 @@ class MeanFilter(object):
         """
         if use_threshold:
             self.filter = self.mean_filter_with_threshold
+            self.filter_batch = self.mean_filter_with_threshold_batch
             self.threshold = threshold
         else:
             self.filter = self.mean_filter_without_threshold
+            self.filter_batch = self.mean_filter_without_threshold_batch
 
     def filter_traces(self, raw_traces):
         """Apply the mean filter to multiple traces
@@ -210,6 +358,32 @@ class MeanFilter(object):
         """
         return [self.filter_trace(raw_trace) for raw_trace in raw_traces]
 
+    def filter_traces_batch(self, raw_traces):
+        """Apply the mean filter to the traces of many events at once
+
+        This gives the same results as :meth:`filter_trace` for each trace.
+        If the traces have an odd number of samples the last sample is
+        dropped, as in :meth:`filter_trace`.
+
+        :param raw_traces: array of raw traces with shape (events, samples,
+                           detectors).
+        :return: array of filtered traces with shape (events, samples,
+                 detectors).
+
+        """
+        raw_traces = moveaxis(asarray(raw_traces, dtype='int'), 1, -1)
+
+        filtered_even = self.filter_batch(raw_traces[..., ::2])
+        filtered_odd = self.filter_batch(raw_traces[..., 1::2])
+
+        n = min(filtered_even.shape[-1], filtered_odd.shape[-1])
+        recombined_traces = empty(raw_traces.shape[:-1] + (2 * n,),
+                                  dtype='int')
+        recombined_traces[..., ::2] = filtered_even[..., :n]
+        recombined_traces[..., 1::2] = filtered_odd[..., :n]
+        filtered_traces = self.filter_batch(recombined_traces)
+        return moveaxis(filtered_traces, -1, 1)
+
     def filter_trace(self, raw_trace):
         """Apply the mean filter to a single trace
 
@@ -282,6 +456,76 @@ class MeanFilter(object):
 
         return filtered_trace
 
+    @staticmethod
+    def _moving_average_batch(traces):
+        """Moving average of 4 samples along the last axis
+
+        The values match those of the convolution used by the single
+        trace filters, the first 3 values are not used.
+
+        """
+        moving_average = zeros(traces.shape)
+        moving_average[..., 3:] = (traces[..., 3:] + traces[..., 2:-1] +
+                                   traces[..., 1:-2] + traces[..., :-3]) / 4
+        return moving_average
+
+    def mean_filter_with_threshold_batch(self, traces):
+        """The mean filter in case use_threshold is True, for many traces
+
+        :param traces: array of traces, the samples along the last axis.
+        :return: array of filtered traces.
+
+        """
+        traces = asarray(traces, dtype='int')
+        moving_average = self._moving_average_batch(traces)
+        rounded_average = around(moving_average).astype(int)
+
+        filtered_traces = empty_like(traces)
+        local_mean = moving_average[..., 3:4]
+        first_values_near_mean = (abs(traces[..., :4] - local_mean) <=
+                                  self.threshold).all(axis=-1)
+        filtered_traces[..., :4] = where(first_values_near_mean[..., newaxis],
+                                         rounded_average[..., 3:4],
+                                         traces[..., :4])
+
+        local_mean = moving_average[..., 4:]
+        values = traces[..., 4:]
+        previous_values = traces[..., 3:-1]
+        keep_values = ((abs(values - previous_values) > 2 * self.threshold) |
+                       # Both values on same side of the local_mean
+                       ((values > local_mean) ==
+                        (previous_values > local_mean)) |
+                       (abs(values - local_mean) > self.threshold))
+        filtered_traces[..., 4:] = where(keep_values, values,
+                                         rounded_average[..., 4:])
+
+        return filtered_traces
+
+    def mean_filter_without_threshold_batch(self, traces):
+        """The mean filter in case use_threshold is False, for many traces
+
+        :param traces: array of traces, the samples along the last axis.
+        :return: array of filtered traces.
+
+        """
+        traces = asarray(traces, dtype='int')
+        moving_average = self._moving_average_batch(traces)
+        rounded_average = around(moving_average).astype(int)
+
+        filtered_traces = empty_like(traces)
+        filtered_traces[..., :4] = rounded_average[..., 3:4]
+
+        local_mean = moving_average[..., 4:]
+        values = traces[..., 4:]
+        previous_values = traces[..., 3:-1]
+        # Both values on same side of the local_mean
+        keep_values = ((values > local_mean) ==
+                       (previous_values > local_mean))
+        filtered_traces[..., 4:] = where(keep_values, values,
+                                         rounded_average[..., 4:])
+
+        return filtered_traces
+
     def __repr__(self):
         try:
             return ("%s(use_threshold=%s, threshold=%r)" %
@@ -376,3 +620,68 @@ class DataReduction(object):
         if length is not None:
             right = right if right < length else length
         return left, right
+
+    def reduce_traces_batch(self, traces, baselines=None,
+                            return_offset=False):
+        """Apply data reduction to the traces of many events at once
+
+        Because the reduced traces have different lengths a list of
+        reduced traces is returned, these are views into the traces array.
+
+        :param traces: array of traces with shape (events, samples,
+                       detectors).
+        :param baselines: array of baselines with shape (events,
+            detectors), if None the baselines will be determined using
+            :class:`TraceObservablesBatch`.
+        :param return_offset: if True the left cuts will also be returned.
+        :return: list of data reduced traces, including an array of the
+                 left cuts if return_offset is True.
+
+        """
+        if baselines is None:
+            baselines = \
+                TraceObservablesBatch(traces).baselines[:, :traces.shape[2]]
+        left, right = self.determine_cuts_batch(traces, baselines)
+        left, right = self.add_padding_batch(left, right, traces.shape[1])
+        reduced_traces = [event_traces[event_left:event_right]
+                          for event_traces, event_left, event_right
+                          in zip(traces, left, right)]
+        if return_offset:
+            return reduced_traces, left
+        else:
+            return reduced_traces
+
+    def determine_cuts_batch(self, traces, baselines):
+        """Determine the left and right cuts for many events at once
+
+        :param traces: array of traces with shape (events, samples,
+                       detectors).
+        :param baselines: array of baselines with shape (events,
+                          detectors).
+        :return: arrays with the left and right cuts for each event, as
+                 given by :meth:`determine_cuts`.
+
+        """
+        above_threshold = ((traces - asarray(baselines)[:, newaxis]).max(
+            axis=2) > self.threshold)
+        has_signal = above_threshold.any(axis=1)
+        left = where(has_signal, above_threshold.argmax(axis=1), 0)
+        right = traces.shape[1] - where(
+            has_signal, above_threshold[:, ::-1].argmax(axis=1), 0)
+        return left, right
+
+    def add_padding_batch(self, left, right, length=None):
+        """Add padding around the cuts of many events
+
+        :param left,right: arrays with the left and right cuts from
+                           :meth:`determine_cuts_batch`.
+        :param length: optionally the length of the traces, to prevent the
+                       right cuts to be larger than the length.
+        :return: arrays with the indices into the traces where to cut.
+
+        """
+        left = maximum(left - self.padding, 0)
+        right = right + self.padding
+        if length is not None:
+            right = minimum(right, length)
+        return left, right
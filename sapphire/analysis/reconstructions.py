@@ -33,7 +33,7 @@ from .direction_reconstruction import (EventDirectionReconstruction,
                                        CoincidenceDirectionReconstruction)
 from .core_reconstruction import (EventCoreReconstruction,
                                   CoincidenceCoreReconstruction)
-from .coincidence_queries import CoincidenceQuery
+from .coincidence_queries import CoincidenceQuery, BATCH_SIZE
 from .calibration import determine_detector_timing_offsets
 from ..utils import pbar
 
@@ -416,9 +416,9 @@ class ReconstructESDCoincidences(object):
             initials = []
         coincidences = pbar(self.cq.all_coincidences(iterator=True),
                             length=self.coincidences.nrows, show=self.progress)
-        angles = self.direction.reconstruct_coincidences(
-            self.cq.all_events(coincidences, n=0), station_numbers,
-            self.offsets, progress=False, initials=initials)
+        angles = self.direction.reconstruct_coincidences_batch(
+            self.cq.all_events(coincidences, n=0, batch_size=BATCH_SIZE),
+            station_numbers, self.offsets, progress=False, initials=initials)
         self.theta, self.phi, self.station_numbers = angles
 
     def reconstruct_cores(self, station_numbers=None):
@@ -435,8 +435,8 @@ class ReconstructESDCoincidences(object):
         coincidences = pbar(self.cq.all_coincidences(iterator=True),
                             length=self.coincidences.nrows, show=self.progress)
         cores = self.core.reconstruct_coincidences(
-            self.cq.all_events(coincidences, n=0), station_numbers,
-            progress=False, initials=initials)
+            self.cq.all_events(coincidences, n=0, batch_size=BATCH_SIZE),
+            station_numbers, progress=False, initials=initials)
         self.core_x, self.core_y = cores
 
     def prepare_output(self):
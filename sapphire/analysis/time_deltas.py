@@ -24,15 +24,15 @@
 import re
 from itertools import combinations
 import posixpath
+import warnings
 
 import tables
-from numpy import isnan
+import numpy as np
 
-from ..utils import pbar
+from ..utils import pbar, get_active_indexes, ERR
 from ..api import Station
 from ..storage import TimeDelta
 from .coincidence_queries import CoincidenceQuery
-from .event_utils import station_arrival_time
 
 
 class ProcessTimeDeltas(object):
@@ -71,8 +71,9 @@ class ProcessTimeDeltas(object):
     def determine_and_store_time_deltas_for_pairs(self):
         """Determine time deltas for all pairs and store the results."""
 
+        time_deltas = self.determine_time_deltas(self.pairs)
         for pair in pbar(self.pairs, show=self.progress):
-            ets, dt = self.determine_time_deltas_for_pair(*pair)
+            ets, dt = time_deltas[pair]
             if len(ets):
                 self.store_time_deltas(ets, dt, pair)
 
@@ -93,14 +94,14 @@ class ProcessTimeDeltas(object):
                       for s1, s2 in combinations(sorted(c_idx[:, 0]), 2)}
 
     def get_detector_offsets(self):
-        """Retrieve the API detector_timing_offset method for all pairs
+        """Retrieve the API detector timing offsets for all pairs
 
-        The detector_timing_offset methods accept a single timestamp as
-        argument, and return the detector offsets for this timestamp.
+        For each station the table of detector offsets is retrieved, the
+        offsets for the events are then looked up by timestamp.
 
         """
         station_numbers = {station for pair in self.pairs for station in pair}
-        self.detector_timing_offsets = {sn: Station(sn).detector_timing_offset
+        self.detector_timing_offsets = {sn: Station(sn).detector_timing_offsets
                                         for sn in station_numbers}
 
     def determine_time_deltas_for_pair(self, ref_station, station):
@@ -111,48 +112,181 @@ class ProcessTimeDeltas(object):
                  t - t_ref. Not corrected for altitude differences.
 
         """
-        dt = []
-        ets = []
-        previous_ets = 0
+        pair = (ref_station, station)
+        return self.determine_time_deltas([pair])[pair]
 
-        coincidences = self.cq.all([ref_station, station], iterator=True)
-        coin_events = self.cq.events_from_stations(coincidences,
-                                                   [ref_station, station])
+    def determine_time_deltas(self, pairs):
+        """Determine the arrival time differences for many station pairs
 
-        ref_offsets = self.detector_timing_offsets[ref_station]
-        offsets = self.detector_timing_offsets[station]
+        The coincidences are processed in a single pass.  First the
+        station arrival times of all events are determined at once, then
+        the time differences are taken for all pairs of stations in each
+        coincidence.
 
-        for events in coin_events:
-            ref_ets = events[0][1]['ext_timestamp']
-            # Filter coincidence which is subset of previous coincidence
-            if previous_ets == ref_ets:
-                continue
-            else:
-                previous_ets = ref_ets
-            # Filter for possibility of same station twice in coincidence
-            if len(events) is not 2:
+        For each pair only coincidences with exactly one event of both
+        stations are used, and a coincidence is skipped if its first
+        event of the pair is the same as for the previous coincidence
+        with that pair (i.e. a subset of the previous coincidence).
+
+        :param pairs: list of (ref_station, station) tuples.
+        :return: dictionary with for each pair the extended timestamps of
+                 the first event and time differences, t - t_ref. Not
+                 corrected for altitude differences.
+
+        """
+        s_ids = {number: s_idx
+                 for s_idx, number in enumerate(self.cq.s_numbers)}
+        n_stations = len(s_ids)
+
+        # Keys of the pairs ordered by s_idx
+        pair_keys = {}
+        for ref_station, station in pairs:
+            try:
+                ref_s_idx = s_ids[ref_station]
+                s_idx = s_ids[station]
+            except KeyError:
                 continue
-            if events[0][0] == ref_station:
-                ref_id = 0
-                id = 1
+            if ref_s_idx != s_idx:
+                key = (min(ref_s_idx, s_idx) * n_stations +
+                       max(ref_s_idx, s_idx))
+                pair_keys[(ref_station, station)] = key
+
+        empty = (np.array([], dtype=np.uint64), np.array([]))
+        time_deltas = {pair: empty for pair in pairs}
+        if not pair_keys:
+            return time_deltas
+
+        c_index = self.cq.c_index.read()
+        if not c_index:
+            return time_deltas
+        lengths = [len(c_idx) for c_idx in c_index]
+        entries = np.concatenate([np.reshape(c_idx, (-1, 2))
+                                  for c_idx in c_index]).astype(np.int64)
+        c_ids = np.repeat(np.arange(len(c_index)), lengths)
+
+        # Only events from stations in the pairs are needed
+        pair_s_ids = np.unique([s_ids[station] for pair in pair_keys
+                                for station in pair])
+        keep = np.in1d(entries[:, 0], pair_s_ids)
+        entries = entries[keep]
+        c_ids = c_ids[keep]
+        if not len(entries):
+            return time_deltas
+        s_idxs = entries[:, 0]
+
+        ext_timestamps, t_triggers, t_firsts = \
+            self._station_arrival_times(entries)
+
+        # Group the events by coincidence and station, the groups are
+        # ordered by station within each coincidence.  Sorting is stable,
+        # so the first entry of a group is its earliest event.
+        order = np.lexsort((s_idxs, c_ids))
+        group_start = np.flatnonzero(
+            np.r_[True, (np.diff(c_ids[order]) != 0) |
+                  (np.diff(s_idxs[order]) != 0)])
+        group_counts = np.diff(np.r_[group_start, len(order)])
+        group_entries = order[group_start]
+        group_c_ids = c_ids[group_entries]
+
+        # All combinations of the groups in each coincidence
+        n_groups = np.bincount(group_c_ids, minlength=len(c_index))
+        first_group = np.cumsum(n_groups) - n_groups
+        first = []
+        second = []
+        for n in np.unique(n_groups[n_groups >= 2]):
+            coincidence_groups = first_group[n_groups == n]
+            for i, j in combinations(range(n), 2):
+                first.append(coincidence_groups + i)
+                second.append(coincidence_groups + j)
+        if not first:
+            return time_deltas
+        first = np.concatenate(first)
+        second = np.concatenate(second)
+
+        keys = (s_idxs[group_entries[first]] * n_stations +
+                s_idxs[group_entries[second]])
+        selected = np.in1d(keys, list(pair_keys.values()))
+        order = np.lexsort((group_c_ids[first[selected]], keys[selected]))
+        first = first[selected][order]
+        second = second[selected][order]
+        keys = keys[selected][order]
+
+        first_entries = group_entries[first]
+        second_entries = group_entries[second]
+        ref_ets = np.where(first_entries < second_entries,
+                           ext_timestamps[first_entries],
+                           ext_timestamps[second_entries])
+
+        # Filter coincidences which are a subset of the previous coincidence
+        previous_ets = np.r_[0, ref_ets[:-1]]
+        previous_ets[np.r_[True, keys[1:] != keys[:-1]]] = 0
+        use = ref_ets != previous_ets
+        # Filter for possibility of same station twice in coincidence
+        use &= (group_counts[first] == 1) & (group_counts[second] == 1)
+
+        relative_ets = ref_ets.astype(np.int64)
+        first_t = ((ext_timestamps[first_entries].astype(np.int64) -
+                    relative_ets) -
+                   t_triggers[first_entries] + t_firsts[first_entries])
+        second_t = ((ext_timestamps[second_entries].astype(np.int64) -
+                     relative_ets) -
+                    t_triggers[second_entries] + t_firsts[second_entries])
+        use &= ~np.isnan(first_t) & ~np.isnan(second_t)
+
+        for pair, key in pair_keys.items():
+            selected = use & (keys == key)
+            if s_ids[pair[0]] < s_ids[pair[1]]:
+                dt = second_t[selected] - first_t[selected]
             else:
-                ref_id = 1
-                id = 0
-
-            ref_event = events[ref_id][1]
-            ref_detector_offsets = ref_offsets(ref_event['timestamp'])
-            event = events[id][1]
-            detector_offsets = offsets(event['timestamp'])
-
-            ref_t = station_arrival_time(ref_event, ref_ets, [0, 1, 2, 3],
-                                         ref_detector_offsets)
-            t = station_arrival_time(event, ref_ets, [0, 1, 2, 3],
-                                     detector_offsets)
-            if isnan(t) or isnan(ref_t):
-                continue
-            dt.append(t - ref_t)
-            ets.append(ref_ets)
-        return ets, dt
+                dt = first_t[selected] - second_t[selected]
+            time_deltas[pair] = (ref_ets[selected], dt)
+        return time_deltas
+
+    def _station_arrival_times(self, entries):
+        """Get the values needed for the station arrival times of events
+
+        Vectorized version of
+        :func:`~sapphire.analysis.event_utils.station_arrival_time`, the
+        detector offsets are looked up in the offset tables.
+
+        :param entries: array of (s_idx, e_idx) pairs of the events.
+        :return: the ext_timestamp, t_trigger and first detector arrival
+                 time corrected for the detector offsets, for each event.
+                 The times are NaN if they could not be determined.
+
+        """
+        n_entries = len(entries)
+        ext_timestamps = np.zeros(n_entries, dtype=np.uint64)
+        t_triggers = np.zeros(n_entries)
+        t_firsts = np.zeros(n_entries)
+
+        for s_idx in np.unique(entries[:, 0]):
+            selected = np.flatnonzero(entries[:, 0] == s_idx)
+            e_idxs, inverse = np.unique(entries[selected, 1],
+                                        return_inverse=True)
+            events = self.cq.s_nodes[s_idx].events.read_coordinates(e_idxs)
+            events = events[inverse]
+
+            offsets = self.detector_timing_offsets[self.cq.s_numbers[s_idx]]
+            idx = get_active_indexes(offsets['timestamp'], events['timestamp'])
+            detector_offsets = np.column_stack(
+                [offsets['offset%d' % i] for i in range(1, 5)])[idx]
+            detector_times = np.column_stack(
+                [events['t%d' % i] for i in range(1, 5)])
+            arrival_times = detector_times - detector_offsets
+            arrival_times[np.in1d(detector_times, ERR)
+                          .reshape(detector_times.shape)] = np.nan
+            t_trigger = events['t_trigger'].astype(float)
+            t_trigger[np.in1d(t_trigger, ERR)] = np.nan
+
+            ext_timestamps[selected] = events['ext_timestamp']
+            t_triggers[selected] = t_trigger
+            with warnings.catch_warnings():
+                # All-NaN rows result in NaN, as intended
+                warnings.simplefilter('ignore', RuntimeWarning)
+                t_firsts[selected] = np.nanmin(arrival_times, axis=1)
+
+        return ext_timestamps, t_triggers, t_firsts
 
     def store_time_deltas(self, ext_timestamps, time_deltas, pair):
         """Store determined dt values"""
@@ -163,12 +297,15 @@ class ProcessTimeDeltas(object):
             dt_table.remove()
         except tables.NoSuchNodeError:
             pass
-        delta_data = [(ets, int(ets) / int(1e9), int(ets) % int(1e9),
-                       time_delta)
-                      for ets, time_delta in zip(ext_timestamps, time_deltas)]
+        ext_timestamps = np.asarray(ext_timestamps, dtype=np.uint64)
         table = self.data.create_table(table_path, 'time_deltas', TimeDelta,
                                        createparents=True,
-                                       expectedrows=len(delta_data))
+                                       expectedrows=len(ext_timestamps))
+        delta_data = np.zeros(len(ext_timestamps), dtype=table.dtype)
+        delta_data['ext_timestamp'] = ext_timestamps
+        delta_data['timestamp'] = ext_timestamps // int(1e9)
+        delta_data['nanoseconds'] = ext_timestamps % int(1e9)
+        delta_data['delta'] = time_deltas
         table.append(delta_data)
         table.flush()
 
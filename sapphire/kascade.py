@@ -200,69 +200,61 @@ class KascadeCoincidences(object):
 
         # Shift the kascade data instead of the hisparc data. There is less of
         # it, so this is much faster.
-        k['ext_timestamp'] += int(-1e9) * timeshift
+        h_t = h['ext_timestamp'].astype(np.int64)
+        k_t = (k['ext_timestamp'].astype(np.int64) -
+               int(round(timeshift * 1e9)))
 
         if dtlimit:
             # dtlimit in ns
             dtlimit *= 1e9
 
-        coinc_dt, coinc_h_idx, coinc_k_idx = [], [], []
-
-        # First loop through kascade data until we have the first event that
-        # occurs _after_ the first hisparc event.
-        h_idx = 0
-        for k_idx in range(len(k)):
-            if k[k_idx][1] > h[h_idx][1]:
-                break
-
-        # Limit number of KASCADE events investigated
-        if limit:
-            max_k_idx = k_idx + limit - 1
+        if len(h) < 2 or not len(k):
+            k_idx = np.array([], dtype=np.int64)
         else:
-            max_k_idx = np.Inf
-
-        while k_idx <= max_k_idx:
-            # Try to get the timestamps of the kascade event and the
-            # neighbouring hisparc events.
-            try:
-                h_t = int(h[h_idx][1])
-                k_t = int(k[k_idx][1])
-                h_t_next = int(h[h_idx + 1][1])
-            except IndexError:
-                # Reached beyond the event list.
-                break
-
-            # Make sure that while the current hisparc event is _before_ the
-            # kascade event, the next hisparc event should occur _after_ the
-            # kascade event.  That way, the kascade event is enclosed by
-            # hisparc events.
-            if k_t > h_t_next:
-                h_idx += 1
-                continue
-
-            # Calculate the time differences for both neighbors. Make sure to
-            # get the sign right. Negative sign: the hisparc event is 'left'.
-            # Positive sign: the hisparc event is 'right'.
-            dt_left = h_t - k_t
-            dt_right = h_t_next - k_t
-
-            # Determine the nearest neighbor and add that to the coincidence
-            # list, if dtlimit is not exceeded
-            if dtlimit is None or min(abs(dt_left), abs(dt_right)) < dtlimit:
-                if abs(dt_left) < abs(dt_right):
-                    coinc_dt.append(dt_left)
-                    coinc_h_idx.append(h_idx)
-                else:
-                    coinc_dt.append(dt_right)
-                    coinc_h_idx.append(h_idx + 1)
-                coinc_k_idx.append(k_idx)
-
-            # Found a match for this kascade event, so continue with the next
-            # one.
-            k_idx += 1
+            # Start with the first kascade event that occurs _after_ the first
+            # hisparc event.
+            first_k_idx = min(np.searchsorted(k_t, h_t[0], side='right'),
+                              len(k) - 1)
+
+            # Limit number of KASCADE events investigated
+            if limit:
+                k_idx = np.arange(first_k_idx,
+                                  min(first_k_idx + limit, len(k)))
+            else:
+                k_idx = np.arange(first_k_idx, len(k))
+
+        # Find the neighbouring hisparc events of all kascade events. While
+        # the left hisparc event is _before_ the kascade event, the right
+        # hisparc event occurs _after_ the kascade event.  That way, the
+        # kascade event is enclosed by hisparc events.
+        k_t = k_t[k_idx]
+        h_idx = np.maximum(np.searchsorted(h_t, k_t, side='left') - 1, 0)
+
+        # Kascade events after the last hisparc event can not be enclosed.
+        enclosed = h_idx + 1 < len(h)
+        h_idx = h_idx[enclosed]
+        k_idx = k_idx[enclosed]
+        k_t = k_t[enclosed]
+
+        # Calculate the time differences for both neighbors. Make sure to
+        # get the sign right. Negative sign: the hisparc event is 'left'.
+        # Positive sign: the hisparc event is 'right'.
+        dt_left = h_t[h_idx] - k_t
+        dt_right = h_t[h_idx + 1] - k_t
+
+        # Determine the nearest neighbor and add that to the coincidence
+        # list, if dtlimit is not exceeded
+        left = abs(dt_left) < abs(dt_right)
+        coinc_dt = np.where(left, dt_left, dt_right)
+        coinc_h_idx = np.where(left, h_idx, h_idx + 1)
+        if dtlimit is not None:
+            within_limit = abs(coinc_dt) < dtlimit
+            coinc_dt = coinc_dt[within_limit]
+            coinc_h_idx = coinc_h_idx[within_limit]
+            k_idx = k_idx[within_limit]
 
         self.coincidences = np.rec.fromarrays(
-            [coinc_dt, coinc_h_idx, coinc_k_idx], names='dt, h_idx, k_idx')
+            [coinc_dt, coinc_h_idx, k_idx], names='dt, h_idx, k_idx')
 
     def store_coincidences(self):
         self.data.create_table(self.kascade_group, 'c_index',
@@ -275,7 +267,7 @@ class KascadeCoincidences(object):
         if not hasattr(self, '_k'):
             self._k = self._get_sorted_id_and_timestamp_array(
                 self.kascade_group)
-        return self._h.copy(), self._k.copy()
+        return self._h, self._k
 
     def _get_sorted_id_and_timestamp_array(self, group):
         timestamps = group.events.col('ext_timestamp')
@@ -147,6 +147,42 @@ class TimeDelta(tables.IsDescription):
     delta = tables.FloatCol(pos=3)
 
 
+class DetectorTimeDeltaHistograms(tables.IsDescription):
+
+    """Store daily histograms of time differences between detectors
+
+    For each pair of detectors (i, j), with i < j, the histogram of t_i -
+    t_j is stored, using the bins of
+    :data:`sapphire.analysis.calibration.DETECTOR_DT_BINS`.  Also stored
+    are the number, sum and sum of squares of all differences and, for
+    each detector, the number of events in which that detector and at
+    least one other detector have data.
+
+    """
+    timestamp = tables.UInt32Col(pos=0)
+    counts = tables.UInt32Col(pos=1, shape=(6, 161))
+    n = tables.UInt64Col(pos=2, shape=6)
+    sum = tables.FloatCol(pos=3, shape=6)
+    sum_of_squares = tables.FloatCol(pos=4, shape=6)
+    reference = tables.UInt64Col(pos=5, shape=4)
+
+
+class StationTimeDeltaHistograms(tables.IsDescription):
+
+    """Store daily histograms of time differences between stations
+
+    The histograms use the bins of
+    :data:`sapphire.analysis.calibration.STATION_DT_BINS`.  Also stored
+    are the number, sum and sum of squares of all differences.
+
+    """
+    timestamp = tables.UInt32Col(pos=0)
+    counts = tables.UInt32Col(pos=1, shape=1600)
+    n = tables.UInt64Col(pos=2)
+    sum = tables.FloatCol(pos=3)
+    sum_of_squares = tables.FloatCol(pos=4)
+
+
 class ReconstructedCoincidence(tables.IsDescription):
 
     """Store information about reconstructed coincidences"""
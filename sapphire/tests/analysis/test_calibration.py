@@ -1,15 +1,20 @@
+import os
+import tempfile
 import unittest
 import warnings
 from mock import patch, sentinel, MagicMock, Mock, call
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 
 import six
-from numpy import isnan, nan, array, all, std
-from numpy.random import uniform, normal
+import tables
+from numpy import isnan, nan, array, all, any, std, zeros, round, percentile, arange, histogram
+from numpy.random import uniform, normal, exponential, seed
+from numpy.testing import assert_array_equal
 
 from sapphire import HiSPARCNetwork, HiSPARCStations
 from sapphire.analysis import calibration
-from sapphire.transformations.clock import datetime_to_gps
+from sapphire.storage import TimeDelta
+from sapphire.transformations.clock import datetime_to_gps, gps_to_datetime
 from sapphire.utils import c
 
 
@@ -90,6 +95,30 @@ class StationTimingTests(unittest.TestCase):
         offset, _ = calibration.determine_station_timing_offset([sentinel.dt])
         self.assertTrue(isnan(offset))
 
+    def test_determine_station_timing_offset_batch(self):
+        seed(1)
+        centers = uniform(-40, 40, 20)
+        dts = [normal(center, uniform(10, 30), int(uniform(1e3, 2e4))) for center in centers]
+        dts.extend([[], normal(0, 10, 15), normal(2500, 10, 1000)])
+        dz = 0.6
+        dzc = dz / c
+
+        offsets, errors = calibration.determine_station_timing_offset_batch(iter(dts))
+        self.assertEqual(len(offsets), len(dts))
+        for center, offset, error in zip(centers, offsets, errors):
+            self.assertLess(abs(center - offset), 4 * error)
+        # Empty, too few time differences or offset too large
+        self.assertTrue(all(isnan(offsets[-3:])))
+        self.assertTrue(all(isnan(errors[-3:])))
+
+        offsets_dz, _ = calibration.determine_station_timing_offset_batch(dts, dz=dz)
+        for offset_dz, offset in zip(offsets_dz[:-3], offsets[:-3]):
+            self.assertAlmostEqual(offset_dz - dzc, offset)
+
+        offsets, errors = calibration.determine_station_timing_offset_batch([])
+        self.assertEqual(len(offsets), 0)
+        self.assertEqual(len(errors), 0)
+
 
 class BestReferenceTests(unittest.TestCase):
 
@@ -191,6 +220,40 @@ class FitTimingOffsetTests(unittest.TestCase):
         # Test if estimated error correctly represents the errors in offsets.
         self.assertLess(abs(std(deviations) - 1), 0.35)
 
+    def test_fit_timing_offset_histograms(self):
+        """Check agreement with the curve_fit reference implementation"""
+
+        seed(1)
+        bins = arange(-100, 100.1, 2.5)
+        histograms = []
+        expected = []
+        for _ in range(20):
+            dt = normal(uniform(-40, 40), uniform(5, 20), int(uniform(1e3, 1e5)))
+            y, _ = histogram(dt, bins)
+            histograms.append(y)
+            expected.append(calibration.fit_timing_offset_histogram(y, bins, len(dt), std(dt)))
+        offsets, errors = calibration.fit_timing_offset_histograms(histograms, bins)
+        for (expected_offset, expected_error), offset, error in zip(expected, offsets, errors):
+            self.assertAlmostEqual(expected_offset, offset, delta=1e-3 * expected_error)
+            self.assertAlmostEqual(expected_error, error, delta=1e-3 * expected_error)
+
+        # Only the masked bins are used
+        mask = zeros((20, len(bins) - 1), dtype=bool)
+        mask[:, 10:50] = True
+        offsets, errors = calibration.fit_timing_offset_histograms(histograms, bins, mask)
+        for y, offset, error in zip(histograms, offsets, errors):
+            expected = calibration.fit_timing_offset_histogram(y[10:50], bins[10:51], y.sum(), 10.)
+            self.assertAlmostEqual(expected[0], offset, delta=1e-3 * expected[1])
+            self.assertAlmostEqual(expected[1], error, delta=1e-3 * expected[1])
+
+        # Fits with less than three bins or without counts fail
+        mask[0, 12:] = False
+        histograms[1][10:50] = 0
+        offsets, errors = calibration.fit_timing_offset_histograms(histograms, bins, mask)
+        self.assertTrue(all(isnan(offsets[:2])))
+        self.assertTrue(all(isnan(errors[:2])))
+        self.assertFalse(any(isnan(offsets[2:])))
+
 
 class DetermineStationTimingOffsetsTests(unittest.TestCase):
 
@@ -366,6 +429,366 @@ class DetermineStationTimingOffsetsTests(unittest.TestCase):
         offsets = self.off.determine_station_timing_offset(date, sentinel.station, sentinel.ref_station)
         self.assertEqual(offsets, (nan, nan))
 
+    def test_determine_station_timing_offset_from_store(self):
+        date = datetime(2015, 1, 2)
+        self.off.calibration_store = Mock()
+        self.off._get_r_dz = Mock()
+        self.off.determine_first_and_last_date = Mock()
+        self.off.read_dt = Mock()
+        self.off._get_r_dz.return_value = sentinel.r, sentinel.dz
+        self.off.determine_first_and_last_date.return_value = (sentinel.left, sentinel.right)
+        store_offset = self.off.calibration_store.determine_station_timing_offset
+        store_offset.return_value = (10., 1.)
+
+        offsets = self.off.determine_station_timing_offset(date, sentinel.station, sentinel.ref_station)
+
+        self.assertEqual(offsets, (10., 1.))
+        store_offset.assert_called_once_with(sentinel.station, sentinel.ref_station, sentinel.left,
+                                             sentinel.right, sentinel.dz, self.off.MIN_LEN_DT, 'curve_fit')
+        self.assertFalse(self.off.read_dt.called)
+
+    @patch.object(calibration, 'determine_station_timing_offset')
+    def test_determine_station_timing_offsets(self, mock_det_offset):
+        start = datetime(2015, 1, 2)
+        end = datetime(2015, 1, 4)
+        ts0 = datetime_to_gps(start)
+        ts1 = datetime_to_gps(datetime(2015, 1, 3))
+        self.off.data = MagicMock()
+        columns = {'timestamp': array([ts1 + 5, ts0 + 3, ts0 + 1, ts1 + 1]),
+                   'delta': array([1., 2., 3., 4.])}
+        self.off.data.get_node.return_value.col.side_effect = columns.get
+        self.off.determine_first_and_last_date = Mock()
+        self.off.determine_first_and_last_date.side_effect = [
+            (start, datetime(2015, 1, 3)), (datetime(2015, 1, 3), end)]
+        self.off._get_r_dz = Mock()
+        self.off._get_r_dz.return_value = sentinel.r, sentinel.dz
+        self.off.MIN_LEN_DT = 2
+        mock_det_offset.return_value = (10., 1.)
+
+        offsets = self.off.determine_station_timing_offsets(502, 501, start, end)
+
+        self.assertEqual(offsets, [(ts0, 10., 1.), (ts1, 10., 1.)])
+        # Timedeltas for each date in the order of the table
+        self.assertEqual(mock_det_offset.call_args_list[0][0][0].tolist(), [2., 3.])
+        self.assertEqual(mock_det_offset.call_args_list[1][0][0].tolist(), [1., 4.])
+        self.assertEqual(mock_det_offset.call_args_list[1][0][1], sentinel.dz)
+
+        self.assertRaises(ValueError, self.off.determine_station_timing_offsets, 502, 501, start, end,
+                          fit='unknown')
+
+    @patch.object(calibration, 'determine_station_timing_offset_batch')
+    def test_determine_station_timing_offsets_vectorized(self, mock_det_offset):
+        start = datetime(2015, 1, 2)
+        end = datetime(2015, 1, 4)
+        ts0 = datetime_to_gps(start)
+        ts1 = datetime_to_gps(datetime(2015, 1, 3))
+        self.off.data = MagicMock()
+        columns = {'timestamp': array([ts1 + 5, ts0 + 3, ts0 + 1, ts1 + 1]),
+                   'delta': array([1., 2., 3., 4.])}
+        self.off.data.get_node.return_value.col.side_effect = columns.get
+        self.off.determine_first_and_last_date = Mock()
+        self.off.determine_first_and_last_date.side_effect = [
+            (start, datetime(2015, 1, 3)), (datetime(2015, 1, 3), end)]
+        self.off._get_r_dz = Mock()
+        self.off._get_r_dz.return_value = sentinel.r, sentinel.dz
+        self.off.MIN_LEN_DT = 2
+        time_deltas = []
+
+        def det_offset(dts, dz):
+            time_deltas.extend(dt.tolist() for dt in dts)
+            return array([10., 11.]), array([1., 2.])
+        mock_det_offset.side_effect = det_offset
+
+        offsets = self.off.determine_station_timing_offsets(502, 501, start, end, fit='vectorized')
+
+        self.assertEqual(offsets, [(ts0, 10., 1.), (ts1, 11., 2.)])
+        # Timedeltas for each date in the order of the table
+        self.assertEqual(time_deltas, [[2., 3.], [1., 4.]])
+        self.assertEqual(mock_det_offset.call_args[0][1], [sentinel.dz, sentinel.dz])
+
+    def test_determine_station_timing_offsets_with_workers(self):
+        seed(1)
+        start = datetime(2015, 1, 2)
+        end = datetime(2015, 1, 6)
+        ts0 = datetime_to_gps(start)
+        self.off.data = MagicMock()
+        columns = {'timestamp': uniform(ts0, ts0 + 4 * 86400, 4000).astype(int),
+                   'delta': normal(10., 20., 4000).round()}
+        self.off.data.get_node.return_value.col.side_effect = columns.get
+        self.off.determine_first_and_last_date = Mock()
+        self.off.determine_first_and_last_date.side_effect = lambda date, *args: (date, date.replace(day=date.day + 1))
+        self.off._get_r_dz = Mock()
+        self.off._get_r_dz.return_value = 100., 1.
+
+        offsets = self.off.determine_station_timing_offsets(502, 501, start, end)
+        offsets_workers = self.off.determine_station_timing_offsets(502, 501, start, end, workers=2)
+
+        self.assertEqual(len(offsets), 4)
+        self.assertFalse(any(isnan(offsets)))
+        self.assertEqual(offsets_workers, offsets)
+
+        offsets_vectorized = self.off.determine_station_timing_offsets(502, 501, start, end, fit='vectorized')
+        offsets_workers = self.off.determine_station_timing_offsets(502, 501, start, end, workers=2,
+                                                                    fit='vectorized')
+        assert_array_equal(offsets_workers, offsets_vectorized)
+        # Agreement of the vectorized fit with the curve_fit reference
+        for (ts, offset, error), (ts_vectorized, offset_vectorized, error_vectorized) in zip(offsets,
+                                                                                             offsets_vectorized):
+            self.assertEqual(ts, ts_vectorized)
+            self.assertAlmostEqual(offset, offset_vectorized, delta=1e-3 * error)
+            self.assertAlmostEqual(error, error_vectorized, delta=1e-3 * error)
+
+    def test_determine_station_timing_offsets_same_as_for_each_date(self):
+        seed(1)
+        start = datetime(2015, 1, 2)
+        end = datetime(2015, 1, 6)
+        ts0 = datetime_to_gps(start)
+        self.off.data = MagicMock()
+        timestamps = uniform(ts0, ts0 + 4 * 86400, 8000).astype(int)
+        deltas = normal(10., 20., 8000).round()
+        # Flat background of accidental coincidences
+        deltas[::4] = uniform(-500, 500, 2000).round()
+        columns = {'timestamp': timestamps, 'delta': deltas}
+        self.off.data.get_node.return_value.col.side_effect = columns.get
+        self.off.read_dt = Mock()
+        self.off.read_dt.side_effect = lambda station, ref_station, left, right: deltas[
+            (timestamps >= datetime_to_gps(left)) & (timestamps < datetime_to_gps(right))]
+        self.off.determine_first_and_last_date = Mock()
+        self.off.determine_first_and_last_date.side_effect = lambda date, *args: (date, date.replace(day=date.day + 2))
+        self.off._get_r_dz = Mock()
+        self.off._get_r_dz.return_value = 100., 1.
+
+        for fit in calibration.FIT_METHODS:
+            offsets = self.off.determine_station_timing_offsets(502, 501, start, end, fit=fit)
+            self.assertEqual(len(offsets), 4)
+            for ts, offset, error in offsets:
+                expected = self.off.determine_station_timing_offset(gps_to_datetime(ts), 502, 501, fit=fit)
+                assert_array_equal(expected, (offset, error))
+
+    def test_determine_station_timing_offsets_as_per_date_loop(self):
+        """Compare with reading and fitting the timedeltas for each date"""
+
+        seed(1)
+        start = datetime(2016, 1, 1)
+        end = datetime(2016, 1, 10)
+        ts0 = datetime_to_gps(start)
+        n = 20000
+        time_deltas = zeros(n, dtype=[('ext_timestamp', 'u8'), ('timestamp', 'u4'),
+                                      ('nanoseconds', 'u4'), ('delta', 'f8')])
+        time_deltas['timestamp'] = uniform(ts0, ts0 + 7 * 86400, n)
+        time_deltas['delta'] = normal(-35., 25., n).round()
+        # Flat background of accidental coincidences
+        time_deltas['delta'][::3] = uniform(-1000., 1000., len(time_deltas[::3])).round()
+        fd, path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        self.off.data = tables.open_file(path, 'w')
+        try:
+            self.off.data.create_table('/coincidences/time_deltas/station_501/station_502', 'time_deltas',
+                                       time_deltas, createparents=True)
+            self.off.determine_first_and_last_date = Mock()
+            self.off.determine_first_and_last_date.side_effect = lambda date, *args: (date, date + timedelta(days=2))
+            self.off._get_r_dz = Mock()
+            self.off._get_r_dz.return_value = 100., 1.
+
+            expected = []
+            for day in range(9):
+                date = start + timedelta(days=day)
+                dt = self.off.read_dt(502, 501, date, date + timedelta(days=2))
+                if len(dt) < self.off.MIN_LEN_DT:
+                    s_off, error = nan, nan
+                else:
+                    s_off, error = calibration.determine_station_timing_offset(dt, 1.)
+                expected.append((datetime_to_gps(date), s_off, error))
+
+            offsets = self.off.determine_station_timing_offsets(502, 501, start, end)
+            offsets_workers = self.off.determine_station_timing_offsets(502, 501, start, end, workers=2)
+        finally:
+            self.off.data.close()
+            os.remove(path)
+
+        self.assertTrue(isnan(expected[-1][1]))
+        assert_array_equal(offsets, expected)
+        assert_array_equal(offsets_workers, expected)
+
+    def test_determine_station_timing_offsets_for_date_with_workers(self):
+        seed(1)
+        dt = [normal(10., 20., 1000).round(), normal(-10., 20., 1000).round(), normal(0., 20., 10).round()]
+        self.off.get_station_pairs_within_max_distance = Mock()
+        self.off.get_station_pairs_within_max_distance.return_value = [(501, 502), (501, 503), (502, 503)]
+        self.off._read_dt_and_dz = Mock()
+        self.off._read_dt_and_dz.side_effect = lambda date, station, ref_station: (dt[station + ref_station - 1003], 0.)
+
+        offsets = self.off.determine_station_timing_offsets_for_date(date(2015, 1, 2))
+        offsets_workers = self.off.determine_station_timing_offsets_for_date(date(2015, 1, 2), workers=2)
+
+        self.assertEqual([offset[:2] for offset in offsets], [(501, 502), (501, 503), (502, 503)])
+        self.assertFalse(any(isnan([offset[2:] for offset in offsets[:2]])))
+        self.assertTrue(all(isnan(offsets[2][2:])))
+        for offset, offset_workers in zip(offsets, offsets_workers):
+            assert_array_equal(offset, offset_workers)
+
+        offsets_vectorized = self.off.determine_station_timing_offsets_for_date(date(2015, 1, 2), fit='vectorized')
+        offsets_workers = self.off.determine_station_timing_offsets_for_date(date(2015, 1, 2), workers=2,
+                                                                             fit='vectorized')
+        for offset, offset_vectorized, offset_workers in zip(offsets, offsets_vectorized, offsets_workers):
+            assert_array_equal(offset_vectorized, offset_workers)
+            self.assertEqual(offset[:2], offset_vectorized[:2])
+            if isnan(offset[2]):
+                self.assertTrue(all(isnan(offset_vectorized[2:])))
+            else:
+                self.assertAlmostEqual(offset[2], offset_vectorized[2], delta=1e-3 * offset[3])
+                self.assertAlmostEqual(offset[3], offset_vectorized[3], delta=1e-3 * offset[3])
+
+
+class TimingCalibrationStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        seed(2)
+        fd, self.path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        self.data = tables.open_file(self.path, 'w')
+        self.store = calibration.TimingCalibrationStore(self.data)
+        self.start = datetime(2016, 1, 1)
+        self.end = datetime(2016, 1, 6)
+
+        n = 20000
+        ts0 = datetime_to_gps(self.start)
+        self.events = zeros(n, dtype=[('timestamp', 'u4')] +
+                            [('t%d' % i, 'f4') for i in range(1, 5)] +
+                            [('n%d' % i, 'f4') for i in range(1, 5)])
+        self.events['timestamp'] = sorted(uniform(ts0, ts0 + 5 * 86400, n))
+        t = normal(200, 30, n)
+        for i, offset in enumerate([3., 0., -7.5, 12.], 1):
+            self.events['t%d' % i] = round((t + offset + normal(0, 6, n)) / 2.5) * 2.5
+            self.events['n%d' % i] = exponential(1, n)
+        self.events['t3'][::3] = -999
+
+        self.time_deltas = zeros(n, dtype=[('ext_timestamp', 'u8'), ('timestamp', 'u4'),
+                                           ('nanoseconds', 'u4'), ('delta', 'f8')])
+        self.time_deltas['timestamp'] = self.events['timestamp']
+        self.time_deltas['delta'] = normal(37.3, 25, n)
+
+    def tearDown(self):
+        warnings.resetwarnings()
+        self.data.close()
+        os.remove(self.path)
+
+    def test_detector_timing_offsets(self):
+        events = self.data.create_table('/s501', 'events', self.events[:5000], createparents=True)
+        self.store.update_detector_histograms(501, events)
+        events.append(self.events[5000:])
+        self.store.update_detector_histograms(501, events, chunk_size=4000)
+
+        histograms = self.data.root.calibration.detectors.station_501
+        self.assertEqual(histograms.attrs.processed_rows, len(self.events))
+        self.assertEqual(len(histograms), 5)
+        self.assertEqual(histograms.col('reference').sum(axis=0)[1],
+                         ((self.events['n2'] > 0.3) &
+                          ((self.events['n1'] > 0.3) | (self.events['n3'] > 0.3) & (self.events['t3'] >= 0) |
+                           (self.events['n4'] > 0.3))).sum())
+
+        expected = calibration.determine_detector_timing_offsets(events)
+        offsets = self.store.determine_detector_timing_offsets(501, self.start, self.end)
+        for expected_offset, offset in zip(expected, offsets):
+            self.assertAlmostEqual(expected_offset, offset, 6)
+
+        offsets = self.store.determine_detector_timing_offsets(501, self.end, datetime(2016, 1, 8))
+        self.assertTrue(all(isnan(offsets)))
+
+    def test_station_timing_offset(self):
+        time_deltas = self.data.create_table('/td', 'time_deltas', TimeDelta, createparents=True)
+        time_deltas.append(self.time_deltas)
+        self.store.update_station_histograms(502, 501, time_deltas)
+
+        expected = calibration.determine_station_timing_offset(self.time_deltas['delta'], 1.5)
+        offset = self.store.determine_station_timing_offset(502, 501, self.start, self.end, 1.5)
+        self.assertAlmostEqual(expected[0], offset[0], delta=expected[1])
+        self.assertAlmostEqual(expected[1], offset[1], delta=0.1 * expected[1])
+
+        offset = self.store.determine_station_timing_offset(502, 501, self.start, self.end,
+                                                            min_n=len(self.time_deltas) + 1)
+        self.assertTrue(all(isnan(offset)))
+
+    def test_station_timing_offsets(self):
+        time_deltas = self.data.create_table('/td', 'time_deltas', TimeDelta, createparents=True)
+        time_deltas.append(self.time_deltas)
+        self.store.update_station_histograms(502, 501, time_deltas)
+
+        intervals = [(self.start, self.end), (self.start, datetime(2016, 1, 3)),
+                     (datetime(2016, 1, 4), self.end), (self.end, datetime(2016, 1, 8))]
+        dz = [1.5, 0., -1.5, 0.]
+        for fit in calibration.FIT_METHODS:
+            offsets, errors = self.store.determine_station_timing_offsets(502, 501, intervals, dz, fit=fit)
+            for (start, end), dz_i, offset, error in zip(intervals, dz, offsets, errors):
+                expected = self.store.determine_station_timing_offset(502, 501, start, end, dz_i, fit=fit)
+                assert_array_equal(expected, (offset, error))
+            self.assertFalse(any(isnan(offsets[:3])))
+            self.assertTrue(isnan(offsets[3]))
+
+        # Agreement of the vectorized fit with the curve_fit reference
+        offsets, errors = self.store.determine_station_timing_offsets(502, 501, intervals, dz)
+        vectorized = self.store.determine_station_timing_offsets(502, 501, intervals, dz, fit='vectorized')
+        for offset, error, offset_vectorized, error_vectorized in zip(offsets[:3], errors[:3], *vectorized):
+            self.assertAlmostEqual(offset, offset_vectorized, delta=1e-2 * error)
+            self.assertAlmostEqual(error, error_vectorized, delta=1e-2 * error)
+
+        offsets, errors = self.store.determine_station_timing_offsets(502, 501, intervals[:2], min_n=10000)
+        self.assertFalse(isnan(offsets[0]))
+        self.assertTrue(isnan(offsets[1]))
+
+    def test_histogram_percentiles(self):
+        values = array([-2.5, 0., 2.5, 5., 10.])
+        counts = array([3, 10, 0, 4, 1])
+        dt = values.repeat(counts)
+        for q in ([0.5, 99.5], [0, 100], [50, 75]):
+            self.assertEqual(calibration._histogram_percentiles(values, counts, q).tolist(),
+                             percentile(dt, q).tolist())
+
+        # Percentiles of several histograms at once
+        counts = array([[3, 10, 0, 4, 1], [0, 1, 5, 5, 0]])
+        result = calibration._histogram_percentiles(values, counts, [0.5, 99.5])
+        for y, percentiles in zip(counts, result):
+            self.assertEqual(percentiles.tolist(), percentile(values.repeat(y), [0.5, 99.5]).tolist())
+
+    def test_determine_detector_timing_offset_histograms(self):
+        histograms = []
+        for offset, n in [(3., 20000), (-7.5, 5000), (12., 800), (150., 2000)]:
+            dt = round(normal(offset, 8, n) / 2.5) * 2.5
+            histograms.append(histogram(dt, calibration.DETECTOR_DT_BINS)[0])
+        histograms.append(zeros(len(calibration.DETECTOR_DT_BINS) - 1))
+        dz = [0., 1.5, -1.5, 0., 0.]
+        offsets, errors = calibration.determine_detector_timing_offset_histograms(histograms, dz)
+        for y, dz_i, offset, error in zip(histograms, dz, offsets, errors):
+            expected = calibration.determine_detector_timing_offset_histogram(y, y.sum(), 0., 100. * y.sum(), dz_i)
+            if isnan(expected[0]):
+                self.assertTrue(isnan(offset))
+                self.assertTrue(isnan(error))
+            else:
+                self.assertAlmostEqual(expected[0], offset, delta=1e-3 * expected[1])
+                self.assertAlmostEqual(expected[1], error, delta=1e-3 * expected[1])
+        self.assertTrue(isnan(offsets[-1]))
+
+    def test_determine_station_timing_offset_histograms(self):
+        histograms = []
+        for offset, sigma, n in [(37.3, 25, 20000), (-120., 40, 5000), (12., 8, 800), (0., 10, 10)]:
+            dt = normal(offset, sigma, n)
+            histograms.append((histogram(dt, calibration.STATION_DT_BINS)[0], n, dt.sum(), (dt ** 2).sum()))
+        histograms.append((zeros(len(calibration.STATION_DT_BINS) - 1, dtype=int), 0, 0., 0.))
+        dz = [0., 1.5, -1.5, 0., 0.]
+        offsets, errors = calibration.determine_station_timing_offset_histograms(
+            [y for y, _, _, _ in histograms], [n for _, n, _, _ in histograms], dz)
+        for (y, n, dt_sum, dt_sum_of_squares), dz_i, offset, error in zip(histograms, dz, offsets, errors):
+            expected = calibration.determine_station_timing_offset_histogram(y, n, dt_sum, dt_sum_of_squares, dz_i)
+            if isnan(expected[0]):
+                self.assertTrue(isnan(offset))
+                self.assertTrue(isnan(error))
+            else:
+                self.assertAlmostEqual(expected[0], offset, delta=1e-2 * expected[1])
+                self.assertAlmostEqual(expected[1], error, delta=1e-2 * expected[1])
+        self.assertFalse(any(isnan(offsets[:3])))
+        self.assertTrue(all(isnan(offsets[3:])))
+
 
 if __name__ == '__main__':
     unittest.main()
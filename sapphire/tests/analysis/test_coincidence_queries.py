@@ -1,10 +1,19 @@
 import unittest
+import os
+import shutil
+import tempfile
+import warnings
 
+import tables
 from mock import sentinel, patch, call
+from numpy.testing import assert_array_equal
 
 from sapphire.analysis import coincidence_queries
 
 
+TEST_DATA_FILE = 'test_data/esd_coincidences.h5'
+
+
 class BaseCoincidenceQueryTest(unittest.TestCase):
 
     @patch.object(coincidence_queries.tables, 'open_file')
@@ -182,5 +191,132 @@ class BaseCoincidenceQueryTest(unittest.TestCase):
         self.assertEqual(result, sentinel.coincidence_events)
 
 
+class CoincidenceQueryIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.data_path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), TEST_DATA_FILE),
+                        self.data_path)
+        self.data = tables.open_file(self.data_path, 'a')
+        self.cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.indexed_cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.indexed_cq.build_index()
+
+    def tearDown(self):
+        self.data.close()
+        os.remove(self.data_path)
+
+    def assert_same_coincidences(self, expected, result):
+        assert_array_equal(expected, result)
+        self.assertEqual(expected.dtype, result.dtype)
+
+    def test_build_index(self):
+        self.assertIsNone(self.cq.station_mask)
+        coincidences = self.data.root.coincidences.coincidences.read()
+        self.assertEqual(self.indexed_cq.station_mask.shape, (len(coincidences), 1))
+        assert_array_equal(self.indexed_cq.station_mask[:, 0],
+                           coincidences['s501'] + 2 * coincidences['s502'])
+        self.assertEqual(self.indexed_cq.station_bits, {'s501': 0, 's502': 1})
+        self.assertTrue((self.indexed_cq.timestamp_index['timestamp'][1:] >=
+                         self.indexed_cq.timestamp_index['timestamp'][:-1]).all())
+
+    def test_queries(self):
+        timestamps = self.cq.coincidences.col('timestamp')
+        start = timestamps.min()
+        stop = timestamps.max()
+        for stations in ([501], [502], [501, 502], [501, 503]):
+            for start, stop in [(None, None), (start, None), (None, stop), (start, stop), (stop, stop + 1)]:
+                self.assert_same_coincidences(self.cq.any(stations, start, stop),
+                                              self.indexed_cq.any(stations, start, stop))
+                self.assert_same_coincidences(self.cq.all(stations[:1], start, stop),
+                                              self.indexed_cq.all(stations[:1], start, stop))
+                self.assert_same_coincidences(self.cq.at_least(stations, 1, start, stop),
+                                              self.indexed_cq.at_least(stations, 1, start, stop))
+        self.assert_same_coincidences(self.cq.all([501, 502]), self.indexed_cq.all([501, 502]))
+        self.assert_same_coincidences(self.cq.at_least([501, 502], 2), self.indexed_cq.at_least([501, 502], 2))
+        self.assertEqual(self.indexed_cq.all([501, 503]), [])
+        self.assertEqual(self.indexed_cq.any([503]), [])
+        self.assert_same_coincidences(self.cq.timerange(start, stop), self.indexed_cq.timerange(start, stop))
+        self.assertEqual([row['id'] for row in self.cq.any([502], iterator=True)],
+                         [row['id'] for row in self.indexed_cq.any([502], iterator=True)])
+
+    def test_persisted_index(self):
+        self.indexed_cq.build_index(persist=True)
+        self.assertIn('station_mask', self.data.root.coincidences)
+        self.assertIn('timestamp_index', self.data.root.coincidences)
+
+        cq = coincidence_queries.CoincidenceQuery(self.data)
+        assert_array_equal(cq.station_mask, self.indexed_cq.station_mask)
+        self.assertEqual(cq.station_bits, self.indexed_cq.station_bits)
+        assert_array_equal(cq.timestamp_index, self.indexed_cq.timestamp_index)
+
+        # Outdated index is not used
+        self.data.root.coincidences.coincidences.append(
+            self.data.root.coincidences.coincidences[:1])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.assertIsNone(cq.station_mask)
+        self.assertEqual(len(caught), 1)
+
+
+class CoincidenceQueryBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.data_path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), TEST_DATA_FILE),
+                        self.data_path)
+        self.cq = coincidence_queries.CoincidenceQuery(self.data_path)
+
+    def tearDown(self):
+        self.cq.finish()
+        os.remove(self.data_path)
+
+    def assert_same_events(self, expected, result):
+        expected = list(expected)
+        result = list(result)
+        self.assertEqual(len(expected), len(result))
+        for expected_events, events in zip(expected, result):
+            self.assertEqual([number for number, _ in expected_events],
+                             [number for number, _ in events])
+            for (_, expected_event), (_, event) in zip(expected_events, events):
+                self.assertEqual(expected_event.dtype, event.dtype)
+                assert_array_equal(expected_event, event)
+
+    def test_all_events(self):
+        coincidences = self.cq.all_coincidences()
+        for batch_size in [1, 2, 1000]:
+            self.assert_same_events(
+                self.cq.all_events(coincidences),
+                self.cq.all_events(self.cq.all_coincidences(iterator=True),
+                                   batch_size=batch_size))
+            self.assert_same_events(
+                self.cq.all_events(coincidences[::-1], n=2),
+                self.cq.all_events(coincidences[::-1], n=2,
+                                   batch_size=batch_size))
+
+    def test_events_from_stations(self):
+        coincidences = self.cq.all_coincidences()
+        for stations in ([501], [502], [501, 502]):
+            self.assert_same_events(
+                self.cq.events_from_stations(coincidences, stations, n=1),
+                self.cq.events_from_stations(coincidences, stations, n=1,
+                                             batch_size=2))
+
+    def test_missing_station_group(self):
+        self.cq.s_nodes[1] = None
+        coincidences = self.cq.all_coincidences()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            expected = list(self.cq.all_events(coincidences))
+            result = list(self.cq.all_events(coincidences, batch_size=1000))
+        self.assertTrue(caught)
+        self.assert_same_events(expected, result)
+        for events in result:
+            self.assertEqual([number for number, _ in events], [501])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,16 +3,19 @@ import tempfile
 import os
 import shutil
 
-from mock import sentinel, patch, Mock
+from mock import sentinel, patch, Mock, MagicMock
 import tables
-from numpy import uint64
+from numpy import uint64, array, concatenate, newaxis
+from numpy.testing import assert_array_equal
 
+from sapphire import storage
 from sapphire.analysis import coincidences
 from sapphire.tests.validate_results import validate_results
 
 
 TEST_DATA = 'test_data/coincidences.h5'
 TEST_DATA_ESD = 'test_data/esd_coincidences.h5'
+TEST_DATA_TRACES = 'test_data/process_events.h5'
 
 
 class CoincidencesTests(unittest.TestCase):
@@ -35,11 +38,11 @@ class CoincidencesTests(unittest.TestCase):
                                            mock_search):
         self.c.search_and_store_coincidences()
         mock_search.assert_called_with(window=10000)
-        mock_process.assert_called_with()
+        mock_process.assert_called_with(workers=None)
         mock_store.assert_called_with()
-        self.c.search_and_store_coincidences(sentinel.window)
+        self.c.search_and_store_coincidences(sentinel.window, sentinel.workers)
         mock_search.assert_called_with(window=sentinel.window)
-        mock_process.assert_called_with()
+        mock_process.assert_called_with(workers=sentinel.workers)
         mock_store.assert_called_with()
 
     def test__retrieve_timestamps(self):
@@ -50,43 +53,60 @@ class CoincidencesTests(unittest.TestCase):
         station2.col.return_value = [uint64(1400000002000000510), uint64(1400000030000000000)][::-1]
         stations = [station1, station2]
         timestamps = self.c._retrieve_timestamps(stations)
-        self.assertEqual(timestamps,
-                         [(uint64(1400000002000000050), 0, 0), (uint64(1400000002000000510), 1, 1),
-                          (uint64(1400000018000000500), 0, 1), (uint64(1400000030000000000), 1, 0)])
+        self.assertEqual(timestamps.dtype, coincidences.TIMESTAMPS_DTYPE)
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000002000000050, 0, 0), (1400000002000000510, 1, 1),
+                          (1400000018000000500, 0, 1), (1400000030000000000, 1, 0)])
         # Shift both
         timestamps = self.c._retrieve_timestamps(stations, shifts=[1, 17])
-        self.assertEqual(timestamps,
-                         [(uint64(1400000003000000050), 0, 0), (uint64(1400000019000000500), 0, 1),
-                          (uint64(1400000019000000510), 1, 1), (uint64(1400000047000000000), 1, 0)])
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000003000000050, 0, 0), (1400000019000000500, 0, 1),
+                          (1400000019000000510, 1, 1), (1400000047000000000, 1, 0)])
         # Wrong value type shifts
         self.assertRaises(TypeError, self.c._retrieve_timestamps, stations, shifts=['', ''])
         self.assertRaises(TypeError, self.c._retrieve_timestamps, stations, shifts=['', 90])
         # Different length shifts
         timestamps = self.c._retrieve_timestamps(stations, shifts=[110])
-        self.assertEqual(timestamps,
-                         [(uint64(1400000002000000510), 1, 1), (uint64(1400000030000000000), 1, 0),
-                          (uint64(1400000112000000050), 0, 0), (uint64(1400000128000000500), 0, 1)])
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000002000000510, 1, 1), (1400000030000000000, 1, 0),
+                          (1400000112000000050, 0, 0), (1400000128000000500, 0, 1)])
         timestamps = self.c._retrieve_timestamps(stations, shifts=[None, 60])
-        self.assertEqual(timestamps,
-                         [(uint64(1400000002000000050), 0, 0), (uint64(1400000018000000500), 0, 1),
-                          (uint64(1400000062000000510), 1, 1), (uint64(1400000090000000000), 1, 0)])
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000002000000050, 0, 0), (1400000018000000500, 0, 1),
+                          (1400000062000000510, 1, 1), (1400000090000000000, 1, 0)])
+        # Negative shifts
+        timestamps = self.c._retrieve_timestamps(stations, shifts=[-1, -12])
+        self.assertEqual(timestamps.tolist(),
+                         [(1399999990000000510, 1, 1), (1400000001000000050, 0, 0),
+                          (1400000017000000500, 0, 1), (1400000018000000000, 1, 0)])
         # Subsecond shifts
         timestamps = self.c._retrieve_timestamps(stations, shifts=[3e-9, 5e-9])
-        self.assertEqual(timestamps,
-                         [(uint64(1400000002000000053), 0, 0), (uint64(1400000002000000515), 1, 1),
-                          (uint64(1400000018000000503), 0, 1), (uint64(1400000030000000005), 1, 0)])
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000002000000053, 0, 0), (1400000002000000515, 1, 1),
+                          (1400000018000000503, 0, 1), (1400000030000000005, 1, 0)])
+        timestamps = self.c._retrieve_timestamps(stations, shifts=[1.1e-8, None])
+        self.assertEqual(timestamps['timestamp'][0], uint64(1400000002000000061))
         # Using limits
         timestamps = self.c._retrieve_timestamps(stations, limit=1)
-        self.assertEqual(timestamps,
-                         [(uint64(1400000002000000050), 0, 0), (uint64(1400000030000000000), 1, 0)])
-        # This should fail but does not
-        self.assertEqual(timestamps,
-                         [(1400000002000000049, 0, 0), (1400000030000000000, 1, 0)])
-        # Using uint64 does work correctly
-        self.assertNotEqual(timestamps,
-                            [(uint64(1400000002000000049), 0, 0), (uint64(1400000030000000000), 1, 0)])
-        self.assertNotEqual(timestamps,
-                            [(uint64(1400000002000000051), 0, 0), (uint64(1400000030000000001), 1, 0)])
+        self.assertEqual(timestamps.tolist(),
+                         [(1400000002000000050, 0, 0), (1400000030000000000, 1, 0)])
+        # Timestamps keep nanosecond precision
+        self.assertNotEqual(timestamps.tolist(),
+                            [(1400000002000000049, 0, 0), (1400000030000000000, 1, 0)])
+        self.assertNotEqual(timestamps.tolist(),
+                            [(1400000002000000051, 0, 0), (1400000030000000001, 1, 0)])
+        # Equal timestamps are ordered by station and event index
+        station1.col.return_value = [uint64(10), uint64(20), uint64(20)]
+        station2.col.return_value = [uint64(10), uint64(20)]
+        timestamps = self.c._retrieve_timestamps(stations)
+        self.assertEqual(timestamps.tolist(),
+                         [(10, 0, 0), (10, 1, 0), (20, 0, 1), (20, 0, 2), (20, 1, 1)])
+        # No events
+        station1.col.return_value = []
+        station2.col.return_value = []
+        timestamps = self.c._retrieve_timestamps(stations)
+        self.assertEqual(len(timestamps), 0)
+        self.assertEqual(timestamps.dtype, coincidences.TIMESTAMPS_DTYPE)
 
     def test__do_search_coincidences(self):
         # [(timestamp, station_idx, event_idx), ..]
@@ -106,6 +126,88 @@ class CoincidencesTests(unittest.TestCase):
         expected_coincidences = [[0, 1, 2, 3, 4, 5, 6, 7]]
         self.assertEqual(c, expected_coincidences)
 
+        c = self.c._do_search_coincidences(timestamps, window=5.5)
+        expected_coincidences = [[0, 1], [2, 3], [6, 7]]
+        self.assertEqual(c, expected_coincidences)
+
+        c = self.c._do_search_coincidences(timestamps, window=5)
+        expected_coincidences = [[0, 1], [6, 7]]
+        self.assertEqual(c, expected_coincidences)
+
+        self.assertEqual(self.c._do_search_coincidences([], window=6), [])
+
+        # Structured timestamps array, as returned by _retrieve_timestamps
+        timestamps = array(timestamps, dtype=coincidences.TIMESTAMPS_DTYPE)
+        c = self.c._do_search_coincidences(timestamps, window=6)
+        expected_coincidences = [[0, 1], [2, 3], [6, 7]]
+        self.assertEqual(c, expected_coincidences)
+
+    def test__iter_timestamps_in_chunks(self):
+        station1 = self.mock_event_table([5, 10, 20, 20, 30, 31])
+        station2 = self.mock_event_table([10, 20, 20, 25])
+        station3 = self.mock_event_table([])
+        stations = [station1, station2, station3]
+        expected = self.c._retrieve_timestamps(stations).tolist()
+        for chunk_size in [1, 2, 3, 10]:
+            chunks = list(self.c._iter_timestamps_in_chunks(
+                stations, chunk_size=chunk_size))
+            self.assertTrue(all(len(chunk) for chunk in chunks))
+            self.assertEqual(concatenate(chunks).tolist(), expected)
+
+        expected = self.c._retrieve_timestamps(stations, [1e-8]).tolist()
+        chunks = self.c._iter_timestamps_in_chunks(stations, [1e-8], 2)
+        self.assertEqual(concatenate(list(chunks)).tolist(), expected)
+
+        station2 = self.mock_event_table([10, 20, 15])
+        chunks = self.c._iter_timestamps_in_chunks([station1, station2],
+                                                   chunk_size=2)
+        self.assertRaises(RuntimeError, list, chunks)
+
+    def test__search_coincidences_in_chunks(self):
+        station1 = self.mock_event_table([0, 250, 251])
+        station2 = self.mock_event_table([0, 10, 100])
+        station3 = self.mock_event_table([15, 200])
+        stations = [station1, station2, station3]
+        timestamps = self.c._retrieve_timestamps(stations)
+        for window in [6, 150, 300]:
+            expected = [timestamps[coincidence].tolist() for coincidence
+                        in self.c._do_search_coincidences(timestamps, window)]
+            for chunk_size in [1, 2, 5]:
+                chunks = self.c._search_coincidences_in_chunks(
+                    stations, window, chunk_size=chunk_size)
+                result = [chunk[coincidence].tolist()
+                          for chunk, coincidences in chunks
+                          for coincidence in coincidences]
+                self.assertEqual(result, expected)
+
+    def test__new_coincidence_rows(self):
+        with tables.open_file('coincidences.h5', 'w', driver='H5FD_CORE',
+                              driver_core_backing_store=0) as data:
+            self.c.coincidences = data.create_table('/', 'coincidences',
+                                                    storage.Coincidence)
+            self.c.coincidences.row.append()
+            self.c.coincidences.flush()
+            events = {'ext_timestamp': array([5000000020, 5000000010, 7000000000,
+                                              6000000005, 6000000001, 6000000003]),
+                      'timestamp': array([5, 5, 7, 6, 6, 6]),
+                      'nanoseconds': array([20, 10, 0, 5, 1, 3])}
+            rows = self.c._new_coincidence_rows([[0, 1], [2, 3, 4, 5]], events)
+        self.assertEqual(rows['id'].tolist(), [1, 2])
+        self.assertEqual(rows['N'].tolist(), [2, 4])
+        self.assertEqual(rows['ext_timestamp'].tolist(), [5000000010, 6000000001])
+        self.assertEqual(rows['timestamp'].tolist(), [5, 6])
+        self.assertEqual(rows['nanoseconds'].tolist(), [10, 1])
+        self.assertEqual(rows['energy'].tolist(), [0., 0.])
+
+    def mock_event_table(self, ext_timestamps):
+        ext_timestamps = array(ext_timestamps, dtype=uint64)
+        event_table = MagicMock()
+        event_table.__len__.return_value = len(ext_timestamps)
+        event_table.col.return_value = ext_timestamps
+        event_table.read.side_effect = \
+            lambda start, stop, field: ext_timestamps[start:stop]
+        return event_table
+
 
 class CoincidencesESDTests(CoincidencesTests):
 
@@ -192,10 +294,98 @@ class CoincidencesESDDataTests(CoincidencesDataTests):
             c.search_and_store_coincidences(station_numbers=[501, 502])
         validate_results(self, self.get_testdata_path(), self.data_path)
 
+    def test_coincidencesesd_output_in_chunks(self):
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, '/coincidences',
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_and_store_coincidences_in_chunks(
+                station_numbers=[501, 502], chunk_size=7)
+        validate_results(self, self.get_testdata_path(), self.data_path)
+
     def get_testdata_path(self):
         dir_path = os.path.dirname(__file__)
         return os.path.join(dir_path, TEST_DATA_ESD)
 
 
+class CoincidenceEventsReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        data_path = os.path.join(os.path.dirname(__file__),
+                                 TEST_DATA_TRACES)
+        self.data = tables.open_file(data_path, 'r')
+        self.reader = coincidences.CoincidenceEventsReader(
+            self.data, ['/s501', '/s501'])
+        self.timestamps = [(uint64(0), 0, 0), (uint64(1), 1, 10),
+                           (uint64(2), 0, 10)]
+
+    def tearDown(self):
+        self.data.close()
+
+    def test_get_events(self):
+        events = self.reader.get_events([0, 1], self.timestamps)
+        self.assertEqual(len(events), 2)
+        station, event, traces = events[1]
+        self.assertEqual(station, '/s501')
+        self.assertEqual(event, self.data.root.s501.events[10])
+        self.assertEqual(len(traces), 4)
+
+        # Traces relative to the baseline, in mV
+        raw_traces = self.reader._get_process(0).get_traces_for_event(event).T
+        baseline = event['baseline']
+        assert_array_equal(traces, (raw_traces - baseline[:, newaxis]) * -0.57)
+
+    def test_get_raw_traces(self):
+        events = self.reader.get_events([2], self.timestamps,
+                                        get_raw_traces=True)
+        station, event, traces = events[0]
+        blobs = self.data.root.s501.blobs
+        self.assertEqual(traces, [blobs[idx] for idx in event['traces']])
+
+    def test_get_events_for_coincidences(self):
+        coincidences = [[0, 1], [1, 2], [2]]
+        result = self.reader.get_events_for_coincidences(coincidences,
+                                                         self.timestamps)
+        self.assertEqual([len(events) for events in result], [2, 2, 1])
+        # The same event of the same station is decoded only once
+        self.assertIs(result[0][1][2], result[1][0][2])
+        self.assertIsNot(result[1][0][2], result[1][1][2])
+        assert_array_equal(result[1][0][2], result[1][1][2])
+        for events, coincidence in zip(result, coincidences):
+            for event, idx in zip(events, coincidence):
+                expected = self.reader.get_events([idx], self.timestamps)[0]
+                assert_array_equal(event[2], expected[2])
+
+    def test_cached_traces_read_only(self):
+        traces = self.reader.get_events([0, 1], self.timestamps)[1][2]
+        expected = traces.copy()
+        with self.assertRaises(ValueError):
+            traces[0, 0] = 1.
+        assert_array_equal(self.reader.get_events([1], self.timestamps)[0][2], expected)
+
+    def test_get_events_function(self):
+        events = coincidences.get_events(self.data, ['/s501', '/s501'], [0, 1], self.timestamps)
+        expected = self.reader.get_events([0, 1], self.timestamps)
+        for (station, event, traces), (_, _, expected_traces) in zip(events, expected):
+            assert_array_equal(traces, expected_traces)
+            # Not shared with a cache, so the traces can be modified
+            self.assertTrue(traces.flags.writeable)
+
+    def test_cache_size(self):
+        self.reader.get_events([0, 1, 2], self.timestamps)
+        self.assertEqual(len(self.reader._cache), 3)
+        nbytes = self.reader._cache_nbytes
+
+        reader = coincidences.CoincidenceEventsReader(
+            self.data, ['/s501', '/s501'], cache_size=nbytes - 1)
+        reader.get_events([0, 1, 2], self.timestamps)
+        self.assertEqual(list(reader._cache.keys()), [(0, 10), (1, 10)])
+        # Reading a cached event makes it the most recently used
+        reader.get_events([1], self.timestamps)
+        self.assertEqual(list(reader._cache.keys()), [(0, 10), (1, 10)])
+        reader.get_events([2], self.timestamps)
+        self.assertEqual(list(reader._cache.keys()), [(1, 10), (0, 10)])
+
+
 if __name__ == '__main__':
     unittest.main()
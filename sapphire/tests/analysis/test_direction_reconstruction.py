@@ -2,9 +2,11 @@ import unittest
 import warnings
 
 from mock import sentinel, patch, Mock, MagicMock
-from numpy import isnan, nan, pi, sqrt, arcsin, arctan, array
+from numpy import isnan, nan, pi, sqrt, arcsin, arctan, array, zeros, all, sin, cos
+from numpy.random import seed, normal, uniform, randint
 
 from sapphire.analysis import direction_reconstruction
+from sapphire.clusters import BaseCluster
 from sapphire.simulations.showerfront import ConeFront
 
 
@@ -96,6 +98,62 @@ class EventDirectionReconstructionTest(unittest.TestCase):
                          ((), (), ()))
         self.assertEqual(mock_reconstruct_event.call_count, 2)
 
+    def test_reconstruct_events_batch(self):
+        cluster = BaseCluster()
+        detectors = [(([0., 1.], [8.66, 8.], [0., .5]), 'UD'), (([0., 0.], [2.89, 3.], [0., 0.]), 'UD'),
+                     (([-5., -5.5], [0., 0.], [0., 0.]), 'LR'), (([5., 5.], [0., 0.], [0., 0.]), 'LR')]
+        cluster._add_station(([0., 10.], [0., 0.], [0., 1.]), [0., .3], detectors,
+                             station_timestamps=[0, 1300], detector_timestamps=[0, 1700])
+        dirrec = direction_reconstruction.EventDirectionReconstruction(cluster.stations[0])
+
+        seed(1)
+        n = 500
+        events = zeros(n, dtype=[('timestamp', 'u4')] + [('t%d' % i, 'f4') for i in range(1, 5)])
+        events['timestamp'] = sorted(randint(1000, 2000, n))
+        for i in range(1, 5):
+            t = normal(20, 10, n).round()
+            t[randint(0, 4, n) == 0] = -999
+            t[randint(0, 20, n) == 0] = -1
+            events['t%d' % i] = t
+
+        offsets = MagicMock(spec=direction_reconstruction.Station)
+        offsets.detector_timing_offsets = array([(0, 1., 0., -2.5, 3.), (1500, 2., 0., -1., 0.)],
+                                                dtype=[('timestamp', 'u4')] +
+                                                      [('offset%d' % i, 'f8') for i in range(1, 5)])
+        offsets.detector_timing_offset.side_effect = (
+            lambda ts: list(offsets.detector_timing_offsets[int(ts >= 1500)])[1:])
+
+        for detector_ids, initials in [(None, []), ([0, 1, 3], [{'core_x': 0., 'core_y': 0.}] * 10)]:
+            theta, phi, ids = dirrec.reconstruct_events_batch(events, detector_ids, offsets, progress=False,
+                                                              initials=initials, chunk_size=200)
+            self.assertEqual(len(theta), n)
+            self.assertFalse(all(isnan(theta)))
+            initials = iter(initials)
+            for event, event_theta, event_phi, event_ids in zip(events, theta, phi, ids):
+                expected = dirrec.reconstruct_event(event, detector_ids, offsets, next(initials, None))
+                self.assertEqual(expected[2], event_ids)
+                self.assertEqual(isnan(expected[0]), isnan(event_theta))
+                if not isnan(expected[0]):
+                    self.assertAlmostEqual(expected[0], event_theta)
+                    self.assertAlmostEqual(expected[1], event_phi)
+
+        # Two detector station, no arrival times for the missing detectors
+        cluster = BaseCluster()
+        cluster._add_station((0., 0., 0.), 0., [((-5., 0., 0.), 'LR'), ((5., 0., 0.), 'LR')])
+        dirrec = direction_reconstruction.EventDirectionReconstruction(cluster.stations[0])
+        events['t3'] = -1
+        events['t4'] = -1
+        theta, phi, ids = dirrec.reconstruct_events(events, progress=False)
+        self.assertTrue(all(isnan(theta)))
+        self.assertTrue(all(isnan(phi)))
+        self.assertEqual(list(ids), [dirrec.reconstruct_event(event)[2] for event in events])
+
+        # Tables and arrays are reconstructed in batches
+        with patch.object(direction_reconstruction.EventDirectionReconstruction,
+                          'reconstruct_events_batch') as mock_batch:
+            dirrec.reconstruct_events(events, sentinel.detector_ids, sentinel.offsets, progress=False)
+            mock_batch.assert_called_once_with(events, sentinel.detector_ids, sentinel.offsets, False, [])
+
 
 class CoincidenceDirectionReconstructionTest(unittest.TestCase):
 
@@ -205,6 +263,42 @@ class CoincidenceDirectionReconstructionTest(unittest.TestCase):
                          ((), (), ()))
         self.assertEqual(mock_reconstruct_coincidence.call_count, 2)
 
+    def test_reconstruct_coincidences_batch(self):
+        seed(1)
+        cluster = BaseCluster()
+        for number in range(501, 507):
+            cluster._add_station((uniform(-300, 300), uniform(-300, 300), uniform(-5, 5)), 0., number=number)
+        dirrec = self.dirrec.__class__(cluster)
+
+        coincidences = []
+        initials = []
+        for _ in range(100):
+            theta, phi = uniform(0, 1), uniform(-pi, pi)
+            coincidence = []
+            for station in cluster.stations:
+                if not randint(0, 3):
+                    continue
+                x, y, z = station.calc_center_of_mass_coordinates()
+                t = -(x * sin(theta) * cos(phi) + y * sin(theta) * sin(phi) + z * cos(theta)) / 0.299792458
+                event = {'timestamp': 100, 'ext_timestamp': 100 * int(1e9) + 5000, 't_trigger': 0.}
+                for i in range(1, 5):
+                    event['t%d' % i] = round(t + normal(0, 3)) if randint(0, 4) else -999.
+                coincidence.append((station.number, event))
+            coincidences.append(coincidence)
+            initials.append({'core_x': 0., 'core_y': 0.} if not randint(0, 10) else {})
+
+        theta, phi, nums = dirrec.reconstruct_coincidences_batch(coincidences, progress=False,
+                                                                 initials=initials, chunk_size=30)
+        expected = dirrec.reconstruct_coincidences(coincidences, progress=False, initials=initials)
+        self.assertEqual(len(theta), len(coincidences))
+        self.assertFalse(all(isnan(theta)))
+        self.assertEqual([list(n) for n in expected[2]], [list(n) for n in nums])
+        for i in range(len(coincidences)):
+            self.assertEqual(isnan(expected[0][i]), isnan(theta[i]))
+            if not isnan(expected[0][i]):
+                self.assertAlmostEqual(expected[0][i], theta[i])
+                self.assertAlmostEqual(expected[1][i], phi[i])
+
     def test_get_station_offsets(self):
         dirrec = self.dirrec
         mock_offsets = Mock()
@@ -571,6 +665,101 @@ class DirectAlgorithm(FlatAlgorithm):
             self.assertTrue(-pi <= phi < pi)
 
 
+class BatchDirectAlgorithm(object):
+
+    """Use this class to check the vectorized direct algorithms
+
+    The results should be the same as those of the scalar algorithm.
+
+    """
+
+    def test_reconstruct_common_batch(self):
+        seed(1)
+        n = 200
+        t = normal(0, 15, (n, 3)).round()
+        t[0] = 0.
+        t[1, 1] = nan
+        x = uniform(-10, 10, (n, 3))
+        y = uniform(-10, 10, (n, 3))
+        z = uniform(-1, 1, (n, 3))
+        x[2] = (0., 0., 0.)  # On a line
+        x[3, 1], y[3, 1], z[3, 1] = x[3, 0], y[3, 0], z[3, 0]  # Same location
+        theta, phi = self.algorithm.reconstruct_common_batch(t, x, y, z)
+        for i in range(n):
+            expected = self.algorithm.reconstruct_common(t[i], x[i], y[i], z[i])
+            self.assertEqual(isnan(expected[0]), isnan(theta[i]))
+            self.assertEqual(isnan(expected[1]), isnan(phi[i]))
+            if not isnan(expected[0]):
+                self.assertAlmostEqual(expected[0], theta[i])
+                self.assertAlmostEqual(expected[1], phi[i])
+        self.assertFalse(all(isnan(theta)))
+        self.assertTrue(isnan(theta[1:4]).all())
+
+        # The same detector positions for all events
+        theta_same_xyz, phi_same_xyz = self.algorithm.reconstruct_common_batch(t, x[4], y[4], z[4])
+        for i in range(n):
+            expected = self.algorithm.reconstruct_common(t[i], x[4], y[4], z[4])
+            self.assertEqual(isnan(expected[0]), isnan(theta_same_xyz[i]))
+            if not isnan(expected[0]):
+                self.assertAlmostEqual(expected[0], theta_same_xyz[i])
+                self.assertAlmostEqual(expected[1], phi_same_xyz[i])
+
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            self.algorithm.reconstruct_common_batch(zeros((2, 4)), zeros(4), zeros(4), zeros(4))
+        self.assertEqual(len(warned), 1)
+
+
+class BatchRegressionAlgorithm(object):
+
+    """Use this class to check the vectorized regression algorithms
+
+    The results should be the same as those of the scalar algorithm, also
+    when combining events with different numbers of detections.
+
+    """
+
+    def assert_same_as_scalar(self, theta, phi, t, x, y, z, mask):
+        for i in range(len(t)):
+            m = mask[i]
+            expected = self.algorithm.reconstruct_common(list(t[i][m]), list(x[i][m]),
+                                                         list(y[i][m]), list(z[i][m]))
+            self.assertEqual(isnan(expected[0]), isnan(theta[i]))
+            self.assertEqual(isnan(expected[1]), isnan(phi[i]))
+            if not isnan(expected[0]):
+                self.assertAlmostEqual(expected[0], theta[i])
+                self.assertAlmostEqual(expected[1], phi[i])
+
+    def test_reconstruct_common_batch(self):
+        seed(1)
+        n = 200
+        x = uniform(-100, 100, (n, 5))
+        y = uniform(-100, 100, (n, 5))
+        z = uniform(-5, 5, (n, 5))
+        theta = uniform(0, 1, (n, 1))
+        phi = uniform(-pi, pi, (n, 1))
+        t = (-(x * sin(theta) * cos(phi) + y * sin(theta) * sin(phi) + z * cos(theta)) / 0.299792458 +
+             normal(0, 5, (n, 5)))
+        x[0] = (0., 0., 0., 0., 0.)  # On a line
+        x[1, 1], y[1, 1], z[1, 1] = x[1, 0], y[1, 0], z[1, 0]  # Same location
+        mask = randint(0, 4, (n, 5)) > 0
+        mask[:, :3] = True
+
+        theta, phi = self.algorithm.reconstruct_common_batch(t, x, y, z)
+        self.assert_same_as_scalar(theta, phi, t, x, y, z, mask | True)
+        self.assertTrue(isnan(theta[0]))
+        self.assertFalse(all(isnan(theta)))
+
+        theta, phi = self.algorithm.reconstruct_common_batch(t, x, y, z, mask)
+        self.assert_same_as_scalar(theta, phi, t, x, y, z, mask)
+        self.assertTrue(isnan(theta[0]))
+        self.assertFalse(all(isnan(theta)))
+
+        self.assertTrue((direction_reconstruction.logic_checks_batch(t, x, y, z, mask) ==
+                         [direction_reconstruction.logic_checks(t[i][m], x[i][m], y[i][m], z[i][m])
+                          for i, m in enumerate(mask)]).all())
+
+
 class AltitudeAlgorithm(FlatAlgorithm):
 
     """Use this class to check the altitude support
@@ -741,14 +930,14 @@ class DirectAlgorithmTest(unittest.TestCase, DirectAlgorithm):
         self.algorithm = direction_reconstruction.DirectAlgorithm()
 
 
-class DirectAlgorithmCartesianTest(unittest.TestCase, DirectAlgorithm):
+class DirectAlgorithmCartesianTest(unittest.TestCase, DirectAlgorithm, BatchDirectAlgorithm):
 
     def setUp(self):
         self.algorithm = direction_reconstruction.DirectAlgorithmCartesian()
 
 
 class DirectAlgorithmCartesian3DTest(unittest.TestCase,
-                                     DirectAltitudeAlgorithm):
+                                     DirectAltitudeAlgorithm, BatchDirectAlgorithm):
 
     def setUp(self):
         self.algorithm = direction_reconstruction.DirectAlgorithmCartesian3D()
@@ -760,17 +949,30 @@ class FitAlgorithm3DTest(unittest.TestCase, MultiAltitudeAlgorithm):
         self.algorithm = direction_reconstruction.FitAlgorithm3D()
 
 
-class RegressionAlgorithmTest(unittest.TestCase, MultiAlgorithm):
+class RegressionAlgorithmTest(unittest.TestCase, MultiAlgorithm, BatchRegressionAlgorithm):
 
     def setUp(self):
         self.algorithm = direction_reconstruction.RegressionAlgorithm()
 
 
-class RegressionAlgorithm3DTest(unittest.TestCase, MultiAltitudeAlgorithm):
+class RegressionAlgorithm3DTest(unittest.TestCase, MultiAltitudeAlgorithm, BatchRegressionAlgorithm):
 
     def setUp(self):
         self.algorithm = direction_reconstruction.RegressionAlgorithm3D()
 
+    def test_reconstruct_common_batch_no_convergence(self):
+        t = array([[0., 10., 20., 5.]])
+        x = array([0., 10., 0., 10.])
+        y = array([0., 0., 10., 10.])
+        z = array([0., 1., 2., -3.])
+        with patch.object(direction_reconstruction.RegressionAlgorithm3D, 'MAX_ITERATIONS', 1):
+            self.assertTrue(isnan(self.algorithm.reconstruct_common(t[0], x, y, z)[0]))
+            theta, phi = self.algorithm.reconstruct_common_batch(t, x, y, z)
+        self.assertTrue(isnan(theta[0]))
+        self.assertTrue(isnan(phi[0]))
+        theta, phi = self.algorithm.reconstruct_common_batch(t, x, y, z)
+        self.assertFalse(isnan(theta[0]))
+
 
 class CurvedRegressionAlgorithmTest(unittest.TestCase, CurvedAlgorithm):
 
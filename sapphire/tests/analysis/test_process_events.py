@@ -4,12 +4,14 @@ import os
 import shutil
 import warnings
 import operator
+import zlib
 
 import tables
 from numpy import array
 from numpy.testing import assert_array_equal
-from mock import Mock
+from mock import Mock, patch
 
+from sapphire import utils
 from sapphire.analysis import process_events
 
 
@@ -33,22 +35,49 @@ class ProcessEventsTests(unittest.TestCase):
         event = self.proc.source[0]
         self.assertEqual(self.proc.get_traces_for_event(event)[12][3], 1334)
 
-    def test__find_unique_row_ids(self):
+    def test_get_traces_for_events(self):
+        events = self.proc.source[:2]
+        traces = self.proc.get_traces_for_events(events)
+        self.assertEqual(traces.shape[:2], (2, 4))
+        self.assertEqual(traces[0][3][12], 1334)
+
+    def test__get_traces(self):
+        events = self.proc.source[:2]
+        traces = self.proc._get_traces(events['traces'])
+        self.assertEqual(traces.shape[:2], (2, 4))
+        self.assertEqual(traces[0][3][12], 1334)
+        for event, event_traces in zip(events, traces):
+            single_traces = self.proc._get_traces(event['traces'])
+            n_samples = single_traces.shape[-1]
+            assert_array_equal(single_traces, event_traces[:, :n_samples])
+            self.assertEqual(list(self.proc._get_trace(event['traces'][0])),
+                             list(single_traces[0]))
+
+    def test__find_sorted_unique_row_ids(self):
         ext_timestamps = self.proc.source.col('ext_timestamp')
         enumerated_timestamps = list(enumerate(ext_timestamps))
         enumerated_timestamps.sort(key=operator.itemgetter(1))
         ids_in = [id for id, _ in enumerated_timestamps]
-        ids = self.proc._find_unique_row_ids(enumerated_timestamps)
-        self.assertEqual(ids, ids_in)
-
-        enumerated_timestamps = [(0, 1), (1, 1), (3, 2), (2, 2)]
-        ids = self.proc._find_unique_row_ids(enumerated_timestamps)
-        self.assertEqual(ids, [0, 3])
-
-        # Must be sorted by timestamp or the result will be differenct.
-        enumerated_timestamps = [(0, 1), (3, 2), (1, 1), (2, 2)]
-        ids = self.proc._find_unique_row_ids(enumerated_timestamps)
-        self.assertNotEqual(ids, [0, 3])
+        ids = self.proc._find_sorted_unique_row_ids(ext_timestamps)
+        assert_array_equal(ids, ids_in)
+
+        # Of duplicate values the first row is kept
+        ids = self.proc._find_sorted_unique_row_ids(array([1, 1, 2, 2]))
+        assert_array_equal(ids, [0, 2])
+
+        # Rows with a value of 0 are removed
+        ids = self.proc._find_sorted_unique_row_ids(array([1, 2, 1, 2, 0]))
+        assert_array_equal(ids, [0, 1])
+
+    def test__sorted_unique_row_ids_out_of_core(self):
+        source = self.proc.source
+        with self.proc._sorted_unique_row_ids(source, 'ext_timestamp') as ids:
+            ids_in = ids
+        with patch.multiple(process_events, CHUNK_SIZE=7,
+                            MAX_ROWS_SORTED_IN_MEMORY=10):
+            with self.proc._sorted_unique_row_ids(source,
+                                                  'ext_timestamp') as ids:
+                assert_array_equal(ids[:], ids_in)
 
     def test__reconstruct_time_from_traces(self):
         event = self.proc.source[10]
@@ -60,6 +89,14 @@ class ProcessEventsTests(unittest.TestCase):
         times = self.proc._reconstruct_time_from_traces(event)
         self.assertEqual(times[0], -1)
 
+    def test__reconstruct_time_from_traces_batch(self):
+        events = self.proc.source[:50]
+        traces = self.proc._get_traces(events['traces'])
+        times = self.proc._reconstruct_time_from_traces_batch(events, traces)
+        expected = [self.proc._reconstruct_time_from_traces(event)
+                    for event in events]
+        assert_array_equal(times, expected)
+
     def test__reconstruct_time_from_trace(self):
         trace = [220, 222, 224, 222, 220]
         self.assertEqual(self.proc._reconstruct_time_from_trace(trace, 200), 0)
@@ -73,6 +110,13 @@ class ProcessEventsTests(unittest.TestCase):
         self.assertEqual(self.proc.first_above_threshold(trace, 4), 2)
         self.assertEqual(self.proc.first_above_threshold(trace, 5), -999)
 
+    def test_first_above_threshold_batch(self):
+        traces = array([[0, 2, 4, 2, 0], [4, 2, 0, -1, -1]])
+        assert_array_equal(self.proc.first_above_threshold_batch(traces, [1, 1]), [1, 0])
+        assert_array_equal(self.proc.first_above_threshold_batch(traces, [4, 3]), [2, 0])
+        assert_array_equal(self.proc.first_above_threshold_batch(traces, [5, 5]), [-999, -999])
+        assert_array_equal(self.proc.first_above_threshold_batch(traces[:, :0], [5, 5]), [-999, -999])
+
 #     @patch.object(process_events.FindMostProbableValueInSpectrum, 'find_mpv')
     def test__process_pulseintegrals(self):
         self.proc.limit = 1
@@ -82,6 +126,17 @@ class ProcessEventsTests(unittest.TestCase):
         self.assertAlmostEqual(self.proc._process_pulseintegrals()[0][3], 3.98951741969)
         self.proc.limit = None
 
+    def test__process_pulseintegrals_in_chunks(self):
+        n_particles = self.proc._process_pulseintegrals()
+        with patch.object(process_events, 'CHUNK_SIZE', 7):
+            assert_array_equal(self.proc._process_pulseintegrals(), n_particles)
+
+    def test__number_of_particles(self):
+        integrals = array([[100., -1., -999., 0.], [300., 50., -1, 20.]])
+        all_mpv = array([100., 50., 10., float('nan')])
+        assert_array_equal(self.proc._number_of_particles(integrals, all_mpv),
+                           [[1., -1., -999., -999.], [3., 1., -1., -999.]])
+
     def create_tempfile_from_testdata(self):
         tmp_path = self.create_tempfile_path()
         data_path = self.get_testdata_path()
@@ -98,6 +153,93 @@ class ProcessEventsTests(unittest.TestCase):
         return os.path.join(dir_path, TEST_DATA_FILE)
 
 
+class DecodeTracesTests(unittest.TestCase):
+    def test_decode_traces(self):
+        blobs = [zlib.compress(b'200,201,1500,'),
+                 b'"' + zlib.compress(b'30,31') + b'"']
+        traces = process_events.decode_traces(blobs, [[0, 1, -1], [1, -1, 0]])
+        assert_array_equal(traces, [[[200, 201, 1500], [30, 31, -1], [-1, -1, -1]],
+                                    [[30, 31, -1], [-1, -1, -1], [200, 201, 1500]]])
+        self.assertEqual(traces.dtype, 'int16')
+
+    def test_decode_traces_missing(self):
+        traces = process_events.decode_traces([], [-1, -1])
+        self.assertEqual(traces.shape, (2, 0))
+
+
+class StoreDecodedTracesTests(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        fd, self.data_path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        dir_path = os.path.dirname(__file__)
+        shutil.copyfile(os.path.join(dir_path, TEST_DATA_FILE), self.data_path)
+        self.data = tables.open_file(self.data_path, 'a')
+        self.group = self.data.get_node(DATA_GROUP)
+        self.proc = process_events.ProcessEvents(self.data, DATA_GROUP,
+                                                 progress=False)
+        self.trace_idx = self.proc.source.col('traces')
+
+    def tearDown(self):
+        warnings.resetwarnings()
+        self.data.close()
+        os.remove(self.data_path)
+
+    def test_store_decoded_traces(self):
+        process_events.store_decoded_traces(self.data, DATA_GROUP,
+                                            progress=False)
+        offsets = self.group.decoded_traces_offsets
+        self.assertEqual(len(offsets), len(self.group.blobs) + 1)
+        self.assertEqual(offsets[-1], len(self.group.decoded_traces))
+        self.assertEqual(self.group.decoded_traces.atom.dtype, 'int16')
+        self.assertEqual(self.group.decoded_traces.filters.complib, 'blosc')
+
+        traces = process_events.read_decoded_traces(
+            self.group.decoded_traces, offsets, self.trace_idx)
+        assert_array_equal(traces, process_events.decode_traces(
+            self.group.blobs, self.trace_idx))
+
+        # Scattered traces and missing traces
+        trace_idx = array([self.trace_idx[-1], self.trace_idx[0], [-1] * 4])
+        traces = process_events.read_decoded_traces(
+            self.group.decoded_traces, offsets, trace_idx)
+        assert_array_equal(traces, process_events.decode_traces(
+            self.group.blobs, trace_idx))
+
+    def test_store_decoded_traces_new_blobs(self):
+        process_events.store_decoded_traces(self.data, DATA_GROUP,
+                                            progress=False)
+        offsets = self.group.decoded_traces_offsets.read()
+        decoded_traces = self.group.decoded_traces.read()
+
+        # Remove the last part, as if those blobs were added later
+        self.group.decoded_traces_offsets.truncate(501)
+        self.group.decoded_traces.truncate(offsets[500])
+        process_events.store_decoded_traces(self.data, DATA_GROUP,
+                                            progress=False)
+        assert_array_equal(self.group.decoded_traces_offsets.read(), offsets)
+        assert_array_equal(self.group.decoded_traces.read(), decoded_traces)
+
+    def test_get_traces_from_decoded_traces(self):
+        traces = self.proc._get_traces(self.trace_idx)
+        trace = list(self.proc._get_trace(self.trace_idx[0][1]))
+        process_events.store_decoded_traces(self.data, DATA_GROUP,
+                                            progress=False)
+        with patch.object(process_events, 'decode_traces') as mock_decode:
+            assert_array_equal(self.proc._get_traces(self.trace_idx), traces)
+            self.assertEqual(list(self.proc._get_trace(self.trace_idx[0][1])),
+                             trace)
+            self.assertFalse(mock_decode.called)
+
+    def test_get_traces_not_yet_decoded(self):
+        process_events.store_decoded_traces(self.data, DATA_GROUP,
+                                            progress=False)
+        self.group.decoded_traces_offsets.truncate(10)
+        with patch.object(process_events, 'read_decoded_traces') as mock_read:
+            self.proc._get_traces(self.trace_idx)
+            self.assertFalse(mock_read.called)
+
+
 class ProcessIndexedEventsTests(ProcessEventsTests):
     def setUp(self):
         warnings.filterwarnings('ignore')
@@ -110,9 +252,47 @@ class ProcessIndexedEventsTests(ProcessEventsTests):
         self.assertEqual(timings[1][0], 162.5)
         self.assertEqual(timings[1][1], -999)
 
+    def test_process_traces_with_workers(self):
+        self.proc.indexes = list(range(0, 280, 7))
+        timings = self.proc.process_traces()
+        self.proc.workers = 2
+        with patch.object(process_events, 'TRACE_CHUNK_SIZE', 3):
+            # 14 chunks, in 7 shards of 2 chunks
+            shards = self.proc._get_worker_shards(40)
+            self.assertEqual([shard[2:] for shard in shards],
+                             [(start, min(start + 6, 40), 3) for start in range(0, 40, 6)])
+            assert_array_equal(self.proc.process_traces(), timings)
+
+    @patch.object(utils, 'multiprocessing', Mock(spec=[]))
+    def test_process_traces_with_workers_python2(self):
+        # No spawned worker processes, the traces are processed serially
+        timings = self.proc.process_traces()
+        self.proc.workers = 2
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            assert_array_equal(self.proc.process_traces(), timings)
+        self.assertEqual(len(warned), 1)
+
     def test_get_traces_for_indexed_event_index(self):
         self.assertEqual(self.proc.get_traces_for_indexed_event_index(0)[12][3], 1334)
 
+    def test_process_and_store_results_in_workers(self):
+        for group in ['s502', 's503']:
+            self.data.copy_node(DATA_GROUP, '/', group, recursive=True)
+        processes = [
+            self.proc,
+            process_events.ProcessIndexedEventsWithoutTraces(self.data, '/s502', [0, 10],
+                                                             progress=False)]
+        process_events.process_and_store_results_in_workers(processes, 2, progress=False)
+        process_events.ProcessIndexedEvents(self.data, '/s503', [0, 10], progress=False).process_and_store_results()
+
+        result = self.data.root.s501.events.read()
+        expected = self.data.root.s503.events.read()
+        for name in expected.dtype.names:
+            assert_array_equal(result[name], expected[name])
+        self.assertEqual(result['t1'][0], 15.)
+        self.assertEqual(self.data.root.s502.events.col('t1')[0], -1)
+
 
 class ProcessEventsWithLINTTests(ProcessEventsTests):
     def setUp(self):
@@ -134,6 +314,11 @@ class ProcessEventsWithLINTTests(ProcessEventsTests):
         self.assertEqual(self.proc._reconstruct_time_from_trace(trace, 200), 1)
         self.assertEqual(self.proc._reconstruct_time_from_trace(trace, 210), -999)
 
+    def test__reconstruct_time_from_trace_batch(self):
+        traces = array([[200, 220]] * 4)
+        times = self.proc._reconstruct_time_from_trace_batch(traces, array([180, 190, 200, 210]))
+        assert_array_equal(times, [0, 0.5, 1, -999])
+
 
 class ProcessEventsWithTriggerOffsetTests(ProcessEventsTests):
     def setUp(self):
@@ -157,6 +342,15 @@ class ProcessEventsWithTriggerOffsetTests(ProcessEventsTests):
         self.assertEqual(times[2], -999)
         self.assertEqual(times[4], -999)
 
+    def test__reconstruct_time_from_traces_batch_with_external(self):
+        self.proc.trigger = [0, 0, 0, 1]
+        events = self.proc.source[8:12]
+        traces = self.proc._get_traces(events['traces'])
+        times = self.proc._reconstruct_time_from_traces_batch(events, traces)
+        self.assertEqual(times[2][0], 162.5)
+        self.assertEqual(times[2][2], -999)
+        assert_array_equal(times[:, 4], -999)
+
     def test__first_above_thresholds(self):
         # 2 detectors
         self.assertEqual(self.proc._first_above_thresholds((x for x in [200, 200, 900]), [300, 400], 900), [2, 2, -999])
@@ -242,6 +436,24 @@ class ProcessEventsWithTriggerOffsetTests(ProcessEventsTests):
         self.proc.trigger = (1, 3, False, 0)
         self.assertEqual(self.proc._reconstruct_trigger(low_idx, high_idx), result)
 
+    def test__reconstruct_trigger_batch(self):
+        low_idx = array([[-999, -999, -999, -999], [-999, -999, 3, -999],
+                         [-999, 0, 3, 2], [0, 2, 4, -999], [7, 4, 1, -999],
+                         [1, 3, 5, 7]])
+        high_idx = array([[-999, -999, -999, -999], [-999, -999, 10, -999],
+                          [8, 9, 2, -999], [-999, 5, 2, -999],
+                          [-999, -999, -999, -999], [2, 4, -999, -999]])
+        for trigger in [(0, 0, False, 0), (0, 0, True, 0), (2, 0, False, 0),
+                        (3, 2, True, 0), (1, 2, False, 0), (3, 0, False, 0),
+                        (0, 2, False, 0), (0, 4, False, 0), (1, 3, False, 0),
+                        (1, 1, True, 0), (0, 1, True, 0), (2, 0, True, 1)]:
+            self.proc.trigger = trigger
+            expected = [self.proc._reconstruct_trigger(list(low), list(high))
+                        for low, high in zip(low_idx, high_idx)]
+            triggers = array([trigger] * len(low_idx))
+            result = self.proc._reconstruct_trigger_batch(low_idx, high_idx, triggers)
+            assert_array_equal(result, expected)
+
 
 class ProcessEventsFromSourceTests(ProcessEventsTests):
     def setUp(self):
@@ -264,6 +476,145 @@ class ProcessEventsFromSourceTests(ProcessEventsTests):
         self.proc.process_and_store_results()
 
 
+class ProcessEventsIncrementalTests(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        self.data_path = self.create_tempfile_path()
+        shutil.copyfile(self.get_testdata_path(), self.data_path)
+        self.data = tables.open_file(self.data_path, 'a')
+        events = self.data.get_node(DATA_GROUP, 'events')
+        self.all_events = events.read()
+        events.truncate(0)
+        events.append(self.all_events[:150])
+        events.flush()
+
+    def tearDown(self):
+        warnings.resetwarnings()
+        self.data.close()
+        os.remove(self.data_path)
+
+    def test_process_and_store_results_incremental(self):
+        self.process_incremental()
+        results = self.data.get_node(DATA_GROUP, 'events')
+        self.assertEqual(len(results), 150)
+        self.assertEqual(results.attrs.processed_source_events, 150)
+        self.assertEqual(results.attrs.last_ext_timestamp,
+                         results.col('ext_timestamp').max())
+
+        # New events, including duplicates of already processed events
+        self.append_events(self.all_events[100:])
+        self.process_incremental()
+        self.assert_results_match_full_processing(results)
+
+    def test_process_and_store_results_incremental_without_new_events(self):
+        self.process_incremental()
+        self.append_events(self.all_events[:10])
+        self.process_incremental()
+        results = self.data.get_node(DATA_GROUP, 'events')
+        self.assertEqual(len(results), 150)
+        self.assertEqual(len(self.data.get_node(DATA_GROUP, '_events')), 150)
+
+    def test_process_and_store_results_incremental_appended_to_results(self):
+        self.process_incremental()
+        # Like publicdb.download_data, which appends to the 'events' table
+        results = self.data.get_node(DATA_GROUP, 'events')
+        results.append(results.read(0, 10))
+        results.flush()
+        self.assertRaises(RuntimeError, self.process_incremental)
+
+    def test_process_and_store_results_incremental_with_limit(self):
+        proc = process_events.ProcessEvents(self.data, DATA_GROUP,
+                                            progress=False)
+        self.assertRaises(RuntimeError, proc.process_and_store_results,
+                          limit=10, incremental=True)
+
+    def process_incremental(self):
+        proc = process_events.ProcessEvents(self.data, DATA_GROUP,
+                                            progress=False)
+        proc.process_and_store_results(incremental=True)
+
+    def append_events(self, events):
+        table = self.data.get_node(DATA_GROUP, '_events')
+        table.append(events)
+        table.flush()
+
+    def assert_results_match_full_processing(self, results):
+        ts = results.col('ext_timestamp')
+        assert_array_equal(ts, sorted(set(self.all_events['ext_timestamp'])))
+        assert_array_equal(results.col('event_id'), range(len(results)))
+        self.assertEqual(results.attrs.processed_source_events, len(results))
+
+        events = self.data.get_node(DATA_GROUP, '_events')
+        assert_array_equal(events.col('ext_timestamp'), ts)
+        assert_array_equal(events.col('event_id'), range(len(results)))
+
+        proc = process_events.ProcessEvents(self.data, DATA_GROUP,
+                                            progress=False)
+        proc.process_and_store_results(destination='full')
+        full = self.data.get_node(DATA_GROUP, 'full')
+        # Including the number of particles of the previously processed events
+        for col in full.colnames:
+            assert_array_equal(results.col(col), full.col(col))
+
+    def create_tempfile_path(self):
+        fd, path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        return path
+
+    def get_testdata_path(self):
+        dir_path = os.path.dirname(__file__)
+        return os.path.join(dir_path, TEST_DATA_FILE)
+
+
+class ProcessEventsFromSourceIncrementalTests(ProcessEventsIncrementalTests):
+    def setUp(self):
+        super(ProcessEventsFromSourceIncrementalTests, self).setUp()
+        self.dest_path = self.create_tempfile_path()
+        self.dest_data = tables.open_file(self.dest_path, 'w')
+
+    def tearDown(self):
+        self.dest_data.close()
+        os.remove(self.dest_path)
+        super(ProcessEventsFromSourceIncrementalTests, self).tearDown()
+
+    def test_process_and_store_results_incremental(self):
+        self.process_incremental()
+        results = self.dest_data.get_node(DATA_GROUP, 'events')
+        self.assertEqual(results.attrs.processed_source_events, 150)
+
+        self.append_events(self.all_events[100:])
+        self.process_incremental()
+        self.assertEqual(results.attrs.processed_source_events, 330)
+        ts = results.col('ext_timestamp')
+        assert_array_equal(ts, sorted(set(self.all_events['ext_timestamp'])))
+        assert_array_equal(results.col('event_id'), range(len(results)))
+        events = self.dest_data.get_node(DATA_GROUP, '_events')
+        assert_array_equal(events.col('ext_timestamp'), ts)
+
+    def test_process_and_store_results_incremental_without_new_events(self):
+        self.process_incremental()
+        self.process_incremental()
+        results = self.dest_data.get_node(DATA_GROUP, 'events')
+        self.assertEqual(len(results), 150)
+
+    def test_process_and_store_results_incremental_appended_to_results(self):
+        self.process_incremental()
+        results = self.dest_data.get_node(DATA_GROUP, 'events')
+        results.append(results.read(0, 10))
+        results.flush()
+        self.assertRaises(RuntimeError, self.process_incremental)
+
+    def process_incremental(self):
+        proc = process_events.ProcessEventsFromSource(
+            self.data, self.dest_data, DATA_GROUP, DATA_GROUP)
+        proc.process_and_store_results(incremental=True)
+
+    def append_events(self, events):
+        table = self.data.get_node(DATA_GROUP, 'events')
+        table.append(events)
+        table.flush()
+
+
 class ProcessEventsFromSourceWithTriggerOffsetTests(ProcessEventsFromSourceTests,
                                                     ProcessEventsWithTriggerOffsetTests):
     def setUp(self):
@@ -301,6 +652,26 @@ class ProcessEventsFromSourceWithTriggerOffsetStationTests(ProcessEventsFromSour
         self.assertEqual(times[2], -999)
         self.assertEqual(times[4], -999)
 
+    def test__reconstruct_time_from_traces_batch_with_external(self):
+        triggers = self.proc.station.triggers.copy()
+        triggers['external'] = 1
+        self.proc.station.triggers = triggers
+
+        events = self.proc.source[8:12]
+        traces = self.proc._get_traces(events['traces'])
+        times = self.proc._reconstruct_time_from_traces_batch(events, traces)
+        self.assertEqual(times[2][0], 162.5)
+        self.assertEqual(times[2][2], -999)
+        assert_array_equal(times[:, 4], -999)
+
+    def test__trigger_settings_batch(self):
+        events = self.proc.source[:20]
+        thresholds, triggers = self.proc._trigger_settings_batch(events)
+        for event, threshold, trigger in zip(events, thresholds, triggers):
+            expected_thresholds, expected_trigger = self.proc.station.trigger(event['timestamp'])
+            assert_array_equal(threshold, expected_thresholds)
+            assert_array_equal(trigger, expected_trigger)
+
 
 class ProcessSinglesTests(unittest.TestCase):
     def setUp(self):
@@ -2,6 +2,7 @@ import unittest
 from itertools import cycle
 
 from numpy import array
+from numpy.testing import assert_array_equal
 from mock import patch, sentinel, MagicMock
 
 from sapphire.analysis import process_traces
@@ -34,6 +35,51 @@ class TraceObservablesTests(unittest.TestCase):
         self.assertEqual(self.to.n_peaks, [2, 2, -1, -1])
 
 
+class TraceObservablesBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        trace = ([200] * 400 + [500] + [510] + [400] * 10 + [200] * 600 +
+                 [400] * 10 + [200])
+        trace2 = ([203, 199] * 200 + [500] + [510] + [398, 402] * 5 +
+                  [203, 199] * 300 + [400] * 10 + [200])
+        trace3 = [30] * 400 + [130] * 20 + [30] * 603
+        self.traces = array([array([trace, trace2]).T,
+                             array([trace3, trace]).T])
+        self.to = process_traces.TraceObservablesBatch(self.traces)
+
+    def test_baselines(self):
+        assert_array_equal(self.to.baselines, [[200, 201, -1, -1],
+                                               [30, 200, -1, -1]])
+
+    def test_std_dev(self):
+        assert_array_equal(self.to.std_dev, [[0, 2000, -1, -1],
+                                             [0, 0, -1, -1]])
+
+    def test_pulseheights(self):
+        assert_array_equal(self.to.pulseheights, [[310, 309, -1, -1],
+                                                  [100, 310, -1, -1]])
+
+    def test_integrals(self):
+        assert_array_equal(self.to.integrals, [[300 + 310 + 200 * 20,
+                                                299 + 309 + 199 * 20, -1, -1],
+                                               [100 * 20,
+                                                300 + 310 + 200 * 20, -1, -1]])
+
+    def test_n_peaks(self):
+        assert_array_equal(self.to.n_peaks, [[2, 2, -1, -1], [1, 2, -1, -1]])
+
+    def test_matches_trace_observables(self):
+        for attr in ['baselines', 'std_dev', 'pulseheights', 'integrals',
+                     'n_peaks']:
+            expected = [getattr(process_traces.TraceObservables(traces), attr)
+                        for traces in self.traces]
+            assert_array_equal(getattr(self.to, attr), expected)
+
+    def test_unsupported_number_of_detectors(self):
+        self.assertRaises(Exception, process_traces.TraceObservablesBatch,
+                          self.traces[:, :, :1])
+
+
 class MeanFilterTests(unittest.TestCase):
 
     def setUp(self):
@@ -149,6 +195,39 @@ class MeanFilterTests(unittest.TestCase):
         filtered_trace = self.mf.mean_filter_without_threshold(raw_trace)
         self.assertEqual(filtered_trace, exp_trace)
 
+    def test_mean_filter_with_threshold_batch(self):
+        raw_traces = [[199, 201, 199, 201, 236],
+                      [199, 211, 189, 201, 202],
+                      [199, 201, 199, 201, 205],
+                      [200, 201, 200, 201, 204]]
+        exp_traces = [[200, 200, 200, 200, 236],
+                      [199, 211, 189, 201, 202],
+                      [200, 200, 200, 200, 202],
+                      [200, 200, 200, 200, 202]]
+        filtered_traces = self.mf.mean_filter_with_threshold_batch(raw_traces)
+        assert_array_equal(filtered_traces, exp_traces)
+
+    def test_mean_filter_without_threshold_batch(self):
+        raw_traces = [[199, 201, 199, 201, 216, 220, 219, 205, 200, 201],
+                      [200, 201, 200, 201, 204, 200, 201, 200, 201, 204]]
+        exp_traces = [[200, 200, 200, 200, 204, 220, 219, 215, 200, 201],
+                      [200, 200, 200, 200, 202, 201, 201, 200, 200, 202]]
+        filtered_traces = \
+            self.mf.mean_filter_without_threshold_batch(raw_traces)
+        assert_array_equal(filtered_traces, exp_traces)
+
+    def test_filter_traces_batch(self):
+        raw_traces = array([[[199, 200], [201, 236], [199, 199], [201, 201],
+                             [216, 205], [220, 211], [219, 189], [205, 201],
+                             [200, 202], [201, 201], [203, 204]]] * 2)
+        for mf in [self.mf, process_traces.MeanFilter(use_threshold=False)]:
+            filtered_traces = mf.filter_traces_batch(raw_traces)
+            exp_traces = [array(mf.filter_traces(traces.T)).T
+                          for traces in raw_traces]
+            assert_array_equal(filtered_traces, exp_traces)
+            # The last sample of odd length traces is dropped
+            self.assertEqual(filtered_traces.shape, (2, 10, 2))
+
 
 class DataReductionTests(unittest.TestCase):
 
@@ -219,6 +298,43 @@ class DataReductionTests(unittest.TestCase):
         for input, expected in combinations:
             self.assertEqual(self.dr.add_padding(*input), expected)
 
+    def test_reduce_traces_batch(self):
+        baseline = 200
+        trace = ([baseline] * 400 + [baseline + 50] + [baseline + 60] * 4 +
+                 [baseline] * 600 + [baseline + 90] * 5 + [baseline] * 300)
+        trace2 = [baseline] * 10 + [baseline + 90] * 5 + [baseline] * 1295
+        flat = [baseline] * len(trace)
+        traces = array([array([trace, flat]).T, array([flat, trace2]).T,
+                        array([flat, flat]).T])
+
+        reduced_traces, left = self.dr.reduce_traces_batch(traces,
+                                                           return_offset=True)
+        self.assertEqual(len(reduced_traces), 3)
+        for event_traces, r_traces, r_left in zip(traces, reduced_traces,
+                                                  left):
+            exp_traces, exp_left = self.dr.reduce_traces(event_traces,
+                                                         return_offset=True)
+            assert_array_equal(r_traces, exp_traces)
+            self.assertEqual(r_left, exp_left)
+        assert_array_equal(left, [400 - self.dr.padding, 0, 0])
+
+    def test_determine_cuts_batch(self):
+        baseline = 200
+        trace = ([baseline] * 400 + [baseline + 50] + [baseline + 60] * 4 +
+                 [baseline] * 600 + [baseline + 90] * 5 + [baseline] * 300)
+        flat = [baseline] * len(trace)
+        traces = array([array([trace, flat]).T, array([flat, flat]).T])
+        left, right = self.dr.determine_cuts_batch(traces, [[baseline] * 2] * 2)
+        assert_array_equal(left, [400, 0])
+        assert_array_equal(right, [len(trace) - 300, len(trace)])
+
+    def test_add_padding_batch(self):
+        left, right = self.dr.add_padding_batch(array([0, 4, 50, 50]),
+                                                array([20, 20, 2400, 2390]),
+                                                2400)
+        assert_array_equal(left, [0, 0, 24, 24])
+        assert_array_equal(right, [46, 46, 2400, 2400])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -217,16 +217,17 @@ class ReconstructESDCoincidencesTest(unittest.TestCase):
         self.rec.coincidences = MagicMock()
         self.rec.coincidences.nrows = 1
         self.rec.direction = MagicMock()
-        self.rec.direction.reconstruct_coincidences.return_value = (sentinel.theta, sentinel.phi, sentinel.nums)
+        self.rec.direction.reconstruct_coincidences_batch.return_value = (sentinel.theta, sentinel.phi,
+                                                                          sentinel.nums)
         self.rec.reconstruct_directions()
-        self.rec.direction.reconstruct_coincidences.assert_called_once_with(
+        self.rec.direction.reconstruct_coincidences_batch.assert_called_once_with(
             self.rec.cq.all_events.return_value, None, self.rec.offsets, progress=False, initials=[])
         self.assertEqual(self.rec.theta, sentinel.theta)
         self.assertEqual(self.rec.phi, sentinel.phi)
         self.assertEqual(self.rec.station_numbers, sentinel.nums)
 
         self.rec.reconstruct_directions(sentinel.nums)
-        self.rec.direction.reconstruct_coincidences.assert_called_with(
+        self.rec.direction.reconstruct_coincidences_batch.assert_called_with(
             self.rec.cq.all_events.return_value, sentinel.nums, self.rec.offsets, progress=False, initials=[])
 
     def test_reconstruct_cores(self):
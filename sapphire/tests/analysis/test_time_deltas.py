@@ -3,10 +3,12 @@ import tempfile
 import os
 import shutil
 
+import numpy as np
 import tables
 from mock import patch, sentinel, Mock
 
 from sapphire.analysis import time_deltas
+from sapphire.analysis.event_utils import station_arrival_time
 
 
 TEST_DATA_FILE = 'test_data/esd_coincidences.h5'
@@ -40,9 +42,38 @@ class ProcessTimeDeltasTests(unittest.TestCase):
         self.td.get_detector_offsets()
 
         self.assertEqual(self.td.detector_timing_offsets,
-                         {sentinel.station1: mock_offsets.detector_timing_offset,
-                          sentinel.station2: mock_offsets.detector_timing_offset,
-                          sentinel.station3: mock_offsets.detector_timing_offset})
+                         {sentinel.station1: mock_offsets.detector_timing_offsets,
+                          sentinel.station2: mock_offsets.detector_timing_offsets,
+                          sentinel.station3: mock_offsets.detector_timing_offsets})
+
+    def test_determine_time_deltas(self):
+        offsets = np.array([(0, 1., 2., 3., 4.), (2000000000, 0., 0., 0., 0.)],
+                           dtype=[('timestamp', int), ('offset1', float),
+                                  ('offset2', float), ('offset3', float),
+                                  ('offset4', float)])
+        self.td.detector_timing_offsets = {501: offsets, 502: offsets[1:]}
+
+        expected_ets = []
+        expected_dt = []
+        for c_idx in self.data.root.coincidences.c_index:
+            events = {self.td.cq.s_numbers[s_idx]:
+                      self.td.cq.s_nodes[s_idx].events[e_idx]
+                      for s_idx, e_idx in c_idx}
+            ref_ets = self.td.cq.s_nodes[c_idx[0][0]].events[c_idx[0][1]]['ext_timestamp']
+            expected_ets.append(ref_ets)
+            expected_dt.append(
+                station_arrival_time(events[502], ref_ets, offsets=[0., 0., 0., 0.]) -
+                station_arrival_time(events[501], ref_ets, offsets=[1., 2., 3., 4.]))
+
+        result = self.td.determine_time_deltas([(501, 502), (502, 501), (501, 503)])
+        self.assertEqual(result[(501, 502)][0].tolist(), expected_ets)
+        self.assertEqual(result[(501, 502)][1].tolist(), expected_dt)
+        self.assertEqual(result[(502, 501)][0].tolist(), expected_ets)
+        self.assertEqual(result[(502, 501)][1].tolist(), [-dt for dt in expected_dt])
+        self.assertEqual(len(result[(501, 503)][0]), 0)
+
+        ets, dt = self.td.determine_time_deltas_for_pair(501, 502)
+        self.assertEqual(dt.tolist(), expected_dt)
 
     def test_store_time_deltas(self):
         pair = (501, 502)
@@ -2,7 +2,9 @@ import unittest
 import tempfile
 import os
 
+import numpy as np
 import tables
+from mock import patch
 
 from sapphire import kascade
 from sapphire.tests.validate_results import validate_results
@@ -36,5 +38,39 @@ class StoreKascadeDataTests(unittest.TestCase):
         return path
 
 
+class KascadeCoincidencesTests(unittest.TestCase):
+
+    @patch.object(kascade.KascadeCoincidences, '__init__')
+    def setUp(self, mock_init):
+        mock_init.return_value = None
+        self.kc = kascade.KascadeCoincidences()
+        self.kc._h = self.id_and_timestamp_array([100, 200, 300, 400])
+        self.kc._k = self.id_and_timestamp_array([50, 110, 160, 290, 350, 500])
+
+    def id_and_timestamp_array(self, timestamps):
+        ids = np.arange(len(timestamps), dtype=np.uint32)
+        timestamps = np.array(timestamps, dtype=np.uint64)
+        return np.rec.fromarrays([ids, timestamps],
+                                 names='event_id, ext_timestamp')
+
+    def test_search_coincidences(self):
+        self.kc.search_coincidences()
+        self.assertEqual(self.kc.coincidences['dt'].tolist(), [-10, 40, 10, 50])
+        self.assertEqual(self.kc.coincidences['h_idx'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(self.kc.coincidences['k_idx'].tolist(), [1, 2, 3, 4])
+
+    def test_search_coincidences_with_limits(self):
+        self.kc.search_coincidences(dtlimit=20e-9)
+        self.assertEqual(self.kc.coincidences['k_idx'].tolist(), [1, 3])
+        self.kc.search_coincidences(limit=2)
+        self.assertEqual(self.kc.coincidences['k_idx'].tolist(), [1, 2])
+
+    def test_search_coincidences_with_timeshift(self):
+        self.kc.search_coincidences(timeshift=-10e-9)
+        self.assertEqual(self.kc.coincidences['dt'].tolist(), [-20, 30, 0, 40])
+        self.kc.search_coincidences(timeshift=10e-9)
+        self.assertEqual(self.kc.coincidences['dt'].tolist(), [50, 20, -40])
+
+
 if __name__ == '__main__':
     unittest.main()
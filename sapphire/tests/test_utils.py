@@ -1,7 +1,10 @@
 from __future__ import print_function
+import os
 import unittest
 import types
+import warnings
 from six import StringIO
+from mock import patch, Mock
 
 from numpy import pi, random, exp, sqrt
 import progressbar
@@ -91,6 +94,14 @@ class ActiveIndexTests(unittest.TestCase):
                         (3, 5.)]:
             self.assertEqual(utils.get_active_index(timestamps, ts), idx)
 
+    def test_get_active_indexes(self):
+        """Vectorized lookup should match the bisection"""
+
+        timestamps = [1., 2., 3., 4.]
+        values = [0., 1., 1.5, 2., 2.1, 4., 5.]
+        expected = [utils.get_active_index(timestamps, ts) for ts in values]
+        self.assertEqual(utils.get_active_indexes(timestamps, values).tolist(), expected)
+
 
 class GaussTests(unittest.TestCase):
 
@@ -198,5 +209,30 @@ class WhichTests(unittest.TestCase):
                           'a_very_unlikely_program_name_to_exist_cosmic_ray')
 
 
+class WorkerPoolTests(unittest.TestCase):
+
+    """Check the worker processes"""
+
+    def test_use_worker_processes(self):
+        self.assertFalse(utils.use_worker_processes(None))
+        self.assertFalse(utils.use_worker_processes(1))
+        self.assertTrue(utils.use_worker_processes(2))
+
+    @patch.object(utils, 'multiprocessing', Mock(spec=[]))
+    def test_use_worker_processes_without_spawn(self):
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            self.assertFalse(utils.use_worker_processes(2))
+        self.assertEqual(len(warned), 1)
+
+    def test_worker_pool(self):
+        data = Mock(mode='a')
+        locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+        with utils.worker_pool(2, files=[data]) as pool:
+            data.flush.assert_called_once_with()
+            self.assertEqual(pool.map(abs, [-1, 2, -3]), [1, 2, 3])
+        self.assertEqual(os.environ.get('HDF5_USE_FILE_LOCKING'), locking)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,11 +5,17 @@ The module contains some commonly functions and classes.
 """
 from __future__ import division
 
+import multiprocessing
+import os
+import threading
+import warnings
+from contextlib import contextmanager
 from functools import wraps
 from bisect import bisect_right
 from distutils.spawn import find_executable
 
-from numpy import floor, ceil, round, arcsin, sin, pi, sqrt
+from numpy import (floor, ceil, round, arcsin, sin, pi, sqrt, searchsorted,
+                   maximum)
 from scipy.stats import norm
 from progressbar import ProgressBar, ETA, Bar, Percentage
 
@@ -89,6 +95,22 @@ def get_active_index(values, value):
     return idx - 1
 
 
+def get_active_indexes(values, timestamps):
+    """Get the indexes where many values fit.
+
+    Vectorized version of :func:`get_active_index`, useful to look up the
+    settings for a lot of events with a single call.
+
+    :param values: sorted array of values (e.g. array of timestamps).
+    :param timestamps: array of values for which to find the positions
+        (e.g. event timestamps).
+    :return: array of indexes into the values array.
+
+    """
+    idx = searchsorted(values, timestamps, side='right') - 1
+    return maximum(idx, 0)
+
+
 def gauss(x, n, mu, sigma):
     """Gaussian distribution
 
@@ -191,3 +213,75 @@ def memoize(method):
             return cache[key]
 
     return memoizer
+
+
+def use_worker_processes(workers):
+    """Check if the work should be done by worker processes
+
+    The workers are spawned as fresh processes, which is not possible in
+    Python 2.  Then a warning is issued and the work should be done in
+    the current process.
+
+    :param workers: the requested number of worker processes.
+    :return: True if more than one worker is requested and possible.
+
+    """
+    if workers is None or workers <= 1:
+        return False
+    if not hasattr(multiprocessing, 'get_context'):
+        warnings.warn('Worker processes require Python 3, the work is done '
+                      'in the current process.')
+        return False
+    return True
+
+
+#: Serializes the changes to the environment while starting workers
+_worker_environ_lock = threading.Lock()
+
+
+@contextmanager
+def worker_pool(workers, initializer=None, initargs=(), files=()):
+    """Start a pool of worker processes which can read the open HDF5 files
+
+    The workers are spawned as fresh processes, forked processes would
+    inherit the open files.  Spawning is only possible in Python 3, check
+    with :func:`use_worker_processes` first.
+
+    The workers only see data which is written to disk, so all files the
+    workers read which are open for writing in this process must be
+    passed as `files`.  These are flushed before the workers start, and
+    should not be modified while the pool is in use.
+
+    HDF5 file locking would prevent the workers from opening files which
+    are open for writing in this process.  HDF5 reads the
+    ``HDF5_USE_FILE_LOCKING`` environment variable when it is loaded, so
+    it is disabled in the environment of this process while the workers
+    are started and restored afterwards.
+
+    :param workers: number of worker processes.
+    :param initializer,initargs: function (and its arguments) called by
+                                 each worker when it starts.
+    :param files: the open HDF5 files which the workers read.
+
+    """
+    for data in files:
+        if data.mode != 'r':
+            data.flush()
+
+    with _worker_environ_lock:
+        locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+        os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+        try:
+            context = multiprocessing.get_context('spawn')
+            pool = context.Pool(workers, initializer, initargs)
+        finally:
+            if locking is None:
+                del os.environ['HDF5_USE_FILE_LOCKING']
+            else:
+                os.environ['HDF5_USE_FILE_LOCKING'] = locking
+
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()